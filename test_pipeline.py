@@ -5,9 +5,15 @@ import unittest
 from parameterized import parameterized
 import shutil
 import os
+import tempfile
+import json
+import logging
+import zipfile
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import xarray as xr
+import scipy.interpolate
 
 from util import define_models
 from util import mineos
@@ -15,6 +21,10 @@ from util import inversion
 from util import partial_derivatives
 from util import weights
 from util import constraints
+from util import ensemble
+from util import timing
+from util import logs
+from util import artefacts
 
 skipMINEOS = False
 
@@ -54,6 +64,34 @@ class PipelineTest(unittest.TestCase):
                                       expected.d_inds)
 
 
+    # =========================================================================
+    # Set up random problems for the least squares solvers
+    # =========================================================================
+    def random_least_squares_problem(self, thickness, boundary_inds, n_data):
+        """ Make a model and random G, d, W for the least squares solvers.
+
+        This draws from np.random, so set the seed in the test first.
+
+        Returns:
+            model, p, G, d, W, H, h, std
+        """
+        n_layers = len(thickness)
+        model = define_models.VsvModel(
+            vsv = np.linspace(3.2, 4.6, n_layers)[:, np.newaxis],
+            thickness = np.array(thickness)[:, np.newaxis],
+            boundary_inds = np.array(boundary_inds),
+            d_inds = np.arange(n_layers - 1),
+        )
+        p = inversion._build_model_vector(model, (0, sum(thickness)))
+        H, h, _ = weights._build_constraint_damp_zero_gradient(model)
+        G = np.random.normal(size=(n_data, p.size))
+        d = np.matmul(G, p) + np.random.normal(scale=0.05, size=(n_data, 1))
+        std = np.random.uniform(0.02, 0.1, n_data)
+        W = weights._build_error_weighting_matrix(std)
+
+        return model, p, G, d, W, H, h, std
+
+
     # =========================================================================
     # The tests to run
     # =========================================================================
@@ -233,6 +271,71 @@ class PipelineTest(unittest.TestCase):
 
         self.assertVsvModelEqual(calc_model, expected)
 
+    # test_add_noise_to_starting_model_seeded
+    def test_add_noise_to_starting_model_seeded(self):
+        """ Test that Monte Carlo trials spawned from one seed are repeatable.
+        """
+        def new_model():
+            return define_models.VsvModel(
+                np.array([[3.4, 3.6, 4.0, 4.2, 4.1, 4.4]]).T,
+                np.array([[0., 30., 3., 40., 10., 137.]]).T,
+                np.array([1, 3]),
+                np.arange(5),
+            )
+
+        seeds = np.random.SeedSequence(42).spawn(3)
+        models = [
+            define_models._add_noise_to_starting_model(
+                new_model(), (0, 220), rng=np.random.default_rng(seed)
+            ) for seed in seeds
+        ]
+        repeated = define_models._add_noise_to_starting_model(
+            new_model(), (0, 220),
+            rng=np.random.default_rng(np.random.SeedSequence(42).spawn(3)[1])
+        )
+
+        self.assertVsvModelEqual(models[1], repeated)
+        self.assertFalse(np.allclose(models[0].vsv, models[1].vsv))
+        self.assertAlmostEqual(np.sum(models[0].thickness), 220)
+
+    # test_adaptive_card_depths
+    @parameterized.expand([
+        ('loose tolerance', 0.005, 10.),
+        ('tight tolerance', 0.0005, 10.),
+        ('short max step', 0.005, 4.),
+    ])
+    def test_adaptive_card_depths(self, name, tolerance, max_step):
+        """ Test the adaptive MINEOS card fits Vsv and keeps the BLs dense.
+        """
+        thickness = [0.] + [6.] * 5 + [3.] + [6.] * 10 + [10.] + [6.] * 50
+        node_depth = np.cumsum(thickness)
+        vsv = np.interp(node_depth, [0, 30, 33, 93, 103, 400],
+                        [3.2, 3.8, 4.4, 4.5, 4.2, 4.7])
+        model = define_models.VsvModel(
+            vsv[:, np.newaxis], np.array(thickness)[:, np.newaxis],
+            np.array([5, 16]), np.arange(len(thickness) - 1),
+        )
+        model_params = define_models.ModelParams(
+            'testcase', depth_limits=(0, node_depth[-1]),
+            card_tolerance=tolerance, card_max_step=max_step,
+        )
+        depth = np.append(np.arange(0, node_depth[-1], 2.), node_depth[-1])[::-1]
+        card_vsv = np.interp(depth, node_depth, vsv)
+
+        keep = define_models._adaptive_card_depths(
+            depth, card_vsv, model, model_params
+        )
+
+        self.assertLess(np.sum(keep), 0.75 * len(depth))
+        self.assertTrue(keep[0] and keep[-1])
+        self.assertTrue(np.all(keep[(30 <= depth) & (depth <= 33)]))
+        self.assertTrue(np.all(keep[(93 <= depth) & (depth <= 103)]))
+        self.assertLessEqual(np.max(np.abs(np.diff(depth[keep]))), max_step)
+        interpolated = np.interp(depth[::-1], depth[keep][::-1],
+                                 card_vsv[keep][::-1])
+        self.assertLessEqual(np.max(np.abs(interpolated - card_vsv[::-1])),
+                             tolerance + 1e-12)
+
     # test_return_evenly_spaced_model
     @parameterized.expand([
         (
@@ -266,6 +369,70 @@ class PipelineTest(unittest.TestCase):
         np.testing.assert_allclose(vsv, exp_vs, rtol=0.01, atol=0.05)
         np.testing.assert_array_equal(bound_inds, exp_bi)
 
+    # test_return_evenly_spaced_model_sampled_mean
+    @parameterized.expand([
+        ('rough model', 0),
+        ('another rough model', 3),
+    ])
+    def test_return_evenly_spaced_model_sampled_mean(self, name, seed):
+        """ Test the respaced velocities are means of 0.1 km samples.
+
+        This is how the respacing has always worked, looping over the new
+        layers, so the vectorised version should match it exactly.
+        """
+        rs = np.random.RandomState(seed)
+        thickness = np.hstack((0., rs.uniform(2, 10, 5), 1.,
+                               rs.uniform(2, 10, 10), 2.,
+                               rs.uniform(2, 10, 20)))
+        vsv = rs.uniform(2.5, 4.8, thickness.size)
+        model = define_models.VsvModel(
+            vsv[:, np.newaxis], thickness[:, np.newaxis], np.array([5, 16]),
+            np.arange(thickness.size - 1),
+        )
+
+        new_t, new_v, new_bi = define_models._return_evenly_spaced_model(
+            model, 6.
+        )
+
+        new_t = new_t.flatten()
+        depth = np.cumsum(new_t)
+        sample_d = np.arange(0, np.cumsum(thickness)[-1], 0.1)
+        sample_v = np.interp(sample_d, np.cumsum(thickness), vsv)
+        for k in range(len(new_t) - 1):
+            if k in new_bi or k - 1 in new_bi:
+                continue # boundary layer nodes are copied across
+            half_t = new_t[max(k, 1)] / 2
+            in_layer = ((max(depth[k] - half_t, 0) <= sample_d)
+                        & (sample_d < depth[k] + half_t))
+            self.assertAlmostEqual(new_v[k, 0], np.mean(sample_v[in_layer]),
+                                   places=10)
+        np.testing.assert_allclose(
+            new_v[np.hstack((new_bi, new_bi + 1, -1)), 0],
+            vsv[np.hstack((model.boundary_inds, model.boundary_inds + 1,
+                           -1))],
+        )
+
+
+
+    # test_mean_val_in_interval
+    @parameterized.expand([
+        ('single layer', [3., 4.], [0., 10.], 0., 10., 3.495),
+        ('part of layer', [3., 4.], [0., 10.], 5., 10., 3.745),
+        ('across nodes', [3., 4., 4.], [0., 10., 10.], 5., 15., 3.8725),
+        ('zero thickness layer', [3., 4., 5., 5.], [0., 10., 0., 10.],
+            5., 15., 4.3725),
+        ('multiple intervals', [3., 4., 4.], [0., 10., 10.],
+            np.array([0., 5., 10.]), np.array([10., 15., 20.]),
+            np.array([3.495, 3.8725, 4.])),
+        ('no samples', [3., 4.], [0., 10.], 5.01, 5.02, np.nan),
+    ])
+    def test_mean_val_in_interval(self, name, v, thick, d1, d2, expected):
+        """ Test the mean of the profile sampled every 0.1 km in the interval.
+        """
+        np.testing.assert_allclose(
+            define_models._mean_val_in_interval(v, thick, d1, d2), expected
+        )
+
 
 
     # ************************* #
@@ -482,11 +649,509 @@ class PipelineTest(unittest.TestCase):
             dc_mineos, dc_from_Gdm, atol=0.01, rtol=0.05,
         )
 
+    # test_banded_damped_least_squares
+    @parameterized.expand([
+        (
+            'Moho LAB, 6 km nodes',
+            [0.] + [6.] * 5 + [3.] + [6.] * 10 + [10.] + [6.] * 30,
+            np.array([5, 16]),
+            12,
+            0.,
+        ),
+        (
+            'Moho LAB, 1 km nodes',
+            [0.] + [1.] * 35 + [3.] + [1.] * 60 + [10.] + [1.] * 290,
+            np.array([35, 96]),
+            17,
+            0.,
+        ),
+        (
+            'Moho LAB, 6 km nodes, Levenberg-Marquardt',
+            [0.] + [6.] * 5 + [3.] + [6.] * 10 + [10.] + [6.] * 30,
+            np.array([5, 16]),
+            12,
+            1.,
+        ),
+    ])
+    def test_banded_damped_least_squares(self, name, thickness, bi, n_data,
+                                         lm_lambda):
+        """ Test the banded (Woodbury) solve against the dense solve.
+        """
+        np.random.seed(42)
+        _, p, G, d, W, H, h, _ = self.random_least_squares_problem(
+            thickness, bi, n_data
+        )
+
+        m_dense = inversion._damped_least_squares(
+            p, G, d, W, H, h, inversion.InversionParams(), lm_lambda,
+        )
+        m_banded = inversion._damped_least_squares(
+            p, G, d, W, H, h, inversion.InversionParams(solver='banded'),
+            lm_lambda,
+        )
+
+        np.testing.assert_allclose(m_banded, m_dense, rtol=1e-6, atol=1e-6)
+
+        if lm_lambda:
+            m_gauss_newton = inversion._damped_least_squares(
+                p, G, d, W, H, h
+            )
+            self.assertLess(np.linalg.norm(m_dense - p),
+                            np.linalg.norm(m_gauss_newton - p))
+
+    # test_check_divergence
+    @parameterized.expand([
+        ('fine', [100., 80., 90., 60.], [[30.], [32.], [31.], [33.]],
+         [5, 5, 6, 5], ''),
+        ('misfit growing', [100., 110., 120., 130.], [[30.], [31.], [32.], [33.]],
+         [5, 5, 5, 5], 'misfit_growing'),
+        ('boundary oscillating', [100., 90., 95., 85., 88.],
+         [[30., 90.], [35., 91.], [29., 92.], [36., 93.], [28., 94.]],
+         [5] * 5, 'boundary_oscillation'),
+        ('small wiggles are fine', [100., 90., 95., 85., 88.],
+         [[30., 90.], [30.5, 91.], [29.8, 92.], [30.4, 93.], [29.9, 94.]],
+         [5] * 5, ''),
+        ('MINEOS restarts', [100., 90.], [[30.], [31.]], [5, 50],
+         'mineos_restarts'),
+    ])
+    def test_check_divergence(self, name, chi_squared, boundary_depths,
+                              n_mineos_runs, expected):
+        """ Test the checks for an inversion that will never converge.
+        """
+        self.assertEqual(
+            inversion._check_divergence(
+                chi_squared, boundary_depths, n_mineos_runs,
+                inversion.InversionParams(),
+            ),
+            expected,
+        )
+
+    # test_failure_log
+    def test_failure_log(self):
+        """ Test the failure log can be read back in.
+        """
+        failure_log = 'output/testcase/failed_locations.jsonl'
+        if os.path.exists(failure_log):
+            os.remove(failure_log)
+        report = inversion.InversionReport(
+            stop_reason='misfit_growing', diverged=True, n_iterations=3,
+            n_rejected=3, chi_squared=[100.], model_change=[0.1, 0.1, 0.1],
+            lm_lambda=10., boundary_depths=[[30., 90.]] * 4,
+            n_mineos_runs=[5] * 4, wall_time=12.,
+        )
+        for location in [(37, -107), (41, -108)]:
+            inversion._write_failure_log(
+                failure_log, location, define_models.ModelParams('testcase'),
+                report,
+            )
+
+        records = inversion.load_failure_log(failure_log)
+        self.assertEqual([(r['lat'], r['lon']) for r in records],
+                         [(37, -107), (41, -108)])
+        self.assertEqual(records[0]['stop_reason'], 'misfit_growing')
+        self.assertEqual(records[1]['boundary_depths'], [[30., 90.]] * 4)
+
+    # test_has_negative_thickness
+    @parameterized.expand([
+        ('fine', [3.5, 4., 4.2, 4.5, 4.4], False),
+        ('Moho moved too deep', [3.5, 4., 4.2, 4.5, 17.], True),
+        ('Moho moved too shallow', [3.5, 4., 4.2, 4.5, -1.], True),
+    ])
+    def test_has_negative_thickness(self, name, p, expected):
+        """ Test the check for unphysical least squares steps.
+        """
+        model = define_models.VsvModel(
+            vsv = np.array([[3.5, 4., 4.2, 4.5, 4.7]]).T,
+            thickness = np.array([[0., 10., 3., 6., 20.]]).T,
+            boundary_inds = np.array([1]),
+            d_inds = np.arange(4),
+        )
+
+        self.assertEqual(
+            inversion._has_negative_thickness(np.array([p]).T, model),
+            expected,
+        )
+
+    # test_model_uncertainty
+    @parameterized.expand([
+        ('dense', 'dense'),
+        ('banded', 'banded'),
+    ])
+    def test_model_uncertainty(self, name, solver):
+        """ Test the banded resolution and covariance against the full matrices.
+        """
+        np.random.seed(42)
+        thickness = [0.] + [6.] * 5 + [3.] + [6.] * 10 + [10.] + [6.] * 30
+        n_data = 12
+        _, p, G, d, W, H, h, std = self.random_least_squares_problem(
+            thickness, [5, 16], n_data
+        )
+        inversion_params = inversion.InversionParams(solver=solver)
+
+        m, uncertainty = inversion._damped_least_squares(
+            p, G, d, W, H, h, inversion_params, return_uncertainty=True
+        )
+
+        # Full matrices, calculated directly
+        F = np.vstack((np.matmul(np.sqrt(W), G), H))
+        Finv = np.matmul(np.linalg.inv(np.matmul(F.T, F)), F.T)
+        R = np.matmul(Finv[:, :n_data], np.matmul(np.sqrt(W), G))
+        cov_f = np.diag(np.hstack((std, np.ones(H.shape[0]))))
+        C = np.matmul(Finv, np.matmul(cov_f, Finv.T))
+        n_off = inversion_params.n_offdiagonals
+
+        np.testing.assert_allclose(m, np.matmul(Finv, np.vstack((
+            np.matmul(np.sqrt(W), d), h))), rtol=1e-6, atol=1e-6)
+        for k in range(-n_off, n_off + 1):
+            np.testing.assert_allclose(
+                uncertainty.resolution[n_off + k][~np.isnan(
+                    uncertainty.resolution[n_off + k])],
+                np.diag(R, k), rtol=1e-5, atol=1e-8,
+            )
+        for k in range(n_off + 1):
+            np.testing.assert_allclose(
+                uncertainty.covariance[k][:p.size - k], np.diag(C, k),
+                rtol=1e-5, atol=1e-8,
+            )
+
+    # test_damping_sweep
+    @parameterized.expand([
+        ('one', [1.]),
+        ('sweep', [0.1, 0.5, 1., 2., 10.]),
+        ('per layer', [[1.] * 5, [0.1, 1., 10., 1., 1.], [2., 0.5, 1., 3., 1.]]),
+        ('per layer, same shape', [[0.1, 0.05, 0.2, 0.1, 0.1],
+                                   [1., 0.5, 2., 1., 1.],
+                                   [10., 5., 20., 10., 10.]]),
+    ])
+    def test_damping_sweep(self, name, damping_scales):
+        """ Test the damping sweep against solving for each damping directly.
+        """
+        np.random.seed(42)
+        thickness = [0.] + [6.] * 5 + [3.] + [6.] * 10 + [10.] + [6.] * 30
+        model, p, G, d, W, H, h, _ = self.random_least_squares_problem(
+            thickness, [5, 16], 12
+        )
+
+        row_layers = None
+        if np.ndim(damping_scales) == 2:
+            row_layers = inversion._constraint_layers(
+                H, define_models._set_earth_layer_indices(
+                    define_models.ModelParams('testcase'), model
+                )
+            )
+            self.assertEqual(set(row_layers), {1, 2, 3})
+
+        sweep = inversion._damping_sweep(G, d, W, H, h, damping_scales,
+                                         row_layers)
+
+        for i, scale in enumerate(damping_scales):
+            if row_layers is not None:
+                scale = np.array(scale)[row_layers][:, np.newaxis]
+            m = inversion._damped_least_squares(p, G, d, W, H * scale,
+                                                h * scale)
+            np.testing.assert_allclose(sweep.models[i], m.flatten(),
+                                       rtol=1e-6, atol=1e-6)
+            self.assertAlmostEqual(
+                sweep.chi_squared[i] / inversion._weighted_chi_squared(
+                    m, G, d, W), 1, places=5,
+            )
+        if row_layers is not None:
+            return
+        # More damping means smoother models that fit the data worse
+        self.assertTrue(np.all(np.diff(sweep.chi_squared) >= -1e-8))
+        self.assertTrue(np.all(np.diff(sweep.roughness) <= 1e-8))
+
+    # test_joint_damped_least_squares
+    @parameterized.expand([
+        ('no lateral smoothing', 0., 0., False),
+        ('strong lateral smoothing', 1e4, 1e4, True),
+    ])
+    def test_joint_damped_least_squares(self, name, damping_s, damping_t,
+                                        smooth):
+        """ Test the joint sparse solve for a 2 x 2 grid of locations.
+        """
+        np.random.seed(42)
+        locations = [(35, -110), (35, -109), (36, -110), (36, -109)]
+        models, ps, Gs, ds, Ws, Hs, hs = [], [], [], [], [], [], []
+        for n_crust in [5, 6, 5, 7]:
+            thickness = ([0.] + [6.] * n_crust + [3.] + [6.] * 10 + [10.]
+                         + [6.] * (35 - n_crust))
+            model, p, G, d, W, H, h, _ = self.random_least_squares_problem(
+                thickness, [n_crust, n_crust + 11], 12
+            )
+            models += [model]
+            ps += [p]
+            Gs += [G]
+            ds += [d]
+            Ws += [W]
+            Hs += [H]
+            hs += [h]
+
+        neighbours = inversion._find_neighbours(locations)
+        self.assertEqual(neighbours, [(0, 1), (0, 2), (1, 3), (2, 3)])
+
+        inversion_params = inversion.InversionParams(
+            lateral_damping_s=damping_s, lateral_damping_t=damping_t,
+        )
+        m_joint = inversion._joint_damped_least_squares(
+            Gs, ds, Ws, Hs, hs, models, neighbours, inversion_params
+        )
+
+        if not smooth:
+            for i in range(len(locations)):
+                m_single = inversion._damped_least_squares(
+                    ps[i], Gs[i], ds[i], Ws[i], Hs[i], hs[i]
+                )
+                np.testing.assert_allclose(m_joint[i], m_single,
+                                           rtol=1e-4, atol=1e-4)
+        else:
+            bl_depths = [
+                inversion._boundary_depths(
+                    inversion._build_inversion_model_from_model_vector(m, model)
+                ) for m, model in zip(m_joint, models)
+            ]
+            np.testing.assert_allclose(bl_depths, [bl_depths[0]] * 4,
+                                       atol=0.1)
+
+    # test_combine_reports
+    def test_combine_reports(self):
+        """ Test the reports from a coarse-to-fine schedule are joined up.
+        """
+        coarse = inversion.InversionReport(
+            stop_reason='max_iterations', diverged=False, n_iterations=2,
+            n_rejected=1, chi_squared=[100., 50.], model_change=[0.1, 0.05],
+            lm_lambda=0.01, boundary_depths=[[30.], [32.], [33.]],
+            n_mineos_runs=[3, 3, 3], wall_time=10.,
+        )
+        fine = inversion.InversionReport(
+            stop_reason='model_converged', diverged=False, n_iterations=1,
+            n_rejected=0, chi_squared=[45., 20.], model_change=[0.0001],
+            lm_lambda=0.001, boundary_depths=[[33.], [33.1]],
+            n_mineos_runs=[5, 5], wall_time=30.,
+        )
+
+        report = inversion._combine_reports([coarse, fine])
+
+        self.assertEqual(report.stop_reason, 'model_converged')
+        self.assertEqual(report.n_iterations, 3)
+        self.assertEqual(report.n_rejected, 1)
+        self.assertEqual(report.chi_squared, [100., 50., 45., 20.])
+        self.assertEqual(report.n_mineos_runs, [3, 3, 3, 5, 5])
+        self.assertEqual(report.lm_lambda, 0.001)
+        self.assertEqual(report.wall_time, 40.)
+
+    # test_space_filling_order
+    @parameterized.expand([
+        ('4 x 4 grid', [(lat, lon) for lat in range(33, 37)
+                        for lon in range(-110, -106)], 1.),
+        ('8 x 8 quarter degree grid', [(lat / 4, lon / 4)
+                                       for lat in range(140, 148)
+                                       for lon in range(-440, -432)], 0.25),
+        ('3 x 5 grid', [(lat, lon) for lat in range(33, 36)
+                        for lon in range(-110, -105)], 1.),
+    ])
+    def test_space_filling_order(self, name, locations, spacing):
+        """ Test that every location is visited once, mostly by neighbours.
+        """
+        order = inversion._space_filling_order(locations)
+
+        self.assertEqual(sorted(order), list(range(len(locations))))
+        steps = np.sum(np.abs(np.diff(
+            np.array(locations)[order], axis=0
+        )), axis=1)
+        # Every location has a neighbour somewhere earlier in the order
+        visited = np.array(locations)[order]
+        for i in range(1, len(order)):
+            self.assertLessEqual(
+                np.min(np.sum(np.abs(visited[:i] - visited[i]), axis=1)),
+                spacing + 1e-9,
+            )
+        if len(locations) in (16, 64):
+            np.testing.assert_allclose(steps, spacing)
+
+    # test_warm_start_model
+    @parameterized.expand([
+        ('same spacing', 6.),
+        ('coarse spacing', 18.),
+    ])
+    def test_warm_start_model(self, name, min_layer_thickness):
+        """ Test the respaced warm start keeps the boundary layers.
+        """
+        model = define_models.VsvModel(
+            vsv = np.array([[3.4, 3.6, 3.7, 4.0, 4.5, 4.4, 4.3, 4.2, 4.4]]).T,
+            thickness = np.array([[0., 12., 13.6, 3., 40., 23., 5., 40., 60.]]).T,
+            boundary_inds = np.array([2, 5]),
+            d_inds = np.arange(8),
+        )
+        model_params = define_models.ModelParams(
+            'testcase', depth_limits=(0, 196.6),
+            boundaries=(('Moho', 'LAB'), [3., 5.]),
+            min_layer_thickness=min_layer_thickness,
+        )
+
+        new_model = inversion._warm_start_model(model, model_params)
+
+        self.assertTrue(np.all(
+            np.delete(new_model.thickness[1:],
+                      new_model.boundary_inds).flatten()
+            >= min_layer_thickness - 1e-6
+        ))
+
+        self.assertAlmostEqual(np.sum(new_model.thickness), 196.6)
+        np.testing.assert_allclose(
+            inversion._boundary_depths(new_model),
+            inversion._boundary_depths(model),
+        )
+        np.testing.assert_allclose(
+            new_model.thickness[new_model.boundary_inds + 1].flatten(),
+            [3., 5.],
+        )
+        # Input model is not changed
+        self.assertEqual(model.thickness[1, 0], 12.)
+
+    # test_batched_damped_least_squares
+    @parameterized.expand([
+        (
+            'different numbers of model parameters and data',
+            [
+                ([0.] + [6.] * 5 + [3.] + [6.] * 10 + [10.] + [6.] * 30,
+                 np.array([5, 16]), 12),
+                ([0.] + [6.] * 7 + [3.] + [6.] * 12 + [10.] + [6.] * 25,
+                 np.array([7, 20]), 12),
+                ([0.] + [6.] * 4 + [3.] + [6.] * 8 + [10.] + [6.] * 20,
+                 np.array([4, 13]), 9),
+            ],
+        ),
+    ])
+    def test_batched_damped_least_squares(self, name, all_inputs):
+        """ Test the batched solve against solving one location at a time.
+        """
+        np.random.seed(42)
+        ps, Gs, ds, Ws, Hs, hs = [], [], [], [], [], []
+        for thickness, bi, n_data in all_inputs:
+            _, p, G, d, W, H, h, _ = self.random_least_squares_problem(
+                thickness, bi, n_data
+            )
+            ps += [p]
+            Gs += [G]
+            ds += [d]
+            Ws += [W]
+            Hs += [H]
+            hs += [h]
+
+        m_batched = inversion._batched_damped_least_squares(Gs, ds, Ws, Hs, hs)
+        m_banded = inversion._batched_damped_least_squares(
+            Gs, ds, Ws, Hs, hs, inversion.InversionParams(solver='banded')
+        )
+
+        for i in range(len(all_inputs)):
+            m_single = inversion._damped_least_squares(
+                ps[i], Gs[i], ds[i], Ws[i], Hs[i], hs[i]
+            )
+            np.testing.assert_allclose(m_batched[i], m_single, rtol=1e-6)
+            np.testing.assert_allclose(m_banded[i], m_single,
+                                       rtol=1e-6, atol=1e-6)
+
+    # test_check_convergence
+    @parameterized.expand([
+        ('keep going', [100., 50.], [0.1, 0.1], 1., '', ''),
+        ('fit to within error', [100., 9.], [0.1], 1., 'chi_squared_target', ''),
+        ('misfit converged', [100., 99.5], [0.1], 1., 'misfit_converged', ''),
+        ('misfit got worse', [100., 120.], [0.1], 1., '', ''),
+        ('stagnated', [100., 80., 90., 85., 81.], [0.1] * 4, 1.,
+         'stagnated', ''),
+        ('model converged', [100., 50.], [0.1, 0.0005], 1.,
+         '', 'model_converged'),
+        ('max iterations', [100., 50.], [0.1] * 5, 1., '', 'max_iterations'),
+        ('max wall time', [100., 50.], [0.1], 1e4, '', 'max_wall_time'),
+    ])
+    def test_check_convergence(self, name, chi_squared, model_change,
+                               wall_time, expected_misfit, expected_model):
+        """ Test the stopping criteria for run_inversion().
+        """
+        inversion_params = inversion.InversionParams(max_wall_time=3600.)
+        n_data = 10
+
+        self.assertEqual(
+            inversion._check_misfit_convergence(
+                chi_squared, n_data, inversion_params
+            ),
+            expected_misfit,
+        )
+        self.assertEqual(
+            inversion._check_model_convergence(
+                model_change, wall_time, inversion_params
+            ),
+            expected_model,
+        )
+
+    # test_check_model_convergence_rejected_step
+    def test_check_model_convergence_rejected_step(self):
+        """ Test a tiny rejected step doesn't count as convergence.
+
+        The model change is only recorded for accepted steps, but rejected
+        steps still count towards max_iterations.
+        """
+        inversion_params = inversion.InversionParams(max_iterations=5)
+
+        self.assertEqual(
+            inversion._check_model_convergence(
+                [0.1], 1., inversion_params, 2, accepted=False
+            ),
+            '',
+        )
+        self.assertEqual(
+            inversion._check_model_convergence(
+                [0.1, 0.05], 1., inversion_params, 5, accepted=False
+            ),
+            'max_iterations',
+        )
+        self.assertEqual(
+            inversion._check_model_convergence(
+                [0.1, 0.0001], 1., inversion_params, 3, accepted=True
+            ),
+            'model_converged',
+        )
+
 
     # ************************* #
     #   partial_derivatives.py  #
     # ************************* #
 
+    # test_integrate_dc_dvsv_dvsv_dp_indepth
+    @parameterized.expand([
+        ('even spacing', np.arange(0., 50., 2.)),
+        ('uneven spacing', np.array([0., 2., 4., 6., 14., 24., 26., 28., 40.])),
+        ('decreasing depth', np.arange(50., 0., -2.)),
+    ])
+    def test_integrate_dc_dvsv_dvsv_dp_indepth(self, name, depth):
+        """ Test the trapezoidal integration against the explicit loop.
+        """
+        np.random.seed(42)
+        n_periods, n_params, n_model = 4, 5, 6
+        G_MINEOS = np.random.normal(size=(n_periods, n_params * len(depth)))
+        dm_dp_mat = np.random.normal(size=(n_params * len(depth), n_model))
+
+        expected = np.zeros((n_periods, n_model))
+        for period in range(n_periods):
+            for mod in range(n_model):
+                for dep in range(G_MINEOS.shape[1] - 1):
+                    idep = dep % len(depth)
+                    if idep == len(depth) - 1:
+                        continue
+                    expected[period, mod] += (
+                        1/2 * (depth[idep + 1] - depth[idep])
+                        * (G_MINEOS[period, dep] * dm_dp_mat[dep, mod]
+                           + G_MINEOS[period, dep + 1] * dm_dp_mat[dep + 1, mod])
+                    )
+
+        np.testing.assert_allclose(
+            partial_derivatives._integrate_dc_dvsv_dvsv_dp_indepth(
+                G_MINEOS, depth, dm_dp_mat
+            ),
+            expected,
+        )
+
     # test_build_MINEOS_G_matrix
     @parameterized.expand([
         (
@@ -979,5 +1644,579 @@ class PipelineTest(unittest.TestCase):
 
 
 
+    # ************************* #
+    #        ensemble.py        #
+    # ************************* #
+
+    # test_update_running_stats
+    @parameterized.expand([
+        ('scalars', np.array([4.1, 4.3, 3.9, 4.6, 4.2])),
+        ('arrays', np.random.RandomState(42).normal(4, 0.2, (50, 7))),
+    ])
+    def test_update_running_stats(self, name, samples):
+        """ Test Welford's running mean and variance against numpy.
+        """
+        stats = ensemble.RunningStats()
+        for x in samples:
+            stats = ensemble._update_running_stats(stats, x)
+
+        self.assertEqual(stats.n, len(samples))
+        np.testing.assert_allclose(stats.mean, np.mean(samples, axis=0))
+        np.testing.assert_allclose(ensemble._running_std(stats),
+                                   np.std(samples, axis=0, ddof=1))
+
+        # No samples at all, e.g. if every trial diverged
+        empty = ensemble.RunningStats(mean=np.zeros(np.shape(samples[0])),
+                                      m2=np.zeros(np.shape(samples[0])))
+        for mean_or_std in (ensemble._running_mean(empty),
+                            ensemble._running_std(empty)):
+            self.assertEqual(np.shape(mean_or_std), np.shape(samples[0]))
+            self.assertTrue(np.all(np.isnan(mean_or_std)))
+        self.assertTrue(np.isnan(float(ensemble._running_mean(
+            ensemble.RunningStats()
+        ))))
+
+
+
+
+    # ************************* #
+    #         timing.py         #
+    # ************************* #
+
+    # test_timing_record
+    def test_timing_record(self):
+        """ Test nested spans are added up and written out per record.
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        timing_log = os.path.join(tmp_dir.name, 'timing.jsonl')
+        timing.collect_spans()
+
+        for iteration in range(2):
+            with timing.span('forward'):
+                for run in range(3):
+                    with timing.span('run_mineos'):
+                        pass
+            with timing.span('solve'):
+                pass
+            timing.write_timing_record(timing_log, id='testcase',
+                                       iteration=iteration)
+        # Nothing to write, so no record
+        timing.write_timing_record(timing_log, id='testcase', iteration=2)
+
+        records = timing.load_timing_records(timing_log)
+        self.assertEqual([r['iteration'] for r in records], [0, 1])
+        self.assertEqual(
+            sorted(records[0]['spans']),
+            ['forward', 'forward/run_mineos', 'solve'],
+        )
+        self.assertEqual(records[1]['spans']['forward/run_mineos']['count'], 3)
+        self.assertGreaterEqual(
+            records[1]['spans']['forward']['seconds'],
+            records[1]['spans']['forward/run_mineos']['seconds'],
+        )
+        summary = timing.summarise_timing_records(records)
+        self.assertEqual(dict((s[0], s[2]) for s in summary),
+                         {'forward': 2, 'forward/run_mineos': 6, 'solve': 2})
+
+
+
+    # ************************* #
+    #          logs.py          #
+    # ************************* #
+
+    # test_logging
+    @parameterized.expand([
+        ('json lines', True),
+        ('plain text', False),
+    ])
+    def test_logging(self, name, json_lines):
+        """ Test log messages are labelled with their context and level.
+        """
+        log_file = 'output/testcase/log.txt'
+        if os.path.exists(log_file):
+            os.remove(log_file)
+        logs.setup_logging('INFO', log_file, json_lines)
+        logger = logging.getLogger('util.testcase')
+
+        with logs.context(id='testcase', location=(37, -107)):
+            logger.debug('Not shown')
+            logger.info('Run %d', 1)
+            with logs.context(trial=3):
+                logger.warning('Trial failed')
+        logger.info('No context')
+        for i in range(5):
+            logs.log_progress(logger, name, 'Progress %d', i,
+                              min_interval=60., force=(i == 4))
+        logs.setup_logging('WARNING')
+
+        with open(log_file, 'r') as fid:
+            lines = fid.read().splitlines()
+        self.assertEqual(len(lines), 5)
+        if json_lines:
+            records = [json.loads(line) for line in lines]
+            self.assertEqual(
+                [r['message'] for r in records],
+                ['Run 1', 'Trial failed', 'No context',
+                 'Progress 0', 'Progress 4'],
+            )
+            self.assertEqual(records[0]['location'], [37, -107])
+            self.assertEqual(records[1]['trial'], 3)
+            self.assertEqual(records[1]['level'], 'WARNING')
+            self.assertNotIn('id', records[2])
+        else:
+            self.assertIn("'id': 'testcase'", lines[0])
+            self.assertTrue(lines[0].endswith('Run 1'))
+
+
+
+    # ************************* #
+    #        artefacts.py       #
+    # ************************* #
+
+    # test_artefacts
+    @parameterized.expand([
+        ('write', 'write'),
+        ('bundle', 'bundle'),
+        ('none', 'none'),
+    ])
+    def test_artefacts(self, name, mode):
+        """ Test CSV artefacts are written, bundled or dropped as asked.
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        save_dir = tmp_dir.name + '/'
+        bundle_file = save_dir + 'testcase_artefacts.zip'
+        # Don't depend on INVERSION_ARTEFACTS in the environment
+        self.addCleanup(artefacts.set_mode, artefacts.get_mode())
+        artefacts.set_mode('write')
+        df = pd.DataFrame({'Depth': [10., 20.], 'roughness': [1., 0.]})
+
+        with artefacts.run(mode, bundle_file):
+            self.assertEqual(artefacts.get_mode(), mode)
+            artefacts.save_csv(df, save_dir + 'damp_s.csv', index=False)
+            artefacts.save_csv(df * 2, save_dir + 'damp_t.csv', index=False)
+            self.assertFalse(os.path.exists(bundle_file))
+        self.assertEqual(artefacts.get_mode(), 'write')
+
+        files = sorted(os.listdir(save_dir))
+        if mode == 'write':
+            self.assertEqual(files, ['damp_s.csv', 'damp_t.csv'])
+            pd.testing.assert_frame_equal(
+                pd.read_csv(save_dir + 'damp_t.csv'), df * 2
+            )
+        elif mode == 'bundle':
+            self.assertEqual(files, ['testcase_artefacts.zip'])
+            with zipfile.ZipFile(bundle_file) as zf:
+                self.assertEqual(sorted(zf.namelist()),
+                                 ['damp_s.csv', 'damp_t.csv'])
+                with zf.open('damp_t.csv') as fid:
+                    pd.testing.assert_frame_equal(pd.read_csv(fid), df * 2)
+            # Nothing is kept once it has been bundled
+            self.assertEqual(artefacts.write_bundle(bundle_file), [])
+        else:
+            self.assertEqual(files, [])
+
+    # test_artefacts_per_location
+    def test_artefacts_per_location(self):
+        """ Test each location in a batched run gets its own bundle.
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmp_dir.name)
+        all_model_params = [
+            define_models.ModelParams('testcase_{}N_-110E'.format(lat))
+            for lat in (35, 36)
+        ]
+        df = pd.DataFrame({'Depth': [10., 20.], 'roughness': [1., 0.]})
+
+        with inversion._artefacts_per_location(
+                all_model_params, inversion.InversionParams(artefacts='bundle')
+                ):
+            for mp in all_model_params:
+                artefacts.save_csv(df, 'output/{}/damp_s.csv'.format(mp.id),
+                                   index=False)
+            self.assertEqual(artefacts.get_mode(), 'bundle')
+
+        for mp in all_model_params:
+            with zipfile.ZipFile(inversion._artefact_bundle_file(mp.id)) as zf:
+                self.assertEqual(zf.namelist(), ['damp_s.csv'])
+        self.assertEqual(artefacts.write_bundle('output/left_over.zip'), [])
+
+
+
+    # ************************* #
+    #       constraints.py      #
+    # ************************* #
+
+    # test_query_surface_wave_store
+    @parameterized.expand([
+        ('single location', [(37.2, -107.6)]),
+        ('many locations', [(lat, lon) for lat in np.arange(33, 43, 0.7)
+                            for lon in np.arange(-117, -102, 0.9)]),
+        ('longitudes 0 to 360', [(36.1, 360 - 110.3), (40.8, 249.6)]),
+    ])
+    def test_query_surface_wave_store(self, name, locations):
+        """ Test the KD-tree lookup finds the same pixels as a full search.
+        """
+        rng = np.random.RandomState(42)
+        phv = pd.concat([
+            pd.DataFrame({
+                'period': period,
+                'lat': np.repeat(np.arange(30., 45., step), 20),
+                'lon': np.tile(np.linspace(-120, -100, 20), 15 // step)
+                       + rng.uniform(-0.1, 0.1, 20 * 15 // step),
+                'ph_vel': rng.normal(3.5 + period / 100, 0.1, 20 * 15 // step),
+            }) for period, step in [(10., 1), (25., 1), (60., 3)]
+        ])
+        store = constraints.build_surface_wave_store(phv)
+        ph_vel, lat, lon = constraints.query_surface_wave_store(
+            store, locations
+        )
+
+        np.testing.assert_array_equal(store.periods, [10., 25., 60.])
+        self.assertEqual(ph_vel.shape, (len(locations), 3))
+        for il, location in enumerate(locations):
+            for ip, period in enumerate(store.periods):
+                pv = phv[phv['period'] == period].reset_index(drop=True)
+                ind = constraints._find_closest_lat_lon(pv, location)
+                self.assertEqual(ph_vel[il, ip], pv.loc[ind, 'ph_vel'])
+                self.assertEqual(lat[il, ip], pv.loc[ind, 'lat'])
+
+    # test_query_surface_wave_store_bilinear
+    @parameterized.expand([
+        ('inside grid', [(36.3, -108.45), (37.9, -109.1)], True),
+        ('outside grid', [(46.2, -108.3)], False),
+    ])
+    def test_query_surface_wave_store_bilinear(self, name, locations,
+                                               in_grid):
+        """ Test bilinear interpolation, and great circle nearest fallback.
+        """
+        lat, lon = np.meshgrid(np.arange(35., 39., 0.25),
+                               np.arange(-110., -107., 0.5), indexing='ij')
+        lat, lon = lat.flatten(), lon.flatten()
+        rng = np.random.RandomState(42)
+        scattered = rng.uniform([34., -111.], [40., -106.], (50, 2))
+        phv = pd.DataFrame({
+            'period': [10.] * lat.size + [60.] * 50,
+            'lat': np.append(lat, scattered[:, 0]),
+            'lon': np.append(lon, scattered[:, 1]),
+            'ph_vel': np.append(3. + 0.1 * lat + 0.02 * lon,
+                                rng.normal(4., 0.1, 50)),
+        })
+        store = constraints.build_surface_wave_store(phv)
+        self.assertIsNotNone(store.grids[0])
+        self.assertIsNone(store.grids[1])
+
+        ph_vel, _, _ = constraints.query_surface_wave_store(
+            store, locations, 'bilinear'
+        )
+
+        for il, (la, lo) in enumerate(locations):
+            if in_grid:
+                self.assertAlmostEqual(ph_vel[il, 0],
+                                       3. + 0.1 * la + 0.02 * lo)
+            # Nearest along a great circle, by brute force
+            for ip, period in enumerate([10., 60.]):
+                if in_grid and ip == 0:
+                    continue
+                pv = phv[phv['period'] == period]
+                dlat = np.radians(pv['lat'].values - la)
+                dlon = np.radians(pv['lon'].values - lo)
+                a = (np.sin(dlat / 2) ** 2 + np.cos(np.radians(la))
+                     * np.cos(np.radians(pv['lat'].values))
+                     * np.sin(dlon / 2) ** 2)
+                self.assertEqual(ph_vel[il, ip],
+                                 pv['ph_vel'].values[np.argmin(a)])
+
+    # test_load_cached_sw_constraints
+    def test_load_cached_sw_constraints(self):
+        """ Test the binary cache matches the text files, and is rebuilt.
+        """
+        data_dir = 'output/testcase/obs_dispersion/'
+        shutil.rmtree(data_dir, ignore_errors=True)
+        os.makedirs(data_dir)
+        lat, lon = np.meshgrid(np.arange(35., 38.), np.arange(-110., -107.))
+        with open(data_dir + 'R10_USANT15.txt', 'w') as fid:
+            fid.write('header\n' * 5 + 'PVELREF 3.2\n' + 'header\n' * 5)
+            for la, lo in zip(lat.flatten(), lon.flatten()):
+                fid.write('{} {} 0.5 {}\n'.format(la, lo, la - 36))
+        with open(data_dir + 'helmholtz_stack_LHZ_25.xyz', 'w') as fid:
+            for la, lo in zip(lat.flatten(), lon.flatten()):
+                fid.write('{} {} {}\n'.format(la, lo, 3.7 + la / 100))
+        with open(data_dir + 'c_60s_BD19', 'w') as fid:
+            for la, lo in zip(lat.flatten(), lon.flatten()):
+                fid.write('{} {} {}\n'.format(la, lo, 3900 + lo))
+
+        expected = constraints._load_observed_sw_constraints(data_dir)
+        for run in range(2):
+            phv = constraints._load_cached_sw_constraints(data_dir)
+            self.assertIsInstance(phv['ph_vel'], np.memmap)
+            for c in ['period', 'lat', 'lon', 'ph_vel']:
+                np.testing.assert_array_equal(phv[c], expected[c].values)
+
+        # Changing a data file should give a new version of the cache,
+        # without touching the old one (which may still be in use)
+        with open(data_dir + 'c_60s_BD19', 'a') as fid:
+            fid.write('39.0 -110.0 4000.\n')
+        new_phv = constraints._load_cached_sw_constraints(data_dir)
+        self.assertEqual(len(new_phv['ph_vel']), len(expected) + 1)
+        self.assertEqual(np.max(new_phv['ph_vel'][new_phv['period'] == 60]), 4.)
+        self.assertEqual(len(os.listdir(data_dir + '.cache')), 2)
+        np.testing.assert_array_equal(phv['ph_vel'], expected['ph_vel'].values)
+
+        # An unreadable cache falls back to the text files
+        version_dir = constraints._versioned_cache_dir(
+            data_dir + '.cache', constraints._sw_cache_key(data_dir)
+        )
+        expected = np.array(new_phv['ph_vel'])
+        os.remove(os.path.join(version_dir, 'ph_vel.npy'))
+        with open(os.path.join(version_dir, 'ph_vel.npy'), 'w') as fid:
+            fid.write('not an array')
+        phv = constraints._load_cached_sw_constraints(data_dir)
+        np.testing.assert_array_equal(phv['ph_vel'], expected)
+
+    # test_phase_velocity_std
+    @parameterized.expand([
+        ('short periods', np.array([5., 8., 9., 10.])),
+        ('all periods', np.array([5., 8., 10., 20., 32., 50., 80., 120., 150.])),
+    ])
+    def test_phase_velocity_std(self, name, periods):
+        """ Test the vectorised uncertainty against the original row by row.
+        """
+        expected = []
+        for period in periods:
+            std = max(0.025, abs(140 / (140 / 4 + period / 100) - 4) / 2)
+            if period <= 8:
+                std *= 2
+            expected += [std]
+
+        np.testing.assert_allclose(
+            constraints._phase_velocity_std(periods), expected
+        )
+
+    # test_extract_rf_constraints
+    @parameterized.expand([
+        ('single location', [(35.1, -110.2)], (('Moho', 'LAB'), [3., 10.]),
+            ([[3.5, 8.]], [[0.3, 0.76]], [[0.2, -0.045]], [[0.04, 0.004]])),
+        ('many locations', [(35.1, -110.2), (36.9, 250.9)],
+            (('Moho', 'LAB'), [3., 10.]),
+            ([[3.5, 8.], [4., 8.]], [[0.3, 0.76], [0.1, 1.6]],
+             [[0.2, -0.045], [0.1, -0.04]], [[0.04, 0.004], [0.01, 0.015]])),
+        ('no synthetics for this width', [(35.1, -110.2)],
+            (('Moho', 'LAB'), [3., 7.]), None),
+    ])
+    def test_extract_rf_constraints(self, name, locations, boundaries,
+                                    expected):
+        """ Test the batch RF lookup, std floors and amplitude conversion.
+        """
+        all_rfs = pd.DataFrame({
+            'lat': [35., 37., 35., 37.], 'lon': [-110., -110., -109., -109.],
+            'ttMoho': [3.5, 3.6, 3.7, 4.], 'ttMohostd': [0.3, 0.1, 0.1, 0.1],
+            'dvMoho': [0.2, 0.1, 0.1, 0.1],
+            'dvMohostd': [0.04, 0.01, 0.01, 0.01],
+            'typeMoho': ['Ps'] * 4,
+            'ttLAB': [4., 4., 4., 4.], 'ttLABstd': [0.2, 0.8, 0.8, 0.8],
+            'ampLAB': [0.045, 0.04, 0.04, 0.04],
+            'ampLABstd': [0.001, 0.01, 0.01, 0.015],
+            'typeLAB': ['Sp'] * 4,
+        })
+        synth = pd.DataFrame({
+            'breadth': [0, 0, 10, 10], 'dv': [0., -0.1, 0., -0.1],
+            'amplitude': [0., 0.1, 0., 0.1],
+        })
+        store = constraints.build_rf_constraint_store(all_rfs, {'Sp': synth})
+
+        rf_constraints = constraints.extract_rf_constraints(
+            locations, boundaries, 2., store,
+        )
+
+        if expected is None:
+            self.assertIsNone(rf_constraints)
+            return
+        for actual, exp in zip(rf_constraints, expected):
+            np.testing.assert_allclose(actual, exp)
+
+    # test_nearest_index
+    @parameterized.expand([
+        ('regular grid', np.arange(20., 50.01, 0.25)),
+        ('irregular grid', np.array([0., 0.5, 2., 2.1, 7., 9.5])),
+        ('single point', np.array([3.])),
+    ])
+    def test_nearest_index(self, name, axis):
+        """ Test the nearest index matches argmin, including at midpoints.
+        """
+        values = np.concatenate((
+            np.linspace(axis[0] - 2, axis[-1] + 2, 101), axis,
+            (axis[:-1] + axis[1:]) / 2,
+        ))
+
+        np.testing.assert_array_equal(
+            constraints._nearest_index(axis, values),
+            [np.argmin(np.abs(axis - v)) for v in values],
+        )
+
+    # test_get_vels_ShenRitzwoller2016_batch
+    def test_get_vels_ShenRitzwoller2016_batch(self):
+        """ Test the batch SR16 extraction, with a memory-mapped Vs cube.
+        """
+        mmap_dir = 'output/testcase/earth_models/'
+        shutil.rmtree(mmap_dir, ignore_errors=True)
+        depth = np.arange(0., 10., 0.5)
+        lats = np.arange(30., 40., 0.25)
+        lons = np.arange(245., 260., 0.25)
+        vsv = np.random.RandomState(42).normal(
+            4., 0.2, (depth.size, lats.size, lons.size)
+        )
+        ds = xr.Dataset(
+            {'vsv': (['depth', 'latitude', 'longitude'], vsv)},
+            coords={'depth': depth, 'latitude': lats, 'longitude': lons},
+        )
+        ds['vs'] = ds['vsv']
+        constraints._literature_models['SR16'] = ds
+        locations = [(35.1, -107.3), (31.9, 250.), (37.625, -110.125)]
+
+        try:
+            for run in range(2):
+                thickness, vs = constraints.get_vels_ShenRitzwoller2016_batch(
+                    locations, mmap_dir
+                )
+                self.assertIsInstance(
+                    constraints._literature_vs_grids[('SR16', mmap_dir)].vs,
+                    np.memmap,
+                )
+                np.testing.assert_array_equal(thickness, [0.] + [0.5] * 19)
+                for il, (lat, lon) in enumerate(locations):
+                    i_lat = np.argmin(np.abs(lats - lat))
+                    i_lon = np.argmin(np.abs(lons - lon % 360))
+                    np.testing.assert_array_equal(vs[il], vsv[:, i_lat, i_lon])
+        finally:
+            del constraints._literature_models['SR16']
+            constraints._literature_vs_grids.pop(('SR16', mmap_dir), None)
+
+    # test_load_absolute_vel_model
+    def test_load_absolute_vel_model(self):
+        """ Test converting dVs to Vs, and reloading it from the disk cache.
+        """
+        cache_dir = 'output/testcase/earth_models/'
+        source_file = 'output/testcase/dvs.nc'
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir, exist_ok=True)
+        depth = np.arange(0., 400., 10.)
+        lats = np.arange(30., 35., 0.5)
+        lons = np.arange(245., 250., 0.5)
+        dvs = np.random.RandomState(42).normal(
+            0., 3., (depth.size, lats.size, lons.size)
+        )
+        ds = xr.Dataset(
+            {'dvs': (['depth', 'latitude', 'longitude'], dvs)},
+            coords={'depth': depth, 'latitude': lats, 'longitude': lons},
+        )
+        ds.to_netcdf(source_file)
+        ref_v = np.array([[3.2, 0.], [3.9, 35.], [4.3, 60.], [4.7, 300.]])
+
+        imax = np.argmax(depth > ref_v[-1, 1])
+        ref_vz = np.interp(depth[:imax], ref_v[:, 1], ref_v[:, 0])
+        expected = np.zeros((imax, lats.size, lons.size))
+        for ila in range(lats.size):
+            for ilo in range(lons.size):
+                expected[:, ila, ilo] = (1 + dvs[:imax, ila, ilo] / 100) * ref_vz
+
+        for run in range(2):
+            vs_ds = constraints._load_absolute_vel_model(
+                ds, 'dvs', ref_v, source_file, cache_dir
+            )
+            np.testing.assert_allclose(vs_ds.vs.values, expected)
+            np.testing.assert_array_equal(vs_ds.depth.values, depth[:imax])
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            vs_ds.close()
+
+    # test_get_vels_Crust1
+    def test_get_vels_Crust1(self):
+        """ Test Crust1.0 profiles from the cache match reading the text files.
+        """
+        data_dir = 'output/testcase/crust1/'
+        shutil.rmtree(data_dir, ignore_errors=True)
+        os.makedirs(data_dir)
+        rs = np.random.RandomState(42)
+        thickness = rs.uniform(0, 10, (64800, 8))
+        thickness[rs.rand(64800, 8) < 0.3] = 0.
+        bnds = np.hstack((np.zeros((64800, 1)), -np.cumsum(thickness, axis=1)))
+        vs = rs.uniform(1., 4.7, (64800, 9))
+        np.savetxt(data_dir + 'crust1.bnds', bnds, fmt='%.2f')
+        np.savetxt(data_dir + 'crust1.vs', vs, fmt='%.2f')
+
+        locations = [(89.5, -179.5), (35.5, -107.5), (-89.5, 179.5),
+                     (35.5, 252.5), (10.5, 0.5)]
+        try:
+            for run in range(2):
+                constraints._crust1_store = constraints._load_cached_crust1(
+                    data_dir
+                )
+                self.assertIsInstance(constraints._crust1_store.vs, np.memmap)
+                for lat, lon in locations:
+                    lon = (lon + 180) % 360 - 180
+                    i = int((lon + 179.5) + (89.5 - lat) * 360)
+                    cb = np.round(bnds[i], 2)
+                    expected_t = [0] + list(-np.diff(cb)[-np.diff(cb) > 0])
+                    expected_vs = list(np.round(vs[i], 2)[:-1][-np.diff(cb) > 0])
+                    expected_vs += [np.round(vs[i, -1], 2)]
+
+                    m_t, m_vs = constraints.get_vels_Crust1((lat, lon))
+                    np.testing.assert_allclose(m_t, expected_t, atol=1e-9)
+                    np.testing.assert_allclose(m_vs, expected_vs)
+                    # Anywhere in the grid cell gives the same profile
+                    np.testing.assert_allclose(
+                        constraints.get_vels_Crust1((lat + 0.4, lon - 0.4))[1],
+                        expected_vs,
+                    )
+        finally:
+            constraints._crust1_store = None
+
+    # test_regrid_lit_model
+    @parameterized.expand([
+        ('nearest', 'nearest'),
+        ('trilinear', 'trilinear'),
+    ])
+    def test_regrid_lit_model(self, name, method):
+        """ Test regridding against looping over columns / scipy.
+        """
+        z_a = np.arange(0., 300., 5.)
+        lats_a = np.arange(50., 29.9, -0.5) # decreasing, as some models
+        lons_a = np.arange(235., 270., 0.5)
+        vs = np.random.RandomState(42).normal(
+            4., 0.2, (z_a.size, lats_a.size, lons_a.size)
+        )
+        ds = xr.Dataset(
+            {'vs': (['depth', 'latitude', 'longitude'], vs)},
+            coords={'depth': z_a, 'latitude': lats_a, 'longitude': lons_a},
+        )
+        z = np.arange(0., 320., 7.)
+        lats = np.arange(32., 45., 0.3)
+        lons = np.arange(-120., -100., 0.3)
+
+        if method == 'nearest':
+            expected = np.zeros((lats.size, lons.size, z.size))
+            for ila, lat in enumerate(lats):
+                for ilo, lon in enumerate(lons):
+                    i_lat = np.argmin(np.abs(lats_a - lat))
+                    i_lon = np.argmin(np.abs(lons_a - 360 - lon))
+                    expected[ila, ilo, :] = np.interp(
+                        z, z_a, vs[:, i_lat, i_lon]
+                    )
+        else:
+            interpolator = scipy.interpolate.RegularGridInterpolator(
+                (lats_a[::-1], lons_a - 360, z_a),
+                vs[:, ::-1, :].transpose(1, 2, 0),
+            )
+            grid = np.meshgrid(lats, lons, np.clip(z, 0, z_a[-1]),
+                               indexing='ij')
+            expected = interpolator(np.stack(grid, axis=-1))
+
+        np.testing.assert_allclose(
+            constraints.regrid_lit_model(ds, z, lats, lons, method), expected
+        )
+
 if __name__ == "__main__":
     unittest.main()
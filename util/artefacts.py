@@ -0,0 +1,173 @@
+""" Optional saving of intermediate files from the inversion.
+
+A few things are saved as CSV files on every call, even though nothing in
+the inversion reads them back - they are just a record for checking and
+plotting afterwards:
+    - the observed constraints, from constraints.extract_observations()
+    - the damping parameters, from weights.build_weighting_damping()
+    - the full MINEOS card, from define_models.convert_vsv_model_to_mineos_model()
+With hundreds of workers on a networked filesystem, all of these small
+writes add up, so these go through save_csv(), which depends on the mode:
+    'write':    write the file straight away (the default)
+    'bundle':   keep the file contents in memory until write_bundle() is
+                called, which saves them all in a single zip file
+    'none':     don't save them at all
+
+The mode can be set for the whole process with set_mode() (or with the
+environment variable INVERSION_ARTEFACTS), or just for one run with run()
+(see inversion.InversionParams.artefacts).
+
+Functions:
+    1. set_mode(mode:str):
+        - Set the mode for the whole process
+    2. get_mode() -> str:
+        - Return the mode currently in use
+    3. run(mode:str='', bundle_file:str=''):
+        - Context manager to set the mode for one run, then save any bundle
+    4. save_csv(df:pd.DataFrame, filename:str, **kwargs):
+        - Save a DataFrame as a CSV file, or keep it for later
+    5. write_bundle(bundle_file:str, prefix:str='') -> list:
+        - Save all of the artefacts kept so far in a zip file
+"""
+
+import contextlib
+import contextvars
+import os
+import zipfile
+
+import pandas as pd
+
+
+MODES = ('write', 'bundle', 'none')
+
+_mode = os.environ.get('INVERSION_ARTEFACTS', 'write')
+_run_mode = contextvars.ContextVar('artefact_mode', default='')
+_pending = {}
+
+
+# =============================================================================
+#       Choose what to do with the artefacts
+# =============================================================================
+
+def set_mode(mode:str):
+    """ Set the artefact mode for the whole process.
+
+    Arguments:
+        mode:
+            - str
+            - One of MODES, i.e. 'write', 'bundle' or 'none'
+    """
+
+    global _mode
+    _check_mode(mode)
+    _mode = mode
+
+def get_mode() -> str:
+    """ Return the artefact mode in use, i.e. that set by run(), if any.
+    """
+
+    return _run_mode.get() or _mode
+
+@contextlib.contextmanager
+def run(mode:str='', bundle_file:str=''):
+    """ Set the artefact mode for a block of code (e.g. one inversion).
+
+    If the mode is 'bundle', all artefacts saved below the directory of
+    bundle_file are written to bundle_file at the end of the block.
+
+    Usage:
+        with artefacts.run('bundle', 'output/[id]/[id]_artefacts.zip'):
+            ...
+
+    Arguments:
+        mode:
+            - str
+            - Default value = '', i.e. keep the mode already in use
+            - One of MODES
+        bundle_file:
+            - str
+            - Default value = '', i.e. keep any artefacts in memory
+            - Path to the zip file to save a bundle to.
+    """
+
+    if mode:
+        _check_mode(mode)
+    token = _run_mode.set(mode or get_mode())
+    try:
+        yield
+    finally:
+        if get_mode() == 'bundle' and bundle_file:
+            write_bundle(bundle_file, os.path.dirname(bundle_file))
+        _run_mode.reset(token)
+
+def _check_mode(mode:str):
+
+    if mode not in MODES:
+        raise ValueError(
+            'Unknown artefact mode {!r} - should be one of {}'.format(mode, MODES)
+        )
+
+
+# =============================================================================
+#       Save the artefacts
+# =============================================================================
+
+def save_csv(df:pd.DataFrame, filename:str, **kwargs):
+    """ Save a DataFrame as a CSV file, depending on the artefact mode.
+
+    Arguments:
+        df:
+            - pd.DataFrame
+        filename:
+            - str
+            - Path to save the CSV file to (or its name in the bundle).
+        **kwargs:
+            - Passed on to df.to_csv(), e.g. index=False
+    """
+
+    mode = get_mode()
+    if mode == 'write':
+        df.to_csv(filename, **kwargs)
+    elif mode == 'bundle':
+        _pending[os.path.normpath(filename)] = df.to_csv(**kwargs)
+
+def write_bundle(bundle_file:str, prefix:str='') -> list:
+    """ Save the artefacts kept in memory so far as a single zip file.
+
+    Saved artefacts are then dropped from memory.  Within the zip file, each
+    artefact is named by its path relative to the directory of bundle_file.
+
+    Arguments:
+        bundle_file:
+            - str
+            - Path to the zip file.  This is overwritten if it exists.
+        prefix:
+            - str
+            - Default value = '', i.e. everything
+            - Only save the artefacts with paths in this directory.
+
+    Returns:
+        filenames:
+            - list of str
+            - Paths of the artefacts that were saved.
+    """
+
+    prefix = os.path.normpath(prefix) + os.sep if prefix else ''
+    filenames = sorted(f for f in _pending if f.startswith(prefix))
+    if not filenames:
+        return []
+
+    bundle_dir = os.path.dirname(bundle_file)
+    if bundle_dir:
+        os.makedirs(bundle_dir, exist_ok=True)
+    tmp_file = '{}.tmp{}'.format(bundle_file, os.getpid())
+    with zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for filename in filenames:
+            zf.writestr(os.path.relpath(filename, bundle_dir or '.'),
+                        _pending[filename])
+    os.replace(tmp_file, bundle_file)
+
+    for filename in filenames:
+        del _pending[filename]
+
+    return filenames
@@ -2,20 +2,167 @@
 
 This includes observed phase velocities and constraints pulled from receiver
 function observations.
+
+The observed phase velocity maps are only read in once per process, and are
+kept in a SurfaceWaveStore, which has a KD-tree of pixel locations for each
+period so the nearest pixel to any number of locations can be found quickly.
+Parsing the text files is slow, so the first time they are read, they are
+also saved as binary .npy files in data/obs_dispersion/.cache/, which are
+memory-mapped by any later process (until any of the text files change).
+Similarly, the receiver function constraints are read in once per process
+and kept in an RFConstraintStore, and literature velocity models are only
+opened once per process (see load_literature_vel_model()).  Crust1.0 is
+converted to .npy files in data/earth_models/crust1/.cache/ in the same way
+as the phase velocity maps (see load_crust1_store()).
 """
 import re
 import os
+import json
+import hashlib
+import shutil
+import typing
+import logging
 
 import numpy as np
 import pandas as pd
+import scipy.spatial
 import xarray as xr # for loading netcdf
 
+from util import artefacts
+
+logger = logging.getLogger(__name__)
+
+_surface_wave_store = None
+_rf_constraint_store = None
+_literature_models = {}
+_literature_vs_grids = {}
+_crust1_store = None
+_SW_CACHE_COLUMNS = ('period', 'lat', 'lon', 'ph_vel')
 
 
 # =============================================================================
 # Set up classes for commonly used variables
 # =============================================================================
 
+class SurfaceWaveStore(typing.NamedTuple):
+    """ Observed phase velocity maps, indexed for fast lookups.
+
+    Fields:
+        periods:
+            - (n_periods, ) np.array
+            - Units:    seconds
+            - Periods of the phase velocity maps, in increasing order.
+        lats:
+            - list of (n_pixels, ) np.arrays (one per period)
+            - Units:    °N
+            - Latitude of each pixel in the phase velocity map.
+        lons:
+            - list of (n_pixels, ) np.arrays (one per period)
+            - Units:    °E
+            - Longitude of each pixel, in the range -180 to 180.
+        ph_vels:
+            - list of (n_pixels, ) np.arrays (one per period)
+            - Units:    km/s
+            - Observed phase velocity at each pixel.
+        trees:
+            - list of scipy.spatial.cKDTree (one per period)
+            - KD-tree of (lat, lon) for the pixels at each period.  As in
+              _find_closest_lat_lon(), distances are measured in degrees.
+        sphere_trees:
+            - list of scipy.spatial.cKDTree (one per period)
+            - KD-tree of the pixels as points on the unit sphere, so the
+              nearest pixel is the nearest along a great circle.
+        grids:
+            - list (one per period) of None or tuples, (grid_lats, grid_lons,
+              grid_ph_vels)
+            - If the pixels at this period are on a (rectilinear) lat, lon
+              grid, the grid coordinates as (n_lats, ) and (n_lons, )
+              np.arrays, and the phase velocities as an (n_lats, n_lons)
+              np.array, with NaN for any missing pixels.  Otherwise, None.
+    """
+
+    periods: np.array
+    lats: list
+    lons: list
+    ph_vels: list
+    trees: list
+    sphere_trees: list
+    grids: list
+
+class RFConstraintStore(typing.NamedTuple):
+    """ Receiver function constraints, indexed for nearest location lookups.
+
+    Fields:
+        table:
+            - pd.DataFrame
+            - All RF constraints, as data/RFconstraints/a_priori_constraints.csv
+        tree:
+            - scipy.spatial.cKDTree
+            - KD-tree of (lat, lon) for the rows of table, with longitudes in
+              the range -180 to 180.  Distances are measured in degrees.
+        std_floors:
+            - dict, {column name: float}
+            - Minimum allowed standard deviation for each of the std columns
+              in table (the 10% quantile of the whole data set), as some of
+              the reported values are unrealistically low.
+        synth_curves:
+            - dict, {(RF type, breadth): (amplitude, dv)}
+            - Synthetic RF amplitudes for a range of velocity contrasts, for
+              each boundary layer width (breadth; km), as (n, ) np.arrays,
+              used to convert observed amplitudes to dV.
+    """
+
+    table: pd.DataFrame
+    tree: scipy.spatial.cKDTree
+    std_floors: dict
+    synth_curves: dict
+
+class LiteratureVsGrid(typing.NamedTuple):
+    """ Vs from a literature model as plain arrays, for fast indexing.
+
+    Fields:
+        depth:
+            - (n_depths, ) np.array
+            - Units:    km
+        latitude:
+            - (n_lats, ) np.array
+            - Units:    °N
+        longitude:
+            - (n_lons, ) np.array
+            - Units:    °E, as stored in the model file (e.g. 0 - 360)
+        vs:
+            - (n_depths, n_lats, n_lons) np.array (or np.memmap)
+            - Units:    km/s
+    """
+
+    depth: np.array
+    latitude: np.array
+    longitude: np.array
+    vs: np.array
+
+class Crust1Store(typing.NamedTuple):
+    """ Crust1.0 layer boundaries and Vs on its 1° x 1° grid.
+
+    Both arrays are indexed by (latitude, longitude, layer), with latitude
+    from 89.5 to -89.5 °N, longitude from -179.5 to 179.5 °E, and the nine
+    layers as listed in get_vels_Crust1().  See crust1_index() to find the
+    grid cell for a given location.
+
+    Fields:
+        bnds:
+            - (180, 360, 9) np.array (np.memmap if the cache could be used)
+            - Units:    km
+            - Elevation of the top of each layer, i.e. negative below sea
+              level.
+        vs:
+            - (180, 360, 9) np.array (np.memmap if the cache could be used)
+            - Units:    km/s
+            - Vs in each layer.
+    """
+
+    bnds: np.array
+    vs: np.array
+
 
 # =============================================================================
 #       Extract the observations of interest for a given location
@@ -35,8 +182,9 @@ def extract_observations(location:tuple, id:str, boundaries:tuple, vpvs:float):
     if not os.path.exists('output/' + id):
         os.mkdir('output/' + id)
     savedir = 'output/{0}/{0}_'.format(id)
-    surface_waves.to_csv('{}_surface_wave_constraints.csv'.format(savedir, id))
-    rfs.to_csv('{}_RF_constraints.csv'.format(savedir, id))
+    artefacts.save_csv(surface_waves,
+                       '{}_surface_wave_constraints.csv'.format(savedir, id))
+    artefacts.save_csv(rfs, '{}_RF_constraints.csv'.format(savedir, id))
 
     d = np.vstack((surface_waves['ph_vel'][:, np.newaxis],
                    rfs['tt'][:, np.newaxis],
@@ -55,75 +203,173 @@ def _extract_rf_constraints(location:tuple, id:str, boundaries:pd.DataFrame,
     Note that some of the reported standard deviation on values are
     unrealistically low (i.e. zero), so we will assume the minimum standard
     deviation on a value is the 10% quantile of the total data set.
+
+    See extract_rf_constraints() for more than one location.
     """
-    bnames, bwidths = boundaries
 
-    # Load in receiver function constraints
-    all_rfs = pd.read_csv('data/RFconstraints/a_priori_constraints.csv')
-    ind = _find_closest_lat_lon(all_rfs.copy(), location)
-    obs = all_rfs.loc[ind]
+    rf_constraints = extract_rf_constraints([location], boundaries, vpvs)
+    if rf_constraints is None:
+        return
 
-    rfs = pd.DataFrame(
-        columns = ['lat', 'lon', 'tt', 'ttstd', 'dv', 'dvstd']
-    )
-    ib = 0
-    for bound in bnames:
-        # Extract travel time information
-        try:
-            tt = obs['tt' + bound]
-            ttstd = obs['tt' + bound + 'std']
+    lat, lon = location
+    tt, ttstd, dv, dvstd = [x[0] for x in rf_constraints]
+
+    return pd.DataFrame({
+        'lat': float(lat), 'lon': float(lon),
+        'tt': tt, 'ttstd': ttstd, 'dv': dv, 'dvstd': dvstd,
+    })
+
+def extract_rf_constraints(locations:np.array, boundaries:tuple, vpvs:float,
+                           store:RFConstraintStore=None) -> tuple:
+    """ Extract receiver function constraints for many locations at once.
+
+    Arguments:
+        locations:
+            - (n_locations, 2) np.array (or list of (lat, lon) tuples)
+            - Units:    °N, °E
+        boundaries:
+            - tuple, (boundary names, boundary widths), as
+              define_models.ModelParams.boundaries
+        vpvs:
+            - float
+            - Used to scale Sp travel times to S travel times.
+        store:
+            - RFConstraintStore
+            - Default value = None, i.e. load_rf_constraint_store()
+
+    Returns:
+        tt, ttstd, dv, dvstd:
+            - (n_locations, n_boundaries) np.arrays
+            - Units:    s, s, fractional velocity change, same
+            - Travel time to and velocity contrast across each boundary,
+              from the nearest RF observation, with the standard deviations
+              floored at store.std_floors.
+            - None if any of the constraints are missing.
+    """
+
+    if store is None:
+        store = load_rf_constraint_store()
+    bnames, bwidths = boundaries
 
-            min_allowed_ttstd = all_rfs['tt' + bound + 'std'].quantile(0.1)
-            ttstd = max((ttstd, min_allowed_ttstd))
-        except:
-            print('No RF constraints on travel time for ' + bound)
+    locations = np.array(locations, dtype=float).reshape(-1, 2)
+    locations[locations[:, 1] > 180, 1] -= 360
+    distance, ind = store.tree.query(locations)
+    for il in np.flatnonzero(distance > 1):
+        logger.warning('Closest RF observation to %s°N, %s°E is at %s°N, %s°E',
+                       *locations[il], *store.tree.data[ind[il]])
+    obs = store.table.iloc[ind]
+
+    shape = (locations.shape[0], len(bnames))
+    tt, ttstd, dv, dvstd = [np.zeros(shape) for i in range(4)]
+    for ib, bound in enumerate(bnames):
+        # Extract travel time information
+        if 'tt' + bound not in obs or 'tt' + bound + 'std' not in obs:
+            logger.warning('No RF constraints on travel time for %s', bound)
             return
+        tt[:, ib] = obs['tt' + bound].values
+        ttstd[:, ib] = np.maximum(obs['tt' + bound + 'std'].values,
+                                  store.std_floors['tt' + bound + 'std'])
 
         # If necessary, scale to Vs travel time
-        try:
-            rftype = obs['type' + bound]
-        except:
-            rftype = 'Ps'
-            print('RF type unspecified for ' + bound + ' - assuming Ps')
-        if rftype == 'Sp': # Scale travel time from travelling at Vp to at Vs
-            tt *= vpvs
-            # for constant a, variable A: sigma_aA = |a| * sigma_A
-            ttstd *= vpvs
+        if 'type' + bound in obs:
+            rftype = obs['type' + bound].values
+        else:
+            rftype = np.full(locations.shape[0], 'Ps')
+            logger.info('RF type unspecified for %s - assuming Ps', bound)
+        is_sp = rftype == 'Sp'
+        tt[is_sp, ib] *= vpvs
+        # for constant a, variable A: sigma_aA = |a| * sigma_A
+        ttstd[is_sp, ib] *= vpvs
 
         # Extract velocity contrast information
-        try:
-            dv = obs['dv' + bound]
-            dvstd = obs['dv' + bound + 'std']
+        if 'dv' + bound in obs and 'dv' + bound + 'std' in obs:
+            dv[:, ib] = obs['dv' + bound].values
+            dvstd[:, ib] = np.maximum(obs['dv' + bound + 'std'].values,
+                                      store.std_floors['dv' + bound + 'std'])
+        elif 'amp' + bound in obs and 'amp' + bound + 'std' in obs:
+            amp = obs['amp' + bound].values
+            ampstd = np.maximum(obs['amp' + bound + 'std'].values,
+                                store.std_floors['amp' + bound + 'std'])
+            for t in np.unique(rftype):
+                converted = _convert_amplitude_to_dv(
+                    amp[rftype == t], ampstd[rftype == t], t, bwidths[ib],
+                    store,
+                )
+                if converted is None:
+                    logger.warning('No RF constraints on dV for %s', bound)
+                    return
+                dv[rftype == t, ib], dvstd[rftype == t, ib] = converted
+        else:
+            logger.warning('No RF constraints on dV for %s', bound)
+            return
 
-            min_allowed_dvstd = all_rfs['dv' + bound + 'std'].quantile(0.1)
-            ampstd = max((dvstd, min_allowed_dvstd))
-        except:
-            try:
-                amp = obs['amp' + bound]
-                ampstd = obs['amp' + bound + 'std']
+    return tt, ttstd, dv, dvstd
 
-                min_allowed_amstd = all_rfs['amp' + bound + 'std'].quantile(0.1)
-                ampstd = max((ampstd, min_allowed_amstd))
+def load_rf_constraint_store() -> RFConstraintStore:
+    """ Return the RFConstraintStore of all RF constraints.
 
-                dv, dvstd = _convert_amplitude_to_dv(
-                    amp, ampstd, rftype, bwidths[ib]
+    The constraints are only read in and indexed the first time this is
+    called in each process.
+    """
+
+    global _rf_constraint_store
+    if _rf_constraint_store is None:
+        rf_dir = 'data/RFconstraints/'
+        synthvals = {}
+        for rftype in ('Ps', 'Sp'):
+            if os.path.exists(rf_dir + 'synthvals_' + rftype + '.csv'):
+                synthvals[rftype] = pd.read_csv(
+                    rf_dir + 'synthvals_' + rftype + '.csv'
                 )
-            except:
-                print('No RF constraints on dV for ' + bound)
-                return
-
-        lat, lon = location
-        rfs = rfs.append(
-            pd.Series([lat, lon, tt, ttstd, dv, dvstd], index=rfs.columns),
-            ignore_index=True,
+        _rf_constraint_store = build_rf_constraint_store(
+            pd.read_csv(rf_dir + 'a_priori_constraints.csv'), synthvals
         )
 
-        ib += 1
+    return _rf_constraint_store
+
+def build_rf_constraint_store(all_rfs:pd.DataFrame, synthvals:dict
+                              ) -> RFConstraintStore:
+    """ Index the RF constraints and precompute everything location-independent.
+
+    Arguments:
+        all_rfs:
+            - pd.DataFrame
+            - As data/RFconstraints/a_priori_constraints.csv, i.e. columns
+              lat, lon, and for each boundary, [tt|dv|amp][boundary][|std]
+              and type[boundary]
+        synthvals:
+            - dict of pd.DataFrames, {RF type: synthetic amplitudes}
+            - As data/RFconstraints/synthvals_[RF type].csv, i.e. columns
+              breadth, dv, amplitude
+
+    Returns:
+        RFConstraintStore
+    """
+
+    lon = all_rfs['lon'].values.astype(float)
+    # Make sure all longitudes are in range -180 to 180
+    lon[lon > 180] -= 360
+    tree = scipy.spatial.cKDTree(
+        np.column_stack((all_rfs['lat'].values.astype(float), lon))
+    )
+
+    std_floors = {
+        c: all_rfs[c].quantile(0.1) for c in all_rfs.columns
+        if c.endswith('std')
+    }
 
+    synth_curves = {}
+    for rftype, synth in synthvals.items():
+        for breadth, curve in synth.groupby('breadth'):
+            synth_curves[(rftype, breadth)] = (
+                curve.amplitude.values, curve.dv.values
+            )
 
-    return rfs
+    return RFConstraintStore(all_rfs.reset_index(drop=True), tree,
+                             std_floors, synth_curves)
 
-def _convert_amplitude_to_dv(amp, ampstd, rftype, boundary_width):
+def _convert_amplitude_to_dv(amp, ampstd, rftype, boundary_width,
+                             store:RFConstraintStore=None):
     """
 
     Calculated the Sp synthetics in MATLAB for a variety of dV (where
@@ -142,50 +388,98 @@ def _convert_amplitude_to_dv(amp, ampstd, rftype, boundary_width):
     synthvals.to_csv('data/RFconstraints/synthvals_Sp.csv', index=False)
     """
 
-    try:
-        synth = pd.read_csv('data/RFconstraints/synthvals_' + rftype +'.csv')
-    except:
-        print('No synthetic amplitudes calculated for ' + rftype + '!')
+    if store is None:
+        store = load_rf_constraint_store()
+
+    if (rftype, boundary_width) not in store.synth_curves:
+        logger.warning('No synthetic amplitudes calculated for %s '
+                       '(breadth %s)!', rftype, boundary_width)
         return
 
-    synth = synth[synth.breadth == boundary_width]
+    amplitude, synth_dv = store.synth_curves[(rftype, boundary_width)]
     # Note that numpy default for interpolation is x < x[0] returns y[0]
-    dv = np.round(np.interp(amp, synth.amplitude, synth.dv), 3)
-    dvstd = abs(np.round(np.interp(ampstd, synth.amplitude, synth.dv), 3))
+    dv = np.round(np.interp(amp, amplitude, synth_dv), 3)
+    dvstd = abs(np.round(np.interp(ampstd, amplitude, synth_dv), 3))
 
     return dv, dvstd
 
 def _extract_phase_vels(location:tuple, phv_preloaded:tuple=(0,)):
 
     if phv_preloaded[0]:
-        phv = phv_preloaded[1]
+        store = build_surface_wave_store(phv_preloaded[1])
     else:
-        print('Loading phase velocities')
-        phv = _load_observed_sw_constraints()
+        store = load_surface_wave_store()
+
+    ph_vel, lat, lon = query_surface_wave_store(store, [location])
+
+    return pd.DataFrame({
+        'period': store.periods, 'lat': lat[0], 'lon': lon[0],
+        'ph_vel': ph_vel[0], 'std': _phase_velocity_std(store.periods),
+    })
+
+def extract_phase_vels(locations:np.array, store:SurfaceWaveStore=None,
+                       interpolation:str='nearest',
+                       ) -> (np.array, np.array, np.array):
+    """ Extract observed phase velocities for many locations at once.
+
+    Arguments:
+        locations:
+            - (n_locations, 2) np.array (or list of (lat, lon) tuples)
+            - Units:    °N, °E
+        store:
+            - SurfaceWaveStore
+            - Default value = None, i.e. load_surface_wave_store()
+        interpolation:
+            - str
+            - 'nearest' or 'bilinear'; see query_surface_wave_store()
+
+    Returns:
+        periods:
+            - (n_periods, ) np.array
+            - Units:    seconds
+        ph_vel:
+            - (n_locations, n_periods) np.array
+            - Units:    km/s
+            - Observed phase velocity at each location
+        std:
+            - (n_periods, ) np.array
+            - Units:    km/s
+            - Assumed uncertainty, as _phase_velocity_std()
+    """
 
-    surface_waves = pd.DataFrame()
-    for period in phv['period'].unique():
-        ind = _find_closest_lat_lon(
-            phv[phv['period'] == period].copy(), location
-        )
-        surface_waves = surface_waves.append(phv.loc[ind])
-    surface_waves = (surface_waves.sort_values(by=['period'], ascending=True)
-        .reset_index(drop=True))
-    # Should actually load in some std!!!!  Going to do a random estimate
-    for index, row in surface_waves.iterrows():
-        # Conservative estimate: below 50s, assume +- 0.025
-        # Else, assume that you will be able to see a 1% difference in phase
-        # over the 140 km (2 station spacings) distance travelled at about 4 km/s
-        surface_waves.loc[index, 'std'] = (
-            max(0.025, abs(140 / (140 / 4 + row.period / 100) - 4) / 2)
-        )
-        if row.period <=8:
-            surface_waves.loc[index, 'std'] *= 2
-        #     phv[phv.period == row.period].ph_vel.std() / 2
+    if store is None:
+        store = load_surface_wave_store()
+    ph_vel, _, _ = query_surface_wave_store(store, locations, interpolation)
+
+    return store.periods, ph_vel, _phase_velocity_std(store.periods)
+
+def _phase_velocity_std(periods:np.array) -> np.array:
+    """ Assumed uncertainty in observed phase velocity at each period.
+
+    Should actually load in some std!!!!  Going to do a random estimate.
+    Conservative estimate: below 50s, assume +- 0.025
+    Else, assume that you will be able to see a 1% difference in phase
+    over the 140 km (2 station spacings) distance travelled at about 4 km/s.
+    This is doubled for periods of 8 s and below.
 
-    return surface_waves.reset_index(drop=True)
+    Arguments:
+        periods:
+            - (n_periods, ) np.array
+            - Units:    seconds
 
-def _load_observed_sw_constraints():
+    Returns:
+        std:
+            - (n_periods, ) np.array
+            - Units:    km/s
+    """
+
+    periods = np.asarray(periods, dtype=float)
+    std = np.maximum(0.025, np.abs(140 / (140 / 4 + periods / 100) - 4) / 2)
+    std[periods <= 8] *= 2
+
+    return std
+
+def _load_observed_sw_constraints(data_dir:str='data/obs_dispersion/'):
     """ Load surface wave constraints into pandas.
 
     Very specific to the way the data is currently stored!  See READMEs in the
@@ -193,24 +487,179 @@ def _load_observed_sw_constraints():
     """
 
     # Load in surface waves
-    data_dir = 'data/obs_dispersion/'
-    phvel = pd.DataFrame()
+    phvel = []
+    periods = set()
     # Have ASWMS data with filenames 'helmholtz_stack_LHZ_[period].xyz',
     # longer period surface wave data with filenames 'c_[period]s_BD19',
     # and ambient noise data with filenames 'R[period]_USANT15.txt'
     for file in sorted(os.listdir(data_dir), reverse=True, key=str.lower):
         if 'USANT15' in file: # Ambient noise
-            phvel = phvel.append(_load_ambient_noise(data_dir, file))
-        if 'helmholtz' in file: # ASWMS data
-            phvel = phvel.append(_load_earthquake_sw(data_dir, file))
-        if 'BD19' in file: # Longer T surface waves: Babikoff & Dalton, 2019
+            c = _load_ambient_noise(data_dir, file)
+        elif 'helmholtz' in file: # ASWMS data
+            c = _load_earthquake_sw(data_dir, file)
+        elif 'BD19' in file: # Longer T surface waves: Babikoff & Dalton, 2019
             c = _load_earthquake_sw_BD19(data_dir, file)
-            if c.period[0] not in phvel.period.unique():
-                phvel = phvel.append(c)
-    phvel = phvel.sort_values(by=['period', 'lat', 'lon']).reset_index(drop=True)
+            if c.period[0] in periods:
+                continue
+        else:
+            continue
+        phvel += [c]
+        periods.add(c.period[0])
+    phvel = (pd.concat(phvel).sort_values(by=['period', 'lat', 'lon'])
+             .reset_index(drop=True))
 
     return phvel
 
+def _load_cached_sw_constraints(data_dir:str='data/obs_dispersion/',
+                                cache_dir:str='') -> dict:
+    """ Load surface wave constraints from the binary cache.
+
+    Each column of the output of _load_observed_sw_constraints() is saved as
+    an uncompressed .npy file, so it can be memory-mapped rather than read
+    into memory by every process.  The cache is labelled with the name, size
+    and modification time of every file in data_dir (see _sw_cache_key()),
+    and is rebuilt from the text files if any of these have changed.
+
+    Each version of the cache is kept in its own subdirectory of cache_dir,
+    named by a hash of this label, and is never changed or deleted once it
+    is there (see _write_versioned_cache()), so it is safe for many
+    processes to build and read the cache at the same time.
+
+    Arguments:
+        data_dir:
+            - str
+            - Default value = 'data/obs_dispersion/'
+            - Directory of text files of phase velocity maps.
+        cache_dir:
+            - str
+            - Default value = '', i.e. [data_dir]/.cache
+            - Directory to keep the binary cache in.
+
+    Returns:
+        phv:
+            - dict of (n_pixels * n_periods, ) np.arrays (np.memmap if
+              the cache could be used)
+            - Keys: period, lat, lon, ph_vel
+            - As the columns of _load_observed_sw_constraints(), i.e.
+              sorted by period, then lat, then lon.
+    """
+
+    cache_dir = cache_dir or os.path.join(data_dir, '.cache')
+    key = _sw_cache_key(data_dir)
+    version_dir = _versioned_cache_dir(cache_dir, key)
+
+    phv = _load_versioned_cache(version_dir, _SW_CACHE_COLUMNS)
+    if phv is None:
+        logger.info('Rebuilding phase velocity cache in %s', version_dir)
+        phv = {
+            c: v.values.astype(float) for c, v in
+            _load_observed_sw_constraints(data_dir)[
+                list(_SW_CACHE_COLUMNS)].items()
+        }
+        if _write_versioned_cache(phv, key, version_dir):
+            phv = _load_versioned_cache(version_dir, _SW_CACHE_COLUMNS) or phv
+
+    return phv
+
+def _sw_cache_key(data_dir:str) -> dict:
+    """ Label the phase velocity cache with the state of the data files.
+
+    Returns:
+        key:
+            - dict, {filename: [size in bytes, modification time]}
+            - For every (non-hidden) file in data_dir.
+    """
+
+    key = {}
+    for file in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, file)
+        if file.startswith('.') or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        key[file] = [stat.st_size, stat.st_mtime]
+
+    return key
+
+def _versioned_cache_dir(cache_dir:str, key:dict) -> str:
+    """ Return the directory for the version of a cache labelled by key.
+
+    Arguments:
+        cache_dir:
+            - str
+        key:
+            - dict, JSON serialisable
+            - Label for the state of the files that the cache is built from.
+
+    Returns:
+        version_dir:
+            - str, [cache_dir]/[hash of key]
+    """
+
+    return os.path.join(cache_dir, hashlib.sha1(
+        json.dumps(key, sort_keys=True).encode()
+    ).hexdigest()[:16])
+
+def _load_versioned_cache(version_dir:str, names:tuple) -> dict:
+    """ Memory-map the arrays in a version of a cache.
+
+    Returns:
+        arrays:
+            - dict of np.memmap, {name: array}
+            - None if this version of the cache doesn't exist (yet) or
+              couldn't be read.
+    """
+
+    if not os.path.exists(os.path.join(version_dir, 'key.json')):
+        return
+    try:
+        return {
+            name: np.load(os.path.join(version_dir, name + '.npy'),
+                          mmap_mode='r')
+            for name in names
+        }
+    except (OSError, ValueError):
+        logger.warning('Could not read the cache in %s', version_dir)
+        return
+
+def _write_versioned_cache(arrays:dict, key:dict, version_dir:str) -> bool:
+    """ Save a version of a cache, as .npy files and the key.
+
+    Everything is written to a temporary directory first, which is then
+    renamed to version_dir.  If another process got there first, its copy is
+    kept.  Either way, a version directory is never deleted or changed once
+    it is in place, so other processes never see a partly written cache, or
+    lose one they are reading.  Old versions are left for tidying up by hand.
+
+    Arguments:
+        arrays:
+            - dict of np.arrays, {name: array}
+        key:
+            - dict, saved as key.json
+        version_dir:
+            - str, as from _versioned_cache_dir()
+
+    Returns:
+        success:
+            - bool
+            - False if the cache could not be written, e.g. the data
+              directory is read only.
+    """
+
+    tmp_dir = '{}.tmp{}'.format(version_dir.rstrip(os.sep), os.getpid())
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), array)
+        with open(os.path.join(tmp_dir, 'key.json'), 'w') as fid:
+            json.dump(key, fid)
+        os.rename(tmp_dir, version_dir)
+    except OSError:
+        # e.g. another process moved its own copy into place first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return os.path.exists(os.path.join(version_dir, 'key.json'))
+
+    return True
+
 
 def _load_ambient_noise(data_dir:str, file:str):
     """
@@ -272,6 +721,211 @@ def _load_earthquake_sw_BD19(data_dir:str, file:str):
 
     return surface_waves[['period', 'lat', 'lon', 'ph_vel']]
 
+def load_surface_wave_store() -> SurfaceWaveStore:
+    """ Return the SurfaceWaveStore of all observed phase velocities.
+
+    The observations are only read in and indexed the first time this is
+    called in each process.
+    """
+
+    global _surface_wave_store
+    if _surface_wave_store is None:
+        logger.info('Loading phase velocities')
+        _surface_wave_store = build_surface_wave_store(
+            _load_cached_sw_constraints()
+        )
+
+    return _surface_wave_store
+
+def build_surface_wave_store(phv:pd.DataFrame) -> SurfaceWaveStore:
+    """ Index observed phase velocities by period and location.
+
+    Arguments:
+        phv:
+            - pd.DataFrame or dict of np.arrays
+            - Columns: period, lat, lon, ph_vel, as from
+              _load_observed_sw_constraints() or
+              _load_cached_sw_constraints()
+
+    Returns:
+        SurfaceWaveStore
+            - If the input is sorted by period (and not a DataFrame), the
+              lats and ph_vels are views into the input arrays, so stay
+              memory-mapped.
+    """
+
+    order = slice(None)
+    if np.any(np.diff(np.asarray(phv['period'])) < 0):
+        order = np.argsort(np.asarray(phv['period']), kind='stable')
+    period, all_lats, all_lons, all_ph_vels = [
+        np.asarray(phv[c])[order] for c in _SW_CACHE_COLUMNS
+    ]
+    periods = np.unique(period)
+    edges = np.searchsorted(period, periods, side='right')
+
+    lats, lons, ph_vels, trees, sphere_trees, grids = [], [], [], [], [], []
+    for start, end in zip(np.append(0, edges[:-1]), edges):
+        lat = all_lats[start:end]
+        # Make sure all longitudes are in range -180 to 180
+        lon = all_lons[start:end].astype(float)
+        lon[lon > 180] -= 360
+        lats += [lat]
+        lons += [lon]
+        ph_vels += [all_ph_vels[start:end]]
+        trees += [scipy.spatial.cKDTree(np.column_stack((lat, lon)))]
+        sphere_trees += [scipy.spatial.cKDTree(_lat_lon_to_unit_vector(lat, lon))]
+        grids += [_grid_map(lat, lon, ph_vels[-1])]
+
+    return SurfaceWaveStore(periods, lats, lons, ph_vels, trees,
+                            sphere_trees, grids)
+
+def _grid_map(lat:np.array, lon:np.array, values:np.array):
+    """ Put a map onto a regular grid, if it is (nearly) on one already.
+
+    Arguments:
+        lat, lon, values:
+            - (n_pixels, ) np.arrays
+            - Location and value of each pixel
+
+    Returns:
+        None if the pixels aren't on a grid; otherwise
+        grid_lats, grid_lons:
+            - (n_lats, ) and (n_lons, ) np.arrays
+            - Units:    °N, °E
+            - Sorted unique values of lat and lon.
+        grid_values:
+            - (n_lats, n_lons) np.array
+            - Values at each grid point; NaN if there is no pixel there.
+    """
+
+    grid_lats, i_lat = np.unique(lat, return_inverse=True)
+    grid_lons, i_lon = np.unique(lon, return_inverse=True)
+    n_grid = grid_lats.size * grid_lons.size
+    if (grid_lats.size < 2 or grid_lons.size < 2 or 2 * lat.size < n_grid
+            or np.unique(i_lat * grid_lons.size + i_lon).size < lat.size):
+        return None
+
+    grid_values = np.full((grid_lats.size, grid_lons.size), np.nan)
+    grid_values[i_lat, i_lon] = values
+
+    return grid_lats, grid_lons, grid_values
+
+def _lat_lon_to_unit_vector(lat:np.array, lon:np.array) -> np.array:
+    """ Convert lat, lon (°N, °E) to (n, 3) points on the unit sphere.
+
+    Straight line (chord) distance between these points increases
+    monotonically with great circle (haversine) distance, so a KD-tree of
+    these points gives the nearest neighbour along a great circle.
+    """
+
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+
+    return np.column_stack((np.cos(lat) * np.cos(lon),
+                            np.cos(lat) * np.sin(lon),
+                            np.sin(lat)))
+
+def _bilinear_interpolate(grid:tuple, lat:np.array, lon:np.array) -> np.array:
+    """ Bilinearly interpolate a gridded map to many locations at once.
+
+    Arguments:
+        grid:
+            - tuple, (grid_lats, grid_lons, grid_values), as from _grid_map()
+        lat, lon:
+            - (n_locations, ) np.arrays
+            - Units:    °N, °E (with longitude in the same range as grid_lons)
+
+    Returns:
+        values:
+            - (n_locations, ) np.array
+            - NaN for any location outside of the grid, or next to a grid
+              point that has no value.
+    """
+
+    grid_lats, grid_lons, grid_values = grid
+    i = np.clip(np.searchsorted(grid_lats, lat) - 1, 0, grid_lats.size - 2)
+    j = np.clip(np.searchsorted(grid_lons, lon) - 1, 0, grid_lons.size - 2)
+    w_lat = (lat - grid_lats[i]) / (grid_lats[i + 1] - grid_lats[i])
+    w_lon = (lon - grid_lons[j]) / (grid_lons[j + 1] - grid_lons[j])
+
+    values = ((1 - w_lat) * (1 - w_lon) * grid_values[i, j]
+              + (1 - w_lat) * w_lon * grid_values[i, j + 1]
+              + w_lat * (1 - w_lon) * grid_values[i + 1, j]
+              + w_lat * w_lon * grid_values[i + 1, j + 1])
+    outside = ((w_lat < 0) | (1 < w_lat) | (w_lon < 0) | (1 < w_lon))
+    values[outside] = np.nan
+
+    return values
+
+def query_surface_wave_store(store:SurfaceWaveStore, locations:np.array,
+                             interpolation:str='nearest',
+                             ) -> (np.array, np.array, np.array):
+    """ Find the observed phase velocities at many locations at once.
+
+    Arguments:
+        store:
+            - SurfaceWaveStore
+        locations:
+            - (n_locations, 2) np.array (or list of (lat, lon) tuples)
+            - Units:    °N, °E
+        interpolation:
+            - str
+            - 'nearest' or 'bilinear'
+            - Default value = 'nearest'
+            - 'nearest' takes the value at the nearest pixel, measuring
+              distance in degrees as _find_closest_lat_lon().
+            - 'bilinear' interpolates the maps that are on a regular grid,
+              so the constraints vary smoothly between pixels.  For maps
+              that aren't gridded, or locations that aren't surrounded by
+              pixels with values, it takes the value at the nearest pixel
+              along a great circle.
+
+    Returns:
+        ph_vel:
+            - (n_locations, n_periods) np.array
+            - Units:    km/s
+            - Phase velocity at each location, for each of store.periods
+        lat, lon:
+            - (n_locations, n_periods) np.arrays
+            - Units:    °N, °E
+            - Location of the pixel used (or the input location, if the value
+              was interpolated)
+    """
+
+    locations = np.array(locations, dtype=float).reshape(-1, 2)
+    locations[locations[:, 1] > 180, 1] -= 360
+
+    shape = (locations.shape[0], len(store.periods))
+    ph_vel = np.zeros(shape)
+    lat = np.zeros(shape)
+    lon = np.zeros(shape)
+    for ip in range(len(store.periods)):
+        nearest = np.ones(locations.shape[0], dtype=bool)
+        if interpolation == 'bilinear':
+            if store.grids[ip] is not None:
+                ph_vel[:, ip] = _bilinear_interpolate(
+                    store.grids[ip], locations[:, 0], locations[:, 1]
+                )
+                lat[:, ip], lon[:, ip] = locations.T
+                nearest = np.isnan(ph_vel[:, ip])
+            _, ind = store.sphere_trees[ip].query(_lat_lon_to_unit_vector(
+                locations[nearest, 0], locations[nearest, 1]
+            ))
+        else:
+            _, ind = store.trees[ip].query(locations)
+        ph_vel[nearest, ip] = store.ph_vels[ip][ind]
+        lat[nearest, ip] = store.lats[ip][ind]
+        lon[nearest, ip] = store.lons[ip][ind]
+
+        distance_squared = ((lat[:, ip] - locations[:, 0]) ** 2
+                            + (lon[:, ip] - locations[:, 1]) ** 2)
+        for il in np.flatnonzero(distance_squared > 1):
+            logger.warning('Closest observation to %s°N, %s°E at %s s is at '
+                           '%s°N, %s°E', *locations[il], store.periods[ip],
+                           lat[il, ip], lon[il, ip])
+
+    return ph_vel, lat, lon
+
 def _find_closest_lat_lon(df:pd.DataFrame, location: tuple):
     """ Find index in dataframe of closest point to lat, lon.
 
@@ -289,8 +943,8 @@ def _find_closest_lat_lon(df:pd.DataFrame, location: tuple):
     min_ind = df['distance_squared'].idxmin()
 
     if df.loc[min_ind, 'distance_squared'] > 1:
-        print('!!!!!! Closest observation at {}°N, {}°E !!!!!!'.format(
-            df.loc[min_ind, 'lat'], df.loc[min_ind, 'lon']))
+        logger.warning('Closest observation at %s°N, %s°E',
+                       df.loc[min_ind, 'lat'], df.loc[min_ind, 'lon'])
 
     return min_ind
 
@@ -320,45 +974,148 @@ def get_vels_Crust1(location):
     then in latitude (from 89.5 to -89.5).
         i.e. index of (lat, lon) will be at (lon + 179.5) + (89.5 - lat) * 360
 
+    These are converted once into (180, 360, 9) arrays (see
+    load_crust1_store()), so each profile is just an index lookup.
 
     """
-    lat, lon = location
-
-    all_lons = np.arange(-179.5,180,1)
-    all_lats = np.arange(89.5,-90,-1)
-    i = int((lon - all_lons[0]) + ((all_lats[0] - lat) // 1) * len(all_lons))
 
-    nm = 'data/earth_models/crust1/crust1.'
-    try:
-        cb = pd.read_csv(nm + 'bnds', skiprows=i, nrows=1, header=None, sep='\s+'
-            ).values.flatten()
-        vs = pd.read_csv(nm + 'vs', skiprows=i, nrows=1, header=None, sep='\s+'
-            ).values.flatten()
-    except:
-        crust1url = 'http://igppweb.ucsd.edu/~gabi/crust1/crust1.0.tar.gz'
-        print(
-            'You need to download (and extract) the Crust1.0 model'
-            + ' from \n\t{} \nand save to \n\t{}'.format(crust1url, nm[:-7])
-        )
+    profiles = get_vels_Crust1_batch([location])
+    if profiles is None:
         return
-    # vp = pd.read_csv(nm + 'vp', skiprows=i, nrows=1, header=None, sep='\s+'
-    #     ).values.flatten()
-    # rho = pd.read_csv(nm + 'rho', skiprows=i, nrows=1, header=None, sep='\s+'
-    #     ).values.flatten()
-
-    thickness = -np.diff(cb)
-    ib = 0
-    m_t = [0]
-    m_vs = []
-    for t in thickness:
-        if t > 0:
-            m_vs += [vs[ib]]
-            m_t += [t]
-        ib += 1
-    m_vs += [vs[ib]]#[m_vs[-1]]
+
+    thickness, vs = profiles
+    has_layer = thickness[0] > 0
+    m_t = [0] + list(thickness[0][has_layer])
+    m_vs = list(vs[0][:-1][has_layer]) + [vs[0][-1]]
 
     return m_t, m_vs
 
+def get_vels_Crust1_batch(locations:np.array) -> (np.array, np.array):
+    """ Pull out Crust1.0 profiles for many locations at once.
+
+    Unlike get_vels_Crust1(), layers that are missing at a location (e.g. no
+    ice or sediments) are not dropped, but have zero thickness, so that the
+    output for all locations can be stacked together.
+
+    Arguments:
+        locations:
+            - (n_locations, 2) np.array (or list of (lat, lon) tuples)
+            - Units:    °N, °E
+
+    Returns:
+        thickness:
+            - (n_locations, 8) np.array
+            - Units:    km
+            - Thickness of each layer above the mantle (see get_vels_Crust1()).
+        vs:
+            - (n_locations, 9) np.array
+            - Units:    km/s
+            - Vs in each layer, including the mantle.
+    """
+
+    store = load_crust1_store()
+    if store is None:
+        return
+
+    locations = np.array(locations, dtype=float).reshape(-1, 2)
+    i_lat, i_lon = crust1_index(locations[:, 0], locations[:, 1])
+    bnds = np.asarray(store.bnds[i_lat, i_lon, :])
+
+    return -np.diff(bnds, axis=1), np.asarray(store.vs[i_lat, i_lon, :])
+
+def crust1_index(lats:np.array, lons:np.array) -> (np.array, np.array):
+    """ Find the Crust1.0 grid cell that each location falls in.
+
+    Arguments:
+        lats:
+            - (n_locations, ) np.array
+            - Units:    °N
+        lons:
+            - (n_locations, ) np.array
+            - Units:    °E (or °W as negative)
+
+    Returns:
+        i_lat, i_lon:
+            - (n_locations, ) np.arrays of ints
+            - Indices into the first two axes of the Crust1Store arrays.
+    """
+
+    lats = np.asarray(lats, dtype=float)
+    lons = (np.asarray(lons, dtype=float) + 180) % 360 - 180
+
+    i_lat = np.clip(np.floor(90 - lats), 0, 179).astype(int)
+    i_lon = np.clip(np.floor(lons + 180), 0, 359).astype(int)
+
+    return i_lat, i_lon
+
+def load_crust1_store() -> Crust1Store:
+    """ Return the Crust1Store, loading it the first time in each process.
+
+    Returns:
+        Crust1Store (or None if the model hasn't been downloaded)
+    """
+
+    global _crust1_store
+    if _crust1_store is None:
+        nm = 'data/earth_models/crust1/'
+        try:
+            _crust1_store = _load_cached_crust1(nm)
+        except OSError:
+            crust1url = 'http://igppweb.ucsd.edu/~gabi/crust1/crust1.0.tar.gz'
+            logger.error(
+                'You need to download (and extract) the Crust1.0 model'
+                + ' from \n\t{} \nand save to \n\t{}'.format(crust1url, nm)
+            )
+
+    return _crust1_store
+
+def _load_cached_crust1(data_dir:str='data/earth_models/crust1/',
+                        cache_dir:str='') -> Crust1Store:
+    """ Load Crust1.0 from the binary cache.
+
+    The first time this is run (or if the text files have changed since),
+    crust1.bnds and crust1.vs are read in and saved as (180, 360, 9) .npy
+    files in cache_dir, which are then memory-mapped.  As for the phase
+    velocity cache (see _load_cached_sw_constraints()), the cache is labelled
+    with the size and modification time of the text files, and each version
+    is kept in its own subdirectory so it is safe to share between processes.
+
+    Arguments:
+        data_dir:
+            - str
+            - Default value = 'data/earth_models/crust1/'
+            - Directory with the Crust1.0 text files, crust1.[bnds|vs].
+        cache_dir:
+            - str
+            - Default value = '', i.e. [data_dir]/.cache
+
+    Returns:
+        Crust1Store
+
+    Raises:
+        OSError if the Crust1.0 text files don't exist.
+    """
+
+    cache_dir = cache_dir or os.path.join(data_dir, '.cache')
+    key = {}
+    for field in Crust1Store._fields:
+        stat = os.stat(os.path.join(data_dir, 'crust1.' + field))
+        key[field] = [stat.st_size, stat.st_mtime]
+    version_dir = _versioned_cache_dir(cache_dir, key)
+
+    arrays = _load_versioned_cache(version_dir, Crust1Store._fields)
+    if arrays is None:
+        logger.info('Rebuilding Crust1.0 cache in %s', version_dir)
+        arrays = {
+            field: np.loadtxt(os.path.join(data_dir, 'crust1.' + field)
+                              ).reshape(180, 360, 9)
+            for field in Crust1Store._fields
+        }
+        if _write_versioned_cache(arrays, key, version_dir):
+            arrays = (_load_versioned_cache(version_dir, Crust1Store._fields)
+                      or arrays)
+
+    return Crust1Store(**arrays)
 
 def get_vels_ShenRitzwoller2016(location):
     """
@@ -380,23 +1137,186 @@ def get_vels_ShenRitzwoller2016(location):
         'rho'           (depth, latitude, longitude)
 
     """
-    lat, lon = location
-    if lon < 0: # Convert to °E if in °W
-        lon += 360
+    profiles = get_vels_ShenRitzwoller2016_batch([location])
+    if profiles is None:
+        return
+
+    thickness, vsv = profiles
+
+    return list(thickness), list(vsv[0])
+
+def get_vels_ShenRitzwoller2016_batch(locations:np.array, mmap_dir:str=''
+                                      ) -> (np.array, np.array):
+    """ Pull out Shen & Ritzwoller (2016) profiles for many locations at once.
+
+    As get_vels_ShenRitzwoller2016(), taking the nearest grid point to each
+    location.
+
+    Arguments:
+        locations:
+            - (n_locations, 2) np.array (or list of (lat, lon) tuples)
+            - Units:    °N, °E
+        mmap_dir:
+            - str
+            - Default value = '', i.e. keep the Vs cube in memory
+            - See load_literature_vs_grid(), e.g. 'data/earth_models/.cache/'
+              to share a memory-mapped Vs cube between processes.
+
+    Returns:
+        thickness:
+            - (n_depths, ) np.array
+            - Units:    km
+            - Layer thicknesses (starting with 0), the same for all profiles
+        vsv:
+            - (n_locations, n_depths) np.array
+            - Units:    km/s
+    """
 
-    ds = load_literature_vel_model('SR16')
-    if not ds:
+    grid = load_literature_vs_grid('SR16', mmap_dir)
+    if grid is None:
         return
 
-    i_lat = np.argmin(np.abs(ds.latitude.values - lat))
-    i_lon = np.argmin(np.abs(ds.longitude.values - lon))
+    locations = np.array(locations, dtype=float).reshape(-1, 2)
+    lons = locations[:, 1].copy()
+    lons[lons < 0] += 360 # Convert to °E if in °W
+    i_lat = _nearest_index(grid.latitude, locations[:, 0])
+    i_lon = _nearest_index(grid.longitude, lons)
+
+    thickness = np.hstack((np.array([0]), np.diff(grid.depth)))
+
+    return thickness, np.asarray(grid.vs[:, i_lat, i_lon]).T
+
+def _nearest_index(axis:np.array, values:np.array) -> np.array:
+    """ Find the index of the nearest point in a sorted axis for many values.
+
+    If the axis is evenly spaced (e.g. the 0.25° SR16 grid), this is just
+    arithmetic; otherwise, it is a binary search.  Either way, ties go to
+    the lower index, as np.argmin(np.abs(axis - value)).
+
+    Arguments:
+        axis:
+            - (n, ) np.array, sorted in increasing order
+        values:
+            - (m, ) np.array
+
+    Returns:
+        inds:
+            - (m, ) np.array of ints
+    """
+
+    axis = np.asarray(axis, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if axis.size == 1:
+        return np.zeros(values.shape, dtype=int)
 
-    thickness = np.hstack((np.array([0]), np.diff(ds.depth.values)))
-    vsv = ds.vsv.values[:, i_lat, i_lon]
+    step = np.diff(axis)
+    if np.allclose(step, step[0]):
+        inds = np.ceil((values - axis[0]) / step[0] - 0.5).astype(int)
+        return np.clip(inds, 0, axis.size - 1)
 
-    return list(thickness), list(vsv)
+    inds = np.clip(np.searchsorted(axis, values), 1, axis.size - 1)
+    lower_is_nearer = np.abs(values - axis[inds - 1]) <= np.abs(axis[inds] - values)
+
+    return inds - lower_is_nearer
+
+def load_literature_vs_grid(ref:str, mmap_dir:str='') -> LiteratureVsGrid:
+    """ Load Vs from a literature model as plain (memory-mapped) arrays.
+
+    The Vs cube is only read in once per process.  If mmap_dir is set, the
+    cube is also saved there as an .npy file, so any later process can just
+    memory-map it rather than reading the NetCDF file.  This is redone if the
+    NetCDF file is newer than the .npy file.
+
+    Arguments:
+        ref:
+            - str
+            - Shorthand for the model; see load_literature_vel_model()
+        mmap_dir:
+            - str
+            - Default value = '', i.e. don't save a memory-mapped copy
+
+    Returns:
+        LiteratureVsGrid (or None if the model couldn't be loaded)
+    """
+
+    if (ref, mmap_dir) in _literature_vs_grids:
+        return _literature_vs_grids[(ref, mmap_dir)]
+
+    ds = load_literature_vel_model(ref)
+    if ds is None:
+        return
+
+    depth = ds.depth.values
+    latitude = ds.latitude.values
+    longitude = ds.longitude.values
+    vs = None
+    if mmap_dir:
+        vs_file = os.path.join(mmap_dir, '{}_vs.npy'.format(ref))
+        source_file = ds.encoding.get('source', '')
+        if (not os.path.exists(vs_file) or (os.path.exists(source_file)
+                and os.path.getmtime(source_file) > os.path.getmtime(vs_file))):
+            try:
+                os.makedirs(mmap_dir, exist_ok=True)
+                tmp_file = '{}.tmp{}.npy'.format(vs_file[:-4], os.getpid())
+                np.save(tmp_file, ds.vs.transpose(
+                    'depth', 'latitude', 'longitude').values.astype(float))
+                os.replace(tmp_file, vs_file)
+            except OSError:
+                logger.warning('Could not save %s', vs_file)
+        if os.path.exists(vs_file):
+            vs = np.load(vs_file, mmap_mode='r')
+    if vs is None:
+        vs = ds.vs.transpose('depth', 'latitude', 'longitude').values
+
+    grid = LiteratureVsGrid(depth, latitude, longitude, vs)
+    _literature_vs_grids[(ref, mmap_dir)] = grid
+
+    return grid
 
 def load_literature_vel_model(ref:str):
+    """ Load a published Vs model as a dataset.
+
+    IRIS EMC has many models of the WUS available to download.  These are
+    models including surface wave data with absolute Vs values (note that
+    some were still reported as dVs with a given reference model).
+
+    Each model is only opened (lazily, so nothing is read until it is used)
+    once per process, and the same dataset is returned for any later calls.
+    Models reported as Vs perturbations are converted to absolute Vs once,
+    and the result cached on disk (see _load_absolute_vel_model()).
+
+    Models listed:
+        SR16:   Shen & Ritzwoller, 2016     - fits Moho Ps RFs
+        S15:    Schmandt et al., 2015       - fits Moho Ps RFs
+        P14:    Porrit et al., 2014         - reported as dVs relative to WUS
+        P15:    Porter et al., 2015
+        F18:    Fichtner et al., 2018
+        Y14:    Yuan et al., 2014           - no Vs modelled < 50 km depth
+        C15:    Chai et al., 2015           - includes fitting RFs throughout
+
+    Arguments:
+        ref:
+            - string
+            - one of the shorthands listed above denoting which model to load
+    Returns:
+        ds
+            - xarray dataset with at least the following fields
+                - vs:           absolute shear velocity (km/s)
+                - depth:        depth (km)
+                - latitude:     (degrees N)
+                - longitude:    (degrees E)
+            - None if the model file has not been downloaded
+    """
+
+    if ref not in _literature_models:
+        ds = _open_literature_vel_model(ref)
+        if ds is None:
+            return
+        _literature_models[ref] = ds
+
+    return _literature_models[ref]
+
+def _open_literature_vel_model(ref:str):
 
     if ref == 'SR16':
         nm = 'data/earth_models/US.2016.nc'
@@ -448,7 +1368,7 @@ def load_literature_vel_model(ref:str):
 
 
     else:
-        print('Unknown reference - try again')
+        logger.error('Unknown reference - try again')
         return
 
 
@@ -456,28 +1376,14 @@ def load_literature_vel_model(ref:str):
         ds = xr.open_dataset(nm)
     except:
 
-        print(
+        logger.error(
             'You need to download the {} model from'.format(ref)
             + ' IRIS EMC\n\t{} \nand save to \n\t{}'.format(url, nm)
         )
         return
 
     if ref_v.any(): # Convert perturbations to absolute values
-        imax = np.argmax(ds.depth.values > ref_v[-1, 1])
-        ref_vz = np.interp(ds.depth.values[:imax], ref_v[:, 1], ref_v[:, 0])
-        dvs = ds[v_field].values[:imax, :, :]
-        vs = np.zeros_like(dvs)
-        for ila in range(dvs.shape[1]):
-            for ilo in range(dvs.shape[2]):
-                vs[:, ila, ilo] = (1 + (dvs[:, ila, ilo] / 100)) * ref_vz
-
-        ds = xr.Dataset(
-            {'vs': (['depth', 'latitude', 'longitude'],  vs)},
-            coords={'longitude': (['longitude'], ds.longitude.values),
-                    'latitude': (['latitude'], ds.latitude.values),
-                    'depth': ds.depth.values[:imax],
-                    }
-        )
+        ds = _load_absolute_vel_model(ds, v_field, ref_v, nm)
         v_field = 'vs'
 
     if v_field != 'vs':
@@ -485,34 +1391,208 @@ def load_literature_vel_model(ref:str):
 
     return ds
 
+def _load_absolute_vel_model(ds:xr.Dataset, v_field:str, ref_v:np.array,
+                             source_file:str,
+                             cache_dir:str='data/earth_models/.cache/'
+                             ) -> xr.Dataset:
+    """ Load a model of Vs perturbations as absolute Vs, via a disk cache.
+
+    Converting the whole model is slow, so the converted dataset is saved as
+    a NetCDF file in cache_dir.  The file name includes a hash of ref_v, and
+    the size and modification time of the source file are saved with it, so
+    the conversion is only redone if either of them change.
+
+    Arguments:
+        ds:
+            - xr.Dataset
+            - Model of Vs perturbations, in %, with dimensions (depth,
+              latitude, longitude).
+        v_field:
+            - str
+            - Name of the Vs perturbation variable in ds.
+        ref_v:
+            - (n, 2) np.array
+            - Reference model, as rows of [Vs (km/s), depth (km)].
+        source_file:
+            - str
+            - Path to the file ds was loaded from.
+        cache_dir:
+            - str
+            - Default value = 'data/earth_models/.cache/'
+
+    Returns:
+        ds:
+            - xr.Dataset
+            - Absolute Vs (km/s) as the field 'vs', only down to the base of
+              the reference model.
+    """
+
+    stat = os.stat(source_file)
+    cache_file = os.path.join(cache_dir, '{}_{}.nc'.format(
+        os.path.splitext(os.path.basename(source_file))[0],
+        hashlib.sha1(np.ascontiguousarray(ref_v, dtype=float)).hexdigest()[:12],
+    ))
+    if os.path.exists(cache_file):
+        cached = xr.open_dataset(cache_file)
+        if (cached.attrs.get('source_size') == stat.st_size
+                and cached.attrs.get('source_mtime') == stat.st_mtime):
+            return cached
+        cached.close()
+
+    imax = np.argmax(ds.depth.values > ref_v[-1, 1])
+    ref_vz = np.interp(ds.depth.values[:imax], ref_v[:, 1], ref_v[:, 0])
+    dvs = ds[v_field].values[:imax, :, :]
+    vs = (1 + dvs / 100) * ref_vz[:, np.newaxis, np.newaxis]
+
+    ds = xr.Dataset(
+        {'vs': (['depth', 'latitude', 'longitude'],  vs)},
+        coords={'longitude': (['longitude'], ds.longitude.values),
+                'latitude': (['latitude'], ds.latitude.values),
+                'depth': ds.depth.values[:imax],
+                },
+        attrs={'source_size': stat.st_size, 'source_mtime': stat.st_mtime},
+    )
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '{}.tmp{}'.format(cache_file, os.getpid())
+        ds.to_netcdf(tmp_file)
+        os.replace(tmp_file, cache_file)
+    except (OSError, ValueError):
+        logger.warning('Could not save %s', cache_file)
+
+    return ds
 
-def interpolate_lit_model(ref, z, lats, lons):
-    # Put the literature model on the same grid as the inversion model
-    ds = load_literature_vel_model(ref)
-    z_a = ds.depth.values
-    lats_a = ds.latitude.values
-    lons_a = ds.longitude.values
-    if lons_a[0] > 0:
-        lons_a -= 360
 
-    vs_a = np.zeros((len(lats), len(lons), len(z)))
-    ila = 0
-    ilo = 0
-    for lat in lats:
-        for lon in lons:
+def interpolate_lit_model(ref:str, z:np.array, lats:np.array, lons:np.array,
+                          method:str='nearest') -> np.array:
+    """ Put a literature Vs model on the same grid as the inversion model.
 
-            i_lat = np.argmin(np.abs(lats_a - lat))
-            i_lon = np.argmin(np.abs(lons_a - lon))
-            if abs(lats_a[i_lat] - lat) > 1:
-                print('Nearest latitude is {}'.format(lats_a[i_lat]))
-            if abs(lons_a[i_lon] - lon) > 1:
-                print('Nearest longitude is {}'.format(lons_a[i_lon]))
+    See regrid_lit_model() for the arguments.
+    """
+
+    return regrid_lit_model(
+        load_literature_vel_model(ref), z, lats, lons, method
+    )
+
+def regrid_lit_model(ds:xr.Dataset, z:np.array, lats:np.array, lons:np.array,
+                     method:str='nearest') -> np.array:
+    """ Put a gridded model on a given grid of depth, latitude and longitude.
+
+    Rather than looking up each (lat, lon) in turn, the indices and weights
+    along each axis are worked out once, and only the model columns that are
+    needed are read in, so the whole cube is regridded in one go.  Depth is
+    always linearly interpolated.  Outside of the model, the values at the
+    nearest edge are used.
+
+    Arguments:
+        ds:
+            - xr.Dataset
+            - Model with the field 'vs' and coordinates depth, latitude and
+              longitude, e.g. from load_literature_vel_model().  If the
+              longitudes are all positive, 360 is subtracted from them.
+        z:
+            - (n_depth_points, ) np.array
+            - Units:    km
+        lats:
+            - (n_latitude_points, ) np.array
+            - Units:    °N
+        lons:
+            - (n_longitude_points, ) np.array
+            - Units:    °E
+        method:
+            - str
+            - Default value = 'nearest'
+            - 'nearest' to take the nearest column of the model to each
+              (lat, lon), or 'trilinear' to interpolate linearly between the
+              surrounding columns as well.
+
+    Returns:
+        vs_a:
+            - (n_latitude_points, n_longitude_points, n_depth_points) np.array
+            - Cube of Vs data from ds.
+    """
 
-            vs_a[ila, ilo, :] = np.interp(z, z_a, ds.vs.values[:, i_lat, i_lon])
+    lateral_method = 'linear' if method == 'trilinear' else 'nearest'
 
-            ilo += 1
-        ila += 1
-        ilo = 0
-    # print('Model {} depth limits: {:.0f}-{:.0f} km'.format(ref, z_a[0], z_a[-1]))
+    lats_a = ds.latitude.values.astype(float)
+    lons_a = ds.longitude.values.astype(float)
+    if lons_a[0] > 0:
+        lons_a = lons_a - 360
+
+    tables = []
+    for name, axis, values in (('latitude', lats_a, lats),
+                               ('longitude', lons_a, lons)):
+        values = np.asarray(values, dtype=float)
+        i0, _, _ = _interpolation_table(axis, values, 'nearest')
+        n_far = np.sum(np.abs(axis[i0] - values) > 1)
+        if n_far:
+            logger.info(
+                'Nearest %s is more than 1° away for %d points', name, n_far
+            )
+        tables += [_interpolation_table(axis, values, lateral_method)]
+    (ila0, ila1, wla), (ilo0, ilo1, wlo) = tables
+    iz0, iz1, wz = _interpolation_table(ds.depth.values, z, 'linear')
+
+    # Only read in the columns of the model that are needed
+    u_lat, i_lat = np.unique(np.concatenate((ila0, ila1)), return_inverse=True)
+    u_lon, i_lon = np.unique(np.concatenate((ilo0, ilo1)), return_inverse=True)
+    vs = (ds.vs.transpose('latitude', 'longitude', 'depth')
+          .isel(latitude=u_lat, longitude=u_lon).values)
+
+    vs = _lerp(vs[:, :, iz0], vs[:, :, iz1], wz)
+    vs = _lerp(vs[i_lat[:ila0.size]], vs[i_lat[ila0.size:]],
+               wla[:, np.newaxis, np.newaxis])
+    vs_a = _lerp(vs[:, i_lon[:ilo0.size]], vs[:, i_lon[ilo0.size:]],
+                 wlo[np.newaxis, :, np.newaxis])
 
     return vs_a
+
+def _interpolation_table(axis:np.array, values:np.array, method:str) -> tuple:
+    """ Find the indices and weights to interpolate along a 1D axis.
+
+    Values are interpolated as (1 - w) * y[i0] + w * y[i1].  Outside of the
+    axis, the value at the nearest end is used, as np.interp().
+
+    Arguments:
+        axis:
+            - (n, ) np.array, sorted (in increasing or decreasing order)
+        values:
+            - (m, ) np.array
+        method:
+            - str
+            - 'nearest' (so i0 = i1 and w = 0) or 'linear'
+
+    Returns:
+        i0, i1:
+            - (m, ) np.array of ints
+        w:
+            - (m, ) np.array
+    """
+
+    axis = np.asarray(axis, dtype=float)
+    values = np.asarray(values, dtype=float)
+    if axis.size > 1 and axis[0] > axis[-1]:
+        i0, i1, w = _interpolation_table(axis[::-1], values, method)
+        return axis.size - 1 - i0, axis.size - 1 - i1, w
+
+    if method == 'nearest' or axis.size == 1:
+        inds = _nearest_index(axis, values)
+        return inds, inds, np.zeros(values.shape)
+
+    i1 = np.clip(np.searchsorted(axis, values, side='right'), 1, axis.size - 1)
+    i0 = i1 - 1
+    dx = axis[i1] - axis[i0]
+    w = np.divide(values - axis[i0], dx, out=np.zeros(values.shape),
+                  where=dx > 0)
+
+    return i0, i1, np.clip(w, 0, 1)
+
+def _lerp(a:np.array, b:np.array, w:np.array) -> np.array:
+    """ Return (1 - w) * a + w * b, but exactly a (or b) when w is 0 (or 1).
+
+    This means that a missing (NaN) value is only carried through if it is
+    actually used.
+    """
+
+    return np.where(w == 0, a, np.where(w == 1, b, (1 - w) * a + w * b))
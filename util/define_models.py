@@ -14,6 +14,9 @@ Classes:
             vpv_vsv_ratio       - Ratio of Vpv to Vsv
             vpv_vph_ratio       - Ratio of Vpv to Vph
             ref_card_csv_name   - Path to a reference full MINEOS model card
+            resolution_schedule - Coarser layer thicknesses to use for early iterations
+            card_tolerance      - Error allowed in Vsv with adaptive MINEOS card spacing
+            card_max_step       - Maximum MINEOS card spacing when adaptive
     2. VsvModel
         - Shear velocity model with
         - Fields:
@@ -45,15 +48,19 @@ Functions:
     5. _return_evenly_spaced_model(model: VsvModel, min_layer_thickness:float
                                    ) -> (np.array, np.array, np.array):
         - Refactor VsvModel so that layers are a more uniform thickness
-    6. _mean_val_in_interval(v:list, thick:list , d1:float, d2:float) -> float:
-        - Find mean value of v within some depth range d1 to d2
-    7. _add_noise_to_starting_model(model:VsvModel, depth_limits:tuple) -> VsvModel:
+    6. _mean_val_in_interval(v:np.array, thick:np.array, d1:np.array,
+                             d2:np.array) -> np.array:
+        - Find mean value of v within some depth range(s) d1 to d2
+    7. _add_noise_to_starting_model(model:VsvModel, depth_limits:tuple, rng=None) -> VsvModel:
         - Add random noise to a VsvModel
-    9. _add_random_noise(a:np.array, sc:float, pdf='normal') -> np.array:
+    9. _add_random_noise(a:np.array, sc:float, pdf='normal', rng=None) -> np.array:
         - Add random noise to an array of a given scale (i.e. standard deviation for normal pdf)
     10. convert_vsv_model_to_mineos_model(vsv_model:VsvModel, model_params:ModelParams,
                                                 **kwargs) -> pd.DataFrame:
         - Convert VsvModel to have all values necessary for MINEOS, and write to disk as csv
+    10a. _adaptive_card_depths(depth:np.array, vsv:np.array, vsv_model:VsvModel,
+                               model_params:ModelParams) -> np.array:
+        - Pick out the card depths needed to fit Vsv to within card_tolerance
     11. _write_mineos_card(mineos_card_model:pd.DataFrame, name:str):
         - Add header information and write MINEOS compatible model as a .card file
     12. _set_earth_layer_indices(model_params:ModelParams, model:VsvModel, **kwargs) -> EarthLayerIndices:
@@ -72,12 +79,16 @@ Functions:
 
 #import collections
 import typing
+import logging
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 import os
 
 from util import constraints
+from util import artefacts
+
+logger = logging.getLogger(__name__)
 
 # =============================================================================
 # Set up classes for commonly used variables
@@ -140,6 +151,37 @@ class ModelParams(typing.NamedTuple):
             - Path to a .csv file containing the information for the reference full MINEOS model card that we'll be altering.
             - This could be some reference Earth model (e.g. PREM), or some more specific local model.
             - Note that this csv file should be in SI units (m, kg.m^-3, etc)
+        resolution_schedule:
+            - tuple of tuples, ((float, int), (float, int), ...)
+            - Units:    (km, dimensionless)
+            - Default value: () i.e. all iterations at min_layer_thickness
+            - Coarse-to-fine schedule for the inversion.  Each item is
+              (layer thickness, maximum number of iterations), and these are
+              run in order before the final iterations at min_layer_thickness.
+            - The MINEOS card spacing is a third of the layer thickness, so
+              early iterations with thicker layers have cheaper MINEOS runs
+              and a smaller G.  The model is respaced with
+              _return_evenly_spaced_model() between stages.
+            - e.g. ((18., 2), (12., 2)) runs up to two iterations with 18 km
+              layers, then up to two with 12 km layers, then the rest with
+              min_layer_thickness layers.
+        card_tolerance:
+            - float
+            - Units:    km/s
+            - Default value: 0. (i.e. evenly spaced MINEOS card)
+            - If greater than zero, the MINEOS card is sampled adaptively
+              (see _adaptive_card_depths()): points are dropped from the evenly
+              spaced card wherever Vsv can be linearly interpolated from the
+              remaining points to within this tolerance.  The card is kept
+              at full density in and around the boundary layers.
+            - e.g. 0.005 km/s
+        card_max_step:
+            - float
+            - Units:    km
+            - Default value: 10.
+            - Maximum spacing between points in an adaptively sampled MINEOS
+              card, so that the eigenfunctions are still well sampled in
+              regions where Vsv is very smooth.
 
     """
 
@@ -152,6 +194,9 @@ class ModelParams(typing.NamedTuple):
     vpv_vph_ratio: float = 1.
     eta: float = 1.
     ref_card_csv_name: str = 'data/earth_models/prem.csv'
+    resolution_schedule: tuple = ()
+    card_tolerance: float = 0.
+    card_max_step: float = 10.
 
 class VsvModel(typing.NamedTuple):
     """ Vsv model with some additional information for the inversion.
@@ -271,7 +316,7 @@ def setup_starting_model(model_params: ModelParams, location: tuple) -> VsvModel
     if not os.path.exists('output/' + model_params.id):
         os.mkdir('output/' + model_params.id)
     else:
-        print('This model ID has already been used!')
+        logger.info('This model ID has already been used!')
 
     # Load in Crust 1.0 crustal structure, defined globally (but coarsely)
     #thick, vs = constraints.get_vels_Crust1(location)
@@ -458,87 +503,104 @@ def _return_evenly_spaced_model(model: VsvModel, min_layer_thickness:float
 
 
     """
-    thick = model.thickness.flatten().tolist()
-    vs = model.vsv.flatten().tolist()
-    boundary_inds = model.boundary_inds.flatten().tolist()
-
-    # Set uppermost value of thick
-    new_thick = [thick[0]]
-    bi = [-1] + boundary_inds
-    new_bi = []
-
-    # Loop through all BLs to get velocities above and within them
-    for ib in range(len(bi[:-1])):
-        inter_boundary_depth = (sum(thick[:bi[ib + 1] + 1])
-                                - sum(thick[:bi[ib] + 2]))
-        n_layers = max(int(inter_boundary_depth // min_layer_thickness), 1)
-        # if ib == 0:
-        #     n_layers *= 3 # Have denser spacing in the crust
-        layer_t = inter_boundary_depth / n_layers
-
-        # set uppermost value of Vs
-        if ib == 0:
-            new_v = [_mean_val_in_interval(vs, thick, sum(new_thick), sum(new_thick) + layer_t / 2)]
-
-        for il in range(n_layers - 1):
-            new_thick += [layer_t]
-            new_v += [_mean_val_in_interval(vs, thick, sum(new_thick) - layer_t / 2,
-                                         sum(new_thick) + layer_t / 2)]
-        new_bi += [len(new_thick)]
-        new_thick += [layer_t, thick[bi[ib + 1] + 1]]
-        new_v += vs[bi[ib + 1]:bi[ib + 1] + 2]
-
-
-    # For the deepest BL to the base of the model
-    inter_boundary_depth = sum(thick) - sum(thick[:boundary_inds[-1] + 2])
+    thick = model.thickness.flatten()
+    vs = model.vsv.flatten()
+    boundary_inds = model.boundary_inds.flatten()
+    depth = np.cumsum(thick)
+
+    # Split the model into sections between the BLs (and from the deepest BL
+    # to the base of the model), each split into n_layers even layers
+    section_tops = np.append(depth[0], depth[boundary_inds + 1])
+    section_bottoms = np.append(depth[boundary_inds], depth[-1])
+    inter_boundary_depth = section_bottoms - section_tops
     # need at least one layer
-    n_layers = max(int(inter_boundary_depth // min_layer_thickness), 1)
+    n_layers = np.maximum(
+        (inter_boundary_depth // min_layer_thickness).astype(int), 1
+    )
     layer_t = inter_boundary_depth / n_layers
-    for il in range(n_layers - 1):
-        new_thick += [layer_t]
-        new_v += [_mean_val_in_interval(vs, thick, sum(new_thick) - layer_t / 2,
-                                     sum(new_thick) + layer_t / 2)]
-    new_thick += [layer_t]
-    new_v += [vs[-1]]
-    return _list_to_col(new_thick), _list_to_col(new_v), np.array(new_bi)
-
 
-def _mean_val_in_interval(v:list, thick:list , d1:float, d2:float) -> float:
-    """ Calculate the mean value of v in some depth interval.
+    # Stitch in the BLs, which keep their original thicknesses
+    new_thick = [thick[:1]]
+    new_bi = []
+    n_above = 1
+    for ib, b in enumerate(boundary_inds):
+        new_bi += [n_above + n_layers[ib] - 1]
+        new_thick += [np.full(n_layers[ib], layer_t[ib]), thick[b + 1:b + 2]]
+        n_above += n_layers[ib] + 1
+    # For the deepest BL to the base of the model
+    new_thick += [np.full(n_layers[-1], layer_t[-1])]
+    new_thick = np.concatenate(new_thick)
+    new_bi = np.array(new_bi, dtype=int)
+
+    # The BLs and the base of the model keep their original velocities
+    new_v = np.zeros(new_thick.size)
+    new_v[new_bi] = vs[boundary_inds]
+    new_v[new_bi + 1] = vs[boundary_inds + 1]
+    new_v[-1] = vs[-1]
+    # Everywhere else, average the velocity over half a layer either side
+    # (only half a layer below the surface).  The node depths are a running
+    # sum of the new thicknesses, so they exactly match the sample depths in
+    # _mean_val_in_interval() as they always have.
+    new_depth = np.cumsum(new_thick)
+    d1 = new_depth - new_thick / 2
+    d2 = new_depth + new_thick / 2
+    d1[0] = new_depth[0]
+    d2[0] = new_depth[0] + new_thick[1] / 2
+    averaged = np.ones(new_thick.size, dtype=bool)
+    averaged[np.hstack((new_bi, new_bi + 1, new_thick.size - 1))] = False
+    new_v[averaged] = _mean_val_in_interval(vs, thick, d1[averaged],
+                                            d2[averaged])
+
+    return new_thick[:, np.newaxis], new_v[:, np.newaxis], new_bi
+
+
+def _mean_val_in_interval(v:np.array, thick:np.array, d1:np.array,
+                          d2:np.array) -> np.array:
+    """ Calculate the mean value of v in some depth interval(s).
+
+    v is interpolated linearly between the nodes, and sampled every 0.1 km
+    from the top of the model.  The mean is the mean of the samples in the
+    interval.  The samples are only calculated once, and their running sum
+    gives the sum in any number of intervals at once.
 
     Arguments:
         - v:
-            - list of floats
+            - (n_nodes, ) np.array (or list) of floats
             - Units:    unspecified
-            - Some list of values defined at nodes (e.g. list of VsvModel.vsv)
+            - Some values defined at nodes (e.g. VsvModel.vsv)
         - thick:
-            - list of floats
+            - (n_nodes, ) np.array (or list) of floats
             - Units:    same as d1, d2; e.g. kilometres
             - Layer thicknesses, like VsvModel.thickness
         - d1:
-            - float
+            - float or (n_intervals, ) np.array
             - Units:    same as d2, thick
-            - Minimum depth of interval (range is inclusive at minimum)
+            - Minimum depth of interval(s) (range is inclusive at minimum)
         - d2:
-            - float
+            - float or (n_intervals, ) np.array
             - Units:    same as thick, d1
-            - Maximum depth of interval (range is exclusive at maximum)
+            - Maximum depth of interval(s) (range is exclusive at maximum)
 
 
     Returns:
-        Mean value within the given range d1-d2:
-            - float
+        Mean value within the given range(s) d1-d2:
+            - float or (n_intervals, ) np.array
             - Units:    same as v
+            - NaN if there are no samples in the range
 
     """
-    interp_d = np.arange(thick[0], sum(thick), 0.1)
-    interp_vs = np.interp(interp_d, np.cumsum(thick), v)
-
-    return np.mean(interp_vs[np.logical_and(
-                d1 <= interp_d, interp_d < d2
-            )])
-
-def _add_noise_to_starting_model(model:VsvModel, depth_limits:tuple) -> VsvModel:
+    depth = np.cumsum(thick)
+    interp_d = np.arange(depth[0], depth[-1], 0.1)
+    interp_vs = np.interp(interp_d, depth, np.array(v, dtype=float).flatten())
+    running_sum = np.append(0., np.cumsum(interp_vs))
+
+    i1 = np.searchsorted(interp_d, d1, side='left')
+    i2 = np.searchsorted(interp_d, d2, side='left')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (running_sum[i2] - running_sum[i1]) / (i2 - i1)
+
+def _add_noise_to_starting_model(model:VsvModel, depth_limits:tuple,
+                                 rng:np.random.Generator=None) -> VsvModel:
     """ Add random noise to the starting model
 
     To investigate dependence on starting model (which is negligible), we add random noise to the starting model at the beginning of the inversion.  We perturb both Vsv and layer thickness.  We maintain layer thickness of the boundary layers, the thickness of the surface layer (i.e. 0), and the total thickness of the velocity model to maintain the depth limits.
@@ -552,6 +614,11 @@ def _add_noise_to_starting_model(model:VsvModel, depth_limits:tuple) -> VsvModel
             - tuple, (float, float)
             - Units:    kilometres
             - Depth limits for inversion, i.e. only perturb values within these limits
+        rng:
+            - np.random.Generator
+            - Default value = None, i.e. use the global np.random state
+            - Pass in a Generator to make the noise reproducible, e.g. for
+              independent Monte Carlo trials.
     Returns:
         new model
             - VsvModel
@@ -565,18 +632,20 @@ def _add_noise_to_starting_model(model:VsvModel, depth_limits:tuple) -> VsvModel
 
 
     # Perturb all Vs that we are inverting for
-    vs[d_inds] = _add_random_noise(vs[d_inds], 0.2)
+    vs[d_inds] = _add_random_noise(vs[d_inds], 0.2, rng=rng)
 
     # For thickness, as layer thickness can be very different, scale
     # perturbations by thickness of layer
     for i in range(len(thick) - 1):
         if i - 1 not in bi and i - 1 in d_inds:
-            thick[i] = _add_random_noise(np.array(thick[i]), np.array(thick[i]) / 10)
+            thick[i] = _add_random_noise(np.array(thick[i]), np.array(thick[i]) / 10,
+                                         rng=rng)
     thick[-1] = depth_limits[1] - sum(thick[:-1])
 
     return VsvModel(vs, thick, bi, _find_depth_indices(thick, depth_limits))
 
-def _add_random_noise(a:np.array, sc:float, pdf='normal') -> np.array:
+def _add_random_noise(a:np.array, sc:float, pdf='normal',
+                      rng:np.random.Generator=None) -> np.array:
     """ Add random noise to an array of mean 0, scaled by sc.
 
     Arguments:
@@ -593,14 +662,19 @@ def _add_random_noise(a:np.array, sc:float, pdf='normal') -> np.array:
             - str
             - Label for type of noise distribution - normal or uniform
             - Default value: 'normal'
+        rng:
+            - np.random.Generator
+            - Default value = None, i.e. use the global np.random state
     Returns:
         np.array of same shape as a with random perturbation of each element
             - np.array
     """
+    if rng is None:
+        rng = np.random
     if pdf == 'normal':
-        return a + np.random.normal(loc=0, scale=sc, size=a.shape)
+        return a + rng.normal(loc=0, scale=sc, size=a.shape)
     if pdf == 'uniform':
-        return a + np.random.uniform(low=-sc, high=sc, size=a.shape)
+        return a + rng.uniform(low=-sc, high=sc, size=a.shape)
 
 
 def convert_vsv_model_to_mineos_model(vsv_model:VsvModel, model_params:ModelParams,
@@ -634,7 +708,7 @@ def convert_vsv_model_to_mineos_model(vsv_model:VsvModel, model_params:ModelPara
         os.mkdir('output')
     if not os.path.exists('output/' + model_params.id):
         os.mkdir('output/' + model_params.id)
-        print("This test ID hasn't been used before!")
+        logger.debug("This test ID hasn't been used before!")
 
     # Load PREM (http://ds.iris.edu/ds/products/emc-prem/)
     # Slightly edited to remove the water layer and give the model point
@@ -648,11 +722,16 @@ def convert_vsv_model_to_mineos_model(vsv_model:VsvModel, model_params:ModelPara
     radius = np.arange(radius_model_base, radius_model_top, step)
     radius = np.append(radius, radius_model_top)
     depth = (radius_Earth - radius) # still in km at this point
-    radius *= 1e3 # convert to SI
 
     vsv = np.interp(depth,
                     np.cumsum(vsv_model.thickness),
-                    vsv_model.vsv.flatten()) * 1e3 # convert to SI
+                    vsv_model.vsv.flatten())
+    if model_params.card_tolerance > 0:
+        keep = _adaptive_card_depths(depth, vsv, vsv_model, model_params)
+        radius, depth, vsv = radius[keep], depth[keep], vsv[keep]
+
+    radius *= 1e3 # convert to SI
+    vsv *= 1e3 # convert to SI
     vsh = vsv / model_params.vsv_vsh_ratio
     vpv = vsv * model_params.vpv_vsv_ratio
     vph = vpv / model_params.vpv_vph_ratio
@@ -669,7 +748,7 @@ def convert_vsv_model_to_mineos_model(vsv_model:VsvModel, model_params:ModelPara
         try:
             Moho_depth = kwargs['Moho']
         except:
-            print('Moho depth never specified! Guessing 35 km.')
+            logger.warning('Moho depth never specified! Guessing 35 km.')
             Moho_depth = 35
     rho[(depth <= Moho_depth) & (2900 < rho)] = 2900
 
@@ -690,13 +769,78 @@ def convert_vsv_model_to_mineos_model(vsv_model:VsvModel, model_params:ModelPara
 
     mineos_card_model = pd.concat([smoothed_below, new_model,
                                    smoothed_above]).reset_index(drop=True)
-    mineos_card_model.to_csv('output/{0}/{0}.csv'.format(model_params.id),
-                             index=False)
+    artefacts.save_csv(mineos_card_model,
+                       'output/{0}/{0}.csv'.format(model_params.id),
+                       index=False)
 
     _write_mineos_card(mineos_card_model, model_params.id)
 
     return mineos_card_model
 
+def _adaptive_card_depths(depth:np.array, vsv:np.array, vsv_model:VsvModel,
+                          model_params:ModelParams) -> np.array:
+    """ Choose which points of an evenly spaced MINEOS card to keep.
+
+    MINEOS run time and the size of the kernels scale with the number of
+    points in the card, but the velocity model is usually very smooth away
+    from the boundary layers.  Starting from the top of the model, we step
+    down as far as possible such that linear interpolation between the two
+    kept points reproduces Vsv at all of the skipped points to within
+    model_params.card_tolerance (and the gap is no bigger than
+    model_params.card_max_step).  All points in the boundary layers (and
+    the points either side of them) and at the ends of the model are kept.
+
+    Note that the kernel integration in partial_derivatives.py accounts for
+    the uneven spacing.
+
+    Arguments:
+        depth:
+            - (n_card_depths, ) np.array
+            - Units:    km
+            - Evenly spaced depths, ordered from deepest to shallowest (i.e.
+              increasing radius, as in the card).
+        vsv:
+            - (n_card_depths, ) np.array
+            - Units:    km/s
+            - Vsv at those depths.
+        vsv_model:
+            - VsvModel
+            - Used to find the boundary layers.
+        model_params:
+            - ModelParams
+
+    Returns:
+        keep:
+            - (n_card_depths, ) np.array of bools
+    """
+
+    n = len(depth)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, -1]] = True
+
+    step = model_params.min_layer_thickness / 3
+    node_depth = np.cumsum(vsv_model.thickness)
+    for ib in vsv_model.boundary_inds:
+        keep[(node_depth[ib] - step <= depth)
+             & (depth <= node_depth[ib + 1] + step)] = True
+
+    i = 0
+    while i < n - 1:
+        j = i + 1
+        while (j < n - 1 and not keep[j]
+               and abs(depth[j + 1] - depth[i]) <= model_params.card_max_step):
+            # Try skipping all points between i and j + 1
+            between = slice(i + 1, j + 1)
+            frac = (depth[between] - depth[i]) / (depth[j + 1] - depth[i])
+            interpolated = vsv[i] + frac * (vsv[j + 1] - vsv[i])
+            if np.max(np.abs(interpolated - vsv[between])) > model_params.card_tolerance:
+                break
+            j += 1
+        keep[j] = True
+        i = j
+
+    return keep
+
 def _write_mineos_card(mineos_card_model:pd.DataFrame, name:str):
     """ Write the MINEOS card model txt file to (name).card.
 
@@ -888,7 +1032,7 @@ def _set_earth_layer_indices(model_params:ModelParams, model:VsvModel, **kwargs)
         try:
             moho_ind = np.argmin(np.abs(depth - kwargs['Moho']))
         except:
-            print('Moho depth never specified! Guessing 35 km.')
+            logger.warning('Moho depth never specified! Guessing 35 km.')
             moho_ind = np.argmin(np.abs(depth - 35))
 
     if 'LAB' in bnames:
@@ -897,7 +1041,7 @@ def _set_earth_layer_indices(model_params:ModelParams, model:VsvModel, **kwargs)
         try:
             lab_ind = np.argmin(np.abs(depth - kwargs['LAB']))
         except:
-            print('LAB depth never specified! Guessing 80 km.')
+            logger.warning('LAB depth never specified! Guessing 80 km.')
             lab_ind = np.argmin(np.abs(depth - 80))
 
 
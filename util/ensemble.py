@@ -0,0 +1,392 @@
+""" Run Monte Carlo ensembles of the inversion in parallel.
+
+To check how much the final model depends on the starting model, we run the
+inversion many times for a single location, each time from a starting model
+with some random noise added (define_models._add_noise_to_starting_model).
+
+The starting model and the observations are only set up once, and the trials
+are then farmed out to separate processes.  Each trial has its own model id
+(so its MINEOS files go in their own scratch directory in output/), and its
+own random number generator, spawned from a single np.random.SeedSequence,
+so the ensemble is reproducible regardless of the number of processes or the
+order in which the trials finish.  The final models are combined as they come
+in using Welford's online algorithm for the mean and variance, so memory use
+does not grow with the number of trials.
+
+Classes:
+    1. EnsembleParams
+        - Parameters for the Monte Carlo ensemble
+        - Fields:
+            n_trials            - Number of Monte Carlo trials
+            n_processes         - Number of processes to run trials in
+            seed                - Entropy for the np.random.SeedSequence
+            depth_spacing       - Spacing of depth grid for the summary stats
+            keep_scratch        - Whether to keep MINEOS files for each trial
+    2. RunningStats
+        - Running count, mean, and sum of squared differences (Welford)
+    3. EnsembleResult
+        - Summary of the ensemble
+Functions:
+    1. run_monte_carlo_ensemble(model_params, location, ensemble_params,
+                                inversion_params) -> EnsembleResult:
+        - Run the ensemble for a single location
+    2. _map_trials(all_args:typing.Iterator, n_processes:int) -> typing.Iterator:
+        - Run the trials, in parallel if requested, yielding results as they finish
+    3. _run_trial(args:tuple) -> (int, np.array, list, float, str):
+        - Run a single Monte Carlo trial (in a worker process)
+    4. _update_running_stats(stats:RunningStats, x:np.array) -> RunningStats:
+        - Add a new value to the running statistics
+    5. _running_mean(stats:RunningStats) -> np.array:
+        - Mean from the running statistics (NaN if there are no samples)
+    6. _running_std(stats:RunningStats) -> np.array:
+        - Sample standard deviation from the running statistics
+"""
+
+import typing
+import logging
+import os
+import shutil
+import concurrent.futures
+import numpy as np
+
+from util import define_models
+from util import constraints
+from util import inversion
+from util import logs
+from util import artefacts
+
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+# Set up classes for commonly used variables
+# =============================================================================
+
+class EnsembleParams(typing.NamedTuple):
+    """ Parameters for the Monte Carlo ensemble.
+
+    Fields:
+        n_trials:
+            - int
+            - Default value = 100
+            - Number of Monte Carlo trials, i.e. number of inversions run from
+              different randomly perturbed starting models.
+        n_processes:
+            - int
+            - Default value = 1
+            - Number of worker processes to run the trials in.  If this is 1,
+              everything is run in the current process.
+        seed:
+            - int
+            - Default value = None
+            - Entropy for the np.random.SeedSequence that all of the trial
+              random number generators are spawned from.  Use the same seed
+              to repeat an ensemble exactly.  If None, fresh entropy is taken
+              from the OS.
+        depth_spacing:
+            - float
+            - Units:    km
+            - Default value = 0.5
+            - Final models are interpolated onto a regular depth grid with
+              this spacing before being added to the ensemble statistics.
+        keep_scratch:
+            - bool
+            - Default value = False
+            - If False, the MINEOS output for each trial is deleted once the
+              trial has finished.
+
+    """
+
+    n_trials: int = 100
+    n_processes: int = 1
+    seed: int = None
+    depth_spacing: float = 0.5
+    keep_scratch: bool = False
+
+class RunningStats(typing.NamedTuple):
+    """ Running statistics for Welford's online mean and variance.
+
+    Fields:
+        n:
+            - int
+            - Number of samples so far.
+        mean:
+            - np.array
+            - Mean of the samples so far.
+        m2:
+            - np.array
+            - Sum of squared differences from the mean.
+    """
+
+    n: int = 0
+    mean: np.array = 0.
+    m2: np.array = 0.
+
+class EnsembleResult(typing.NamedTuple):
+    """ Summary of a Monte Carlo ensemble for one location.
+
+    Fields:
+        depth:
+            - (n_depths, ) np.array
+            - Units:    km
+            - Regular depth grid for vsv_mean and vsv_std.
+        vsv_mean:
+            - (n_depths, ) np.array
+            - Units:    km/s
+            - Mean final Vsv of all converged trials.
+        vsv_std:
+            - (n_depths, ) np.array
+            - Units:    km/s
+            - Standard deviation of final Vsv of all converged trials.
+        boundary_depth_mean:
+            - (n_boundary_layers, ) np.array
+            - Units:    km
+            - Mean depth to the top of each boundary layer.
+        boundary_depth_std:
+            - (n_boundary_layers, ) np.array
+            - Units:    km
+        chi_squared_mean:
+            - float
+            - Mean weighted chi squared of the final models.
+            - NaN if no trials converged (and likewise for the other means).
+        n_converged:
+            - int
+            - Number of trials included in the statistics.
+        failed_trials:
+            - list of tuples, (trial number, stop reason)
+            - Trials that diverged (see inversion._check_divergence()) and
+              so are not included in the statistics.
+    """
+
+    depth: np.array
+    vsv_mean: np.array
+    vsv_std: np.array
+    boundary_depth_mean: np.array
+    boundary_depth_std: np.array
+    chi_squared_mean: float
+    n_converged: int
+    failed_trials: list
+
+
+# =============================================================================
+#       Run the ensemble
+# =============================================================================
+
+def run_monte_carlo_ensemble(model_params:define_models.ModelParams,
+                             location:tuple,
+                             ensemble_params:EnsembleParams=EnsembleParams(),
+                             inversion_params:inversion.InversionParams
+                                 =inversion.InversionParams(),
+                             ) -> EnsembleResult:
+    """ Run a Monte Carlo ensemble of inversions for a single location.
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+            - The id is used as a prefix for the id of each trial.
+        location:
+            - tuple, (latitude, longitude)
+            - Units:    °N, °E
+        ensemble_params:
+            - EnsembleParams
+        inversion_params:
+            - inversion.InversionParams
+            - Used for every trial, except that diverged trials are not
+              written to the failure log (see EnsembleResult.failed_trials).
+
+    Returns:
+        EnsembleResult
+    """
+
+    # Set up the starting model and observations once, for all trials
+    with artefacts.run(inversion_params.artefacts,
+                       inversion._artefact_bundle_file(model_params.id)):
+        base_model = define_models.setup_starting_model(model_params,
+                                                        location)
+        obs_constraints = constraints.extract_observations(
+            location, model_params.id, model_params.boundaries,
+            model_params.vpv_vsv_ratio,
+        )
+    depth = np.arange(model_params.depth_limits[0],
+                      model_params.depth_limits[1]
+                      + ensemble_params.depth_spacing / 2,
+                      ensemble_params.depth_spacing)
+
+    seeds = np.random.SeedSequence(ensemble_params.seed).spawn(
+        ensemble_params.n_trials
+    )
+    all_args = (
+        (trial, seeds[trial], model_params, base_model, obs_constraints,
+         location, depth, inversion_params, ensemble_params.keep_scratch)
+        for trial in range(ensemble_params.n_trials)
+    )
+
+    # Start from arrays of the right shape, in case every trial diverges
+    vsv_stats = RunningStats(mean=np.zeros(depth.shape),
+                             m2=np.zeros(depth.shape))
+    n_boundaries = len(model_params.boundaries[0])
+    bl_stats = RunningStats(mean=np.zeros(n_boundaries),
+                            m2=np.zeros(n_boundaries))
+    chi_stats = RunningStats()
+    failed_trials = []
+    for trial, vsv, boundary_depths, chi_squared, stop_reason in _map_trials(
+            all_args, ensemble_params.n_processes):
+        if stop_reason in inversion.DIVERGENCE_REASONS:
+            failed_trials += [(trial, stop_reason)]
+            logger.warning('MC trial %d diverged (%s)', trial, stop_reason)
+            continue
+        vsv_stats = _update_running_stats(vsv_stats, vsv)
+        bl_stats = _update_running_stats(bl_stats, np.array(boundary_depths))
+        chi_stats = _update_running_stats(chi_stats, chi_squared)
+        n_done = vsv_stats.n + len(failed_trials)
+        logs.log_progress(
+            logger, 'ensemble', 'MC trial %d done (%s); %d of %d trials finished',
+            trial, stop_reason, n_done, ensemble_params.n_trials,
+            force=(n_done == ensemble_params.n_trials),
+        )
+
+    return EnsembleResult(
+        depth=depth,
+        vsv_mean=_running_mean(vsv_stats),
+        vsv_std=_running_std(vsv_stats),
+        boundary_depth_mean=_running_mean(bl_stats),
+        boundary_depth_std=_running_std(bl_stats),
+        chi_squared_mean=float(_running_mean(chi_stats)),
+        n_converged=vsv_stats.n,
+        failed_trials=sorted(failed_trials),
+    )
+
+def _map_trials(all_args:typing.Iterator, n_processes:int) -> typing.Iterator:
+    """ Run _run_trial() for every set of arguments, yielding as they finish.
+
+    Only a couple of trials per process are queued up at any one time, so
+    neither the inputs nor the outputs pile up in memory.
+    """
+
+    if n_processes == 1:
+        for args in all_args:
+            yield _run_trial(args)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(n_processes) as executor:
+        running = set()
+        for args in all_args:
+            running.add(executor.submit(_run_trial, args))
+            if len(running) >= 2 * n_processes:
+                done, running = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+        for future in concurrent.futures.as_completed(running):
+            yield future.result()
+
+def _run_trial(args:tuple) -> (int, np.array, list, float, str):
+    """ Run a single Monte Carlo trial.
+
+    This is run in a worker process, so takes a single tuple of arguments
+    and returns only the (small) things needed for the ensemble statistics.
+
+    Arguments:
+        args:
+            - tuple of
+                trial (int), seed (np.random.SeedSequence),
+                model_params (define_models.ModelParams),
+                base_model (define_models.VsvModel),
+                obs_constraints (tuple), location (tuple),
+                depth (np.array), inversion_params (inversion.InversionParams),
+                keep_scratch (bool)
+
+    Returns:
+        trial:
+            - int
+        vsv:
+            - (n_depths, ) np.array
+            - Final Vsv model interpolated onto depth.
+        boundary_depths:
+            - list of floats
+            - Final depth to the top of each boundary layer.
+        chi_squared:
+            - float
+            - Weighted chi squared of the final model.
+        stop_reason:
+            - str
+            - As inversion.InversionReport.stop_reason
+    """
+
+    (trial, seed, model_params, base_model, obs_constraints, location, depth,
+     inversion_params, keep_scratch) = args
+
+    trial_params = model_params._replace(
+        id='{}_mc{:04.0f}'.format(model_params.id, trial)
+    )
+    scratch_dir = 'output/{}'.format(trial_params.id)
+    os.makedirs(scratch_dir, exist_ok=True)
+
+    # _add_noise_to_starting_model() changes the model in place
+    model = define_models._add_noise_to_starting_model(
+        define_models.VsvModel(
+            base_model.vsv.copy(), base_model.thickness.copy(),
+            base_model.boundary_inds.copy(), base_model.d_inds,
+        ),
+        trial_params.depth_limits,
+        rng=np.random.default_rng(seed),
+    )
+    # Any bundle is saved in the scratch directory, so only kept with it.
+    # A single perturbed trial diverging doesn't mean the location is broken,
+    # so this is reported in EnsembleResult.failed_trials, not the failure log
+    with artefacts.run(inversion_params.artefacts,
+                       inversion._artefact_bundle_file(trial_params.id)):
+        model, report = inversion._run_inversion_from_model(
+            trial_params, model, obs_constraints, location,
+            inversion_params._replace(failure_log=''),
+        )
+
+    if not keep_scratch:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    vsv = np.interp(depth, np.cumsum(model.thickness), model.vsv.flatten())
+
+    return (trial, vsv, inversion._boundary_depths(model),
+            report.chi_squared[-1], report.stop_reason)
+
+def _update_running_stats(stats:RunningStats, x:np.array) -> RunningStats:
+    """ Add a sample to the running statistics (Welford, 1962).
+
+    DOI: 10.1080/00401706.1962.10490022
+
+    Arguments:
+        stats:
+            - RunningStats
+        x:
+            - np.array (or float)
+            - New sample, which must be the same shape as all previous ones.
+
+    Returns:
+        RunningStats
+    """
+
+    n = stats.n + 1
+    delta = x - stats.mean
+    mean = stats.mean + delta / n
+    m2 = stats.m2 + delta * (x - mean)
+
+    return RunningStats(n, mean, m2)
+
+def _running_mean(stats:RunningStats) -> np.array:
+    """ Return the mean from the running statistics, or NaN if there are none.
+    """
+
+    if stats.n < 1:
+        return stats.mean * np.nan
+
+    return stats.mean
+
+def _running_std(stats:RunningStats) -> np.array:
+    """ Calculate the sample standard deviation from the running statistics.
+    """
+
+    if stats.n < 2:
+        return stats.mean * np.nan
+
+    return np.sqrt(stats.m2 / (stats.n - 1))
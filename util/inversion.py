@@ -14,15 +14,374 @@ this indicates how it should be done, not that it is being done here.
 
 #import collections
 import typing
+import logging
+import time
+import json
+import datetime
+import os
+import contextlib
 import numpy as np
 import pandas as pd
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
 
 from util import define_models
 from util import mineos
 from util import constraints
 from util import partial_derivatives
 from util import weights
+from util import timing
+from util import logs
+from util import artefacts
 
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+# Set up classes for commonly used variables
+# =============================================================================
+
+class InversionParams(typing.NamedTuple):
+    """ Parameters controlling how the damped least squares is solved.
+
+    Fields:
+        solver:
+            - str
+            - 'dense' or 'banded'
+            - Default value = 'dense'
+            - 'dense' forms the full normal equations, F' * F, and solves them
+              with np.linalg.lstsq.  This is fine for the default node spacing.
+            - 'banded' keeps the a priori constraints, H' * H, in banded
+              storage and adds on the (low rank) data term, G' * We * G, via
+              the Woodbury identity.  The cost of this is close to linear in
+              the number of depth nodes, so use this for finely spaced models
+              (e.g. 1 km nodes over 400 km).
+        banded_shift:
+            - float
+            - Units:    dimensionless
+            - Default value = 1e-8
+            - H' * H is singular (e.g. no constraints on the boundary layer
+              thicknesses), so for the banded solver we add this fraction of
+              the largest diagonal element of the normal equations to the
+              diagonal so the banded Cholesky factorisation exists.  The bias
+              that this introduces is removed by iterative refinement.
+        banded_refinement_steps:
+            - int
+            - Default value = 3
+            - Number of iterative refinement steps used to remove the effect
+              of banded_shift from the banded solution.
+        max_iterations:
+            - int
+            - Default value = 5
+            - Maximum number of least squares iterations in run_inversion().
+              Each iteration requires a full MINEOS run.
+        max_wall_time:
+            - float
+            - Units:    seconds
+            - Default value = inf
+            - If run_inversion() has been going for longer than this, no
+              more iterations will be started.
+        chi_squared_target:
+            - float
+            - Units:    dimensionless
+            - Default value = 1.
+            - Stop once the reduced chi squared of the current model (i.e.
+              the weighted chi squared divided by the number of data points)
+              is at or below this value - the data are fit to within error.
+        misfit_reduction_tolerance:
+            - float
+            - Units:    dimensionless
+            - Default value = 0.01
+            - Stop once the (non-negative) fractional reduction in the
+              weighted chi squared between successive iterations is less
+              than this.
+        model_change_tolerance:
+            - float
+            - Units:    dimensionless
+            - Default value = 0.001
+            - Stop once the relative change in the model vector,
+              |p_new - p| / |p|, where p = [s; t], is less than this.
+        stagnation_iterations:
+            - int
+            - Default value = 3
+            - Stop if the weighted chi squared has not improved on the best
+              previous value (by at least misfit_reduction_tolerance) for this
+              many iterations in a row.
+        lm_lambda_initial:
+            - float
+            - Units:    dimensionless
+            - Default value = 0.
+            - Starting value of the Levenberg-Marquardt damping, λ, which
+              adds λ * diag(F' * F) to the normal equations to shorten the
+              step (see _damped_least_squares()).
+            - If this is zero, run_inversion() takes full Gauss-Newton steps
+              and accepts all of them (the original behaviour).  Set this to
+              e.g. 0.01 to switch on the step control.
+        lm_lambda_factor:
+            - float
+            - Default value = 10.
+            - λ is divided by this after a step that does about as well as
+              predicted, and multiplied by it after a step that does poorly
+              (or is rejected).
+        lm_accept_ratio:
+            - float
+            - Units:    dimensionless
+            - Default value = 0.
+            - A step is only accepted if the ratio of the actual reduction in
+              chi squared (from the next MINEOS run) to that predicted by the
+              linearised problem is greater than this.
+        lm_max_retries:
+            - int
+            - Default value = 10
+            - Number of times λ will be increased to find a step that does
+              not give any negative layer thicknesses before giving up.
+              These retries do not need a MINEOS run.
+        divergence_misfit_iterations:
+            - int
+            - Default value = 3
+            - Abort the inversion if chi squared (of every model that MINEOS
+              was run for, including rejected steps) has increased this many
+              times in a row.
+        divergence_oscillation_iterations:
+            - int
+            - Default value = 4
+            - Abort the inversion if the depth of any boundary layer has
+              flipped between moving up and moving down (by more than
+              divergence_oscillation_depth) for this many steps in a row.
+        divergence_oscillation_depth:
+            - float
+            - Units:    km
+            - Default value = 1.
+            - Boundary depth changes smaller than this are ignored when
+              looking for oscillations.
+        divergence_mineos_runs:
+            - int
+            - Default value = 30
+            - Abort the inversion if MINEOS has to be run (i.e. restarted)
+              more than this many times to get down to the shortest period
+              (see mineos.run_mineos()).  This is a good sign that the model
+              has become unphysical.  MINEOS is stopped as soon as this is
+              reached, rather than at mineos.RunParameters.max_run_N.
+        n_offdiagonals:
+            - int
+            - Default value = 3
+            - Number of off-diagonals of the model resolution and posterior
+              covariance matrices kept in ModelUncertainty (on each side of
+              the diagonal), i.e. the trade-offs with the nearest
+              n_offdiagonals model parameters.
+        lateral_damping_s:
+            - float
+            - Units:    1 / (km/s)
+            - Default value = 1.
+            - For the joint multi-location inversion, weight of the equations
+              setting Vsv equal at the same depth in neighbouring locations.
+        lateral_damping_t:
+            - float
+            - Units:    1 / km
+            - Default value = 0.1
+            - For the joint multi-location inversion, weight of the equations
+              setting the depth of each boundary layer equal in neighbouring
+              locations.
+        sparse_solver:
+            - str
+            - 'lsmr' or 'lsqr'
+            - Default value = 'lsmr'
+            - scipy.sparse.linalg solver used for the joint inversion.
+        sparse_tolerance:
+            - float
+            - Default value = 1e-10
+            - Stopping tolerance (atol and btol) for the sparse solver.
+        failure_log:
+            - str
+            - Default value = 'output/failed_locations.jsonl'
+            - Path to the failure log.  When an inversion is aborted, a line
+              of JSON describing what happened is appended to this file
+              (see _write_failure_log()).  If this is an empty string,
+              nothing is written.
+        timing_log:
+            - str
+            - Default value = ''
+            - Path to a timing log.  If set, a line of JSON with the time
+              spent in each stage of the iteration (MINEOS runs, building G,
+              the least squares etc.) is appended to this file after every
+              iteration (see timing.write_timing_record()).  If this is an
+              empty string, nothing is written.
+        profile_dir:
+            - str
+            - Default value = ''
+            - If set, each stage of the inversion (see
+              ModelParams.resolution_schedule) is run under cProfile, and
+              the stats are saved to [profile_dir]/[model id]_[stage].prof.
+              If this is an empty string, nothing is profiled.
+        artefacts:
+            - str
+            - Default value = '', i.e. use the mode set for the process
+            - What to do with the CSV files of observations, damping and
+              the MINEOS card that are saved along the way (see the
+              artefacts module): 'write' them as they are made, 'bundle'
+              them into output/[id]/[id]_artefacts.zip at the end of the
+              run, or save 'none' of them.
+
+    """
+
+    solver: str = 'dense'
+    banded_shift: float = 1e-8
+    banded_refinement_steps: int = 3
+    max_iterations: int = 5
+    max_wall_time: float = float('inf')
+    chi_squared_target: float = 1.
+    misfit_reduction_tolerance: float = 0.01
+    model_change_tolerance: float = 0.001
+    stagnation_iterations: int = 3
+    lm_lambda_initial: float = 0.
+    lm_lambda_factor: float = 10.
+    lm_accept_ratio: float = 0.
+    lm_max_retries: int = 10
+    divergence_misfit_iterations: int = 3
+    divergence_oscillation_iterations: int = 4
+    divergence_oscillation_depth: float = 1.
+    divergence_mineos_runs: int = 30
+    n_offdiagonals: int = 3
+    lateral_damping_s: float = 1.
+    lateral_damping_t: float = 0.1
+    sparse_solver: str = 'lsmr'
+    sparse_tolerance: float = 1e-10
+    failure_log: str = 'output/failed_locations.jsonl'
+    timing_log: str = ''
+    profile_dir: str = ''
+    artefacts: str = ''
+
+class ModelUncertainty(typing.NamedTuple):
+    """ Compact model resolution and posterior covariance for one location.
+
+    The full matrices are (n_model_points x n_model_points), but almost all
+    of the useful information is close to the diagonal, so only the diagonal
+    and the nearest few off-diagonals are kept.  These are stored like the
+    banded matrices in scipy.linalg.solve_banded, i.e. row k of each array is
+    the kth diagonal, padded with NaN where it runs off the end.
+
+    Fields:
+        resolution:
+            - (2 * n_offdiagonals + 1, n_model_points) np.array
+            - Model resolution matrix, R, where m_est = R * m_true (for
+              perfect data and no a priori constraints).
+            - resolution[n_offdiagonals + k, i] = R[i, i + k]
+              for k = -n_offdiagonals, ..., n_offdiagonals, so the diagonal is
+              resolution[n_offdiagonals, :].  R is not symmetric.
+        covariance:
+            - (n_offdiagonals + 1, n_model_points) np.array
+            - Units:    seismological, so (km/s)^2 for velocities,
+                        km^2 for thicknesses, and km^2/s for cross terms
+            - Posterior model covariance, C, (symmetric).
+            - covariance[k, i] = C[i, i + k], so the variance of each model
+              parameter is covariance[0, :].
+    """
+
+    resolution: np.array
+    covariance: np.array
+
+class InversionReport(typing.NamedTuple):
+    """ Record of how an inversion run went, and why it stopped.
+
+    Fields:
+        stop_reason:
+            - str
+            - Why the iterations stopped.  One of
+                'chi_squared_target', 'misfit_converged', 'stagnated',
+                'model_converged', 'max_iterations', 'max_wall_time'
+              if it worked, or (if it was aborted as it looks like it will
+              never converge - see _check_divergence())
+                'negative_thickness', 'misfit_growing', 'boundary_oscillation',
+                'mineos_restarts'
+        diverged:
+            - bool
+            - True if the inversion was aborted.
+        n_iterations:
+            - int
+            - Number of least squares steps tried (each needing a MINEOS
+              run to evaluate), including any that were rejected.
+        n_rejected:
+            - int
+            - Number of those steps that were rejected as they did not
+              reduce the misfit enough.
+        chi_squared:
+            - list of floats
+            - Weighted chi squared for each accepted model, starting with
+              the starting model.
+        model_change:
+            - list of floats
+            - Relative change in the model vector, |p_new - p| / |p|,
+              for each least squares step that was accepted.
+        lm_lambda:
+            - float
+            - Final value of the Levenberg-Marquardt damping.
+        boundary_depths:
+            - list of lists of floats
+            - Units:    km
+            - Depth to the top of each boundary layer for every model that
+              MINEOS was run for (including rejected steps).
+        n_mineos_runs:
+            - list of ints
+            - Number of MINEOS runs (i.e. restarts + 1) needed to reach the
+              shortest period for every model that MINEOS was run for.
+        uncertainty:
+            - ModelUncertainty
+            - Resolution and posterior covariance of the final model, or
+              None if the inversion diverged.
+        wall_time:
+            - float
+            - Units:    seconds
+            - Total time taken.
+    """
+
+    stop_reason: str
+    diverged: bool
+    n_iterations: int
+    n_rejected: int
+    chi_squared: list
+    model_change: list
+    lm_lambda: float
+    boundary_depths: list
+    n_mineos_runs: list
+    wall_time: float
+    uncertainty: ModelUncertainty = None
+
+
+class DampingSweep(typing.NamedTuple):
+    """ Models and L-curve for a range of damping levels.
+
+    Fields:
+        damping_scales:
+            - (n_damping, ) or (n_damping, n_layers) np.array
+            - Units:    dimensionless
+            - Scale factor, α, applied to all of the a priori constraint
+              equations (i.e. α * H * m = α * h), on top of the layer-specific
+              damping set in weights.build_weighting_damping().
+            - If 2D, a separate scale factor for the constraints on each
+              layer (see _constraint_layers()) at each damping level.
+        models:
+            - (n_damping, n_model_points) np.array
+            - Units:    seismological, so km/s for velocities (s),
+                        km for layer thicknesses (t)
+            - Least squares solution, p, for each damping level.
+        chi_squared:
+            - (n_damping, ) np.array
+            - Weighted chi squared misfit to the data, as predicted by the
+              linearised problem (see _weighted_chi_squared()).
+        roughness:
+            - (n_damping, ) np.array
+            - Misfit to the (unscaled) a priori constraints, |H * m - h|^2.
+    """
+
+    damping_scales: np.array
+    models: np.array
+    chi_squared: np.array
+    roughness: np.array
+
+
+DIVERGENCE_REASONS = ('negative_thickness', 'misfit_growing',
+                      'boundary_oscillation', 'mineos_restarts')
 
 # =============================================================================
 #       Run the Damped Least Squares Inversion
@@ -39,62 +398,1541 @@ def run_with_no_inputs():
 
     location = (35, -104)
 
-    return run_inversion(model_params, loc)
+    return run_inversion(model_params, location)
 
 
 def run_inversion(model_params:define_models.ModelParams,
                   location:tuple,
-                  n_iterations:int=5) -> (define_models.VsvModel):
-    """ Set the inversion running over some number of iterations.
+                  inversion_params:InversionParams=InversionParams(),
+                  ) -> (define_models.VsvModel, InversionReport):
+    """ Set the inversion running until it converges (or gives up).
+
+    Each MINEOS run gives both the partial derivatives for the next least
+    squares step and the misfit of the current model.  Before each least
+    squares step, we check whether the misfit is good enough, has stopped
+    improving, or has stagnated (_check_misfit_convergence()).  After each
+    step, we check whether the model has stopped changing, or whether we have
+    run out of iterations or time (_check_model_convergence()), so that no
+    MINEOS run is wasted.
+
+    If inversion_params.lm_lambda_initial is set, the step length is
+    controlled with Levenberg-Marquardt damping, λ.  Any step that would give
+    a negative layer thickness is thrown out before it gets to MINEOS and
+    re-solved with a larger λ.  Each remaining step is evaluated by running
+    MINEOS for the new model, and the actual reduction in chi squared is
+    compared to that predicted by the linearised problem.  If the ratio of the
+    two is too small, the step is rejected and we go back to the previous
+    model (and partial derivatives) with a larger λ.  Otherwise, the step is
+    accepted and λ is decreased if the linear prediction did well (so we get
+    back towards Gauss-Newton steps).
+
+    Some locations will never converge, so after every MINEOS run we also
+    check for signs of divergence (_check_divergence()).  If the inversion
+    looks like it is going nowhere, it is aborted straight away, and the
+    details are written to the failure log (_write_failure_log()).
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+        location:
+            - tuple, (latitude, longitude)
+            - Units:    °N, °E
+        inversion_params:
+            - InversionParams
+            - Includes all of the stopping criteria and step control
+
+    Returns:
+        model:
+            - define_models.VsvModel
+            - Final model
+        report:
+            - InversionReport
+            - Includes the reason for stopping, the misfit history, and the
+              resolution and posterior covariance of the final model
+    """
+
+    with logs.context(id=model_params.id, location=location), \
+            artefacts.run(inversion_params.artefacts,
+                          _artefact_bundle_file(model_params.id)):
+        model = define_models.setup_starting_model(model_params, location)
+        obs_constraints = constraints.extract_observations(
+            location, model_params.id, model_params.boundaries,
+            model_params.vpv_vsv_ratio,
+        )
+
+        return _run_inversion_from_model(
+            model_params, model, obs_constraints, location, inversion_params
+        )
+
+def _run_inversion_from_model(model_params:define_models.ModelParams,
+                              model:define_models.VsvModel,
+                              obs_constraints:tuple,
+                              location:tuple,
+                              inversion_params:InversionParams,
+                              ) -> (define_models.VsvModel, InversionReport):
+    """ Run the inversion (as run_inversion()) from a given starting model.
+
+    If model_params.resolution_schedule is set, the early iterations are run
+    with coarser layers (and so a coarser MINEOS card), respacing the model
+    with _return_evenly_spaced_model() between each stage, before the final
+    iterations at model_params.min_layer_thickness.
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+        model:
+            - define_models.VsvModel
+            - Starting model
+        obs_constraints:
+            - tuple of (obs, std_obs, periods), as from
+              constraints.extract_observations()
+        location:
+            - tuple, (latitude, longitude)
+            - Units:    °N, °E
+            - Only used to label the failure log and log messages
+        inversion_params:
+            - InversionParams
+
+    Returns:
+        model, report:
+            - As run_inversion()
+    """
+
+    with logs.context(id=model_params.id, location=location):
+        return _run_inversion_stages(
+            model_params, model, obs_constraints, location, inversion_params
+        )
+
+def _run_inversion_stages(model_params:define_models.ModelParams,
+                          model:define_models.VsvModel,
+                          obs_constraints:tuple,
+                          location:tuple,
+                          inversion_params:InversionParams,
+                          ) -> (define_models.VsvModel, InversionReport):
+    """ Run each stage of the resolution schedule in turn.
+
+    See _run_inversion_from_model().
+    """
+
+    start_time = time.perf_counter()
+    stages = list(model_params.resolution_schedule) + [
+        (model_params.min_layer_thickness, inversion_params.max_iterations)
+    ]
+    reports = []
+    current_thickness = model_params.min_layer_thickness
+    for stage, (layer_thickness, max_iterations) in enumerate(stages):
+        stage_params = model_params._replace(min_layer_thickness=layer_thickness)
+        if layer_thickness != current_thickness:
+            model = _warm_start_model(model, stage_params)
+            current_thickness = layer_thickness
+        profile_file = ''
+        if inversion_params.profile_dir:
+            profile_file = os.path.join(
+                inversion_params.profile_dir,
+                '{}_{}.prof'.format(model_params.id, stage),
+            )
+        with timing.profile(profile_file):
+            model, report = _run_inversion_stage(
+                stage_params, model, obs_constraints, location,
+                inversion_params._replace(
+                    max_iterations=max_iterations,
+                    max_wall_time=(inversion_params.max_wall_time
+                                   - (time.perf_counter() - start_time)),
+                ),
+            )
+        reports += [report]
+        if report.diverged or report.stop_reason == 'max_wall_time':
+            break
+
+    return model, _combine_reports(reports)
+
+def _combine_reports(reports:list) -> InversionReport:
+    """ Combine the InversionReports from each stage of the inversion.
+
+    Histories are joined together, counts are added up, and everything else
+    is taken from the final stage.
+    """
+
+    if len(reports) == 1:
+        return reports[0]
+
+    return reports[-1]._replace(
+        n_iterations=sum(r.n_iterations for r in reports),
+        n_rejected=sum(r.n_rejected for r in reports),
+        chi_squared=[c for r in reports for c in r.chi_squared],
+        model_change=[c for r in reports for c in r.model_change],
+        boundary_depths=[b for r in reports for b in r.boundary_depths],
+        n_mineos_runs=[n for r in reports for n in r.n_mineos_runs],
+        wall_time=sum(r.wall_time for r in reports),
+    )
+
+def _run_inversion_stage(model_params:define_models.ModelParams,
+                         model:define_models.VsvModel,
+                         obs_constraints:tuple,
+                         location:tuple,
+                         inversion_params:InversionParams,
+                         ) -> (define_models.VsvModel, InversionReport):
+    """ Run the inversion at a single resolution.
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+        model:
+            - define_models.VsvModel
+            - Starting model
+        obs_constraints:
+            - tuple of (obs, std_obs, periods), as from
+              constraints.extract_observations()
+        location:
+            - tuple, (latitude, longitude)
+            - Units:    °N, °E
+            - Only used to label the failure log
+        inversion_params:
+            - InversionParams
+
+    Returns:
+        model, report:
+            - As run_inversion()
+    """
+
+    start_time = time.perf_counter()
+    timing.collect_spans() # reset, so timing records are per iteration
+    # Still need to pass model_params as it has info on e.g. vp/vs ratio
+    # needed to convert from VsvModel to MINEOS card
+    with timing.span('forward'):
+        *ls_inputs, n_mineos_runs = _build_least_squares_inputs(
+            model_params, model, obs_constraints,
+            inversion_params.divergence_mineos_runs,
+        )
+    _write_timing_record(inversion_params, model_params, location, 0)
+    chi_squared = [_chi_squared_if_run(ls_inputs)]
+    all_chi_squared = chi_squared.copy()
+    boundary_depths = [_boundary_depths(model)]
+    all_n_mineos_runs = [n_mineos_runs]
+    model_change = []
+    n_steps = 0
+    n_rejected = 0
+    lm_lambda = inversion_params.lm_lambda_initial
+    stop_reason = ''
+    if ls_inputs[0] is None:
+        stop_reason = _mineos_gave_up(n_mineos_runs, inversion_params)
+    while not stop_reason:
+        stop_reason = _check_divergence(
+            all_chi_squared, boundary_depths, all_n_mineos_runs,
+            inversion_params,
+        )
+        if stop_reason:
+            break
+
+        p, G, d, W, H_mat, h_vec = ls_inputs
+        stop_reason = _check_misfit_convergence(
+            chi_squared, d.size, inversion_params
+        )
+        if stop_reason:
+            break
+
+        with timing.span('solve'):
+            p_new, lm_lambda = _physical_damped_least_squares(
+                p, G, d, W, H_mat, h_vec, model, lm_lambda, inversion_params
+            )
+        if p_new is None:
+            stop_reason = 'negative_thickness'
+            break
+        step_change = float(np.linalg.norm(p_new - p) / np.linalg.norm(p))
+        n_steps += 1
+
+        with timing.span('forward'):
+            new_model = _update_model(p_new, model, model_params)
+            *new_ls_inputs, n_mineos_runs = _build_least_squares_inputs(
+                model_params, new_model, obs_constraints,
+                inversion_params.divergence_mineos_runs,
+            )
+        new_chi_squared = _chi_squared_if_run(new_ls_inputs)
+        all_chi_squared += [new_chi_squared]
+        boundary_depths += [_boundary_depths(new_model)]
+        all_n_mineos_runs += [n_mineos_runs]
+        if new_ls_inputs[0] is None:
+            stop_reason = _mineos_gave_up(n_mineos_runs, inversion_params)
+            break
+        gain_ratio = _calculate_gain_ratio(
+            chi_squared[-1], new_chi_squared,
+            _weighted_chi_squared(p_new, G, d, W),
+        )
+
+        # For Gauss-Newton, take every step, only damping to avoid
+        # negative thicknesses
+        gauss_newton = inversion_params.lm_lambda_initial == 0
+        accepted = (gauss_newton
+                    or gain_ratio > inversion_params.lm_accept_ratio)
+        if accepted:
+            model = new_model
+            ls_inputs = new_ls_inputs
+            chi_squared += [new_chi_squared]
+            model_change += [step_change]
+        if gauss_newton:
+            lm_lambda = 0.
+        elif accepted:
+            if gain_ratio > 0.75:
+                lm_lambda /= inversion_params.lm_lambda_factor
+            elif gain_ratio < 0.25:
+                lm_lambda *= inversion_params.lm_lambda_factor
+        else:
+            n_rejected += 1
+            lm_lambda *= inversion_params.lm_lambda_factor
+        _write_timing_record(inversion_params, model_params, location,
+                             len(all_chi_squared) - 1)
+
+        stop_reason = _check_model_convergence(
+            model_change, time.perf_counter() - start_time, inversion_params,
+            n_steps, accepted,
+        )
+        if stop_reason:
+            break
+
+    diverged = stop_reason in DIVERGENCE_REASONS
+    uncertainty = None
+    if not diverged:
+        # Linearised about the final model, so no need for another MINEOS run
+        with timing.span('uncertainty'):
+            _, uncertainty = _damped_least_squares(
+                *ls_inputs, inversion_params, return_uncertainty=True
+            )
+    _write_timing_record(inversion_params, model_params, location, 'final')
+
+    report = InversionReport(
+        stop_reason=stop_reason,
+        diverged=diverged,
+        n_iterations=n_steps,
+        n_rejected=n_rejected,
+        chi_squared=chi_squared,
+        model_change=model_change,
+        lm_lambda=lm_lambda,
+        boundary_depths=boundary_depths,
+        n_mineos_runs=all_n_mineos_runs,
+        wall_time=time.perf_counter() - start_time,
+        uncertainty=uncertainty,
+    )
+    logger.info('Stopped after %d iterations (%d rejected; %s): '
+                'chi squared %.2f', report.n_iterations, report.n_rejected,
+                report.stop_reason, report.chi_squared[-1])
+    if report.diverged and inversion_params.failure_log:
+        _write_failure_log(inversion_params.failure_log, location,
+                           model_params, report)
+
+    return model, report
+
+def _mineos_gave_up(n_mineos_runs:int,
+                    inversion_params:InversionParams) -> str:
+    """ Log that MINEOS needed too many restarts, and return the stop reason.
+
+    See _build_least_squares_inputs() and
+    InversionParams.divergence_mineos_runs.
+    """
+
+    logger.warning('MINEOS needed %d runs to reach the shortest period '
+                   '(more than %d), so giving up', n_mineos_runs,
+                   inversion_params.divergence_mineos_runs)
+
+    return 'mineos_restarts'
+
+def _write_timing_record(inversion_params:InversionParams,
+                         model_params:define_models.ModelParams,
+                         location:tuple, iteration):
+    """ Write the time spent in each stage since the last record.
+
+    See timing.write_timing_record().  Nothing is written unless
+    inversion_params.timing_log is set.
+
+    Arguments:
+        iteration:
+            - int (number of forward runs so far, less one) or 'final'
+    """
+
+    timing.write_timing_record(
+        inversion_params.timing_log,
+        id=model_params.id,
+        location=[float(x) for x in location],
+        min_layer_thickness=float(model_params.min_layer_thickness),
+        iteration=iteration,
+    )
+
+def _chi_squared_if_run(ls_inputs:list) -> float:
+    """ Return the weighted chi squared, or NaN if MINEOS gave up.
+
+    Arguments:
+        ls_inputs:
+            - list, [p, G, d, W, H_mat, h_vec], as from
+              _build_least_squares_inputs()
+    """
+
+    if ls_inputs[0] is None:
+        return float('nan')
+
+    return _weighted_chi_squared(*ls_inputs[:4])
+
+def _artefact_bundle_file(id:str) -> str:
+    """ Return the path to save the CSV artefacts of a run to if bundled.
+
+    See InversionParams.artefacts.
+    """
+
+    return 'output/{0}/{0}_artefacts.zip'.format(id)
+
+def _artefacts_per_location(all_model_params:list,
+                            inversion_params:InversionParams):
+    """ Set the artefact mode for a run that steps many locations together.
+
+    Each location gets its own artefacts.run(), so if bundling, every
+    location has its own bundle (see _artefact_bundle_file()), all written
+    at the end of the block.
+
+    Usage:
+        with _artefacts_per_location(all_model_params, inversion_params):
+            ...
+    """
+
+    stack = contextlib.ExitStack()
+    for mp in all_model_params:
+        stack.enter_context(artefacts.run(inversion_params.artefacts,
+                                          _artefact_bundle_file(mp.id)))
+
+    return stack
+
+def _boundary_depths(model:define_models.VsvModel) -> list:
+    """ Find the depth to the top of each boundary layer in a model.
+
+    Arguments:
+        model:
+            - define_models.VsvModel
+
+    Returns:
+        depths:
+            - list of floats
+            - Units:    km
+    """
+
+    depth = np.cumsum(model.thickness)
+
+    return [float(depth[i]) for i in model.boundary_inds]
+
+def _check_divergence(chi_squared:list, boundary_depths:list,
+                      n_mineos_runs:list,
+                      inversion_params:InversionParams) -> str:
+    """ Decide whether the inversion is going nowhere and should be aborted.
+
+    Arguments:
+        chi_squared:
+            - list of floats
+            - Weighted chi squared for every model that MINEOS has been run
+              for so far (including rejected steps), most recent last.
+        boundary_depths:
+            - list of lists of floats
+            - Units:    km
+            - Depth to each boundary layer for the same models.
+        n_mineos_runs:
+            - list of ints
+            - Number of MINEOS runs needed for each of the same models.
+        inversion_params:
+            - InversionParams
+
+    Returns:
+        stop_reason:
+            - str
+            - Empty string if the inversion is fine, otherwise
+              'mineos_restarts', 'misfit_growing' or 'boundary_oscillation'.
+    """
+
+    if n_mineos_runs[-1] > inversion_params.divergence_mineos_runs:
+        return 'mineos_restarts'
+
+    k = inversion_params.divergence_misfit_iterations
+    if len(chi_squared) > k and np.all(np.diff(chi_squared[-k - 1:]) > 0):
+        return 'misfit_growing'
+
+    n = inversion_params.divergence_oscillation_iterations
+    if len(boundary_depths) > n:
+        steps = np.diff(np.array(boundary_depths[-n - 1:]), axis=0)
+        big = np.abs(steps) > inversion_params.divergence_oscillation_depth
+        flipped = np.sign(steps[1:]) != np.sign(steps[:-1])
+        if np.any(np.all(big, axis=0) & np.all(flipped, axis=0)):
+            return 'boundary_oscillation'
+
+    return ''
+
+def _write_failure_log(failure_log:str, location:tuple,
+                       model_params:define_models.ModelParams,
+                       report:InversionReport):
+    """ Append the details of an aborted inversion to the failure log.
+
+    The failure log has one JSON object per line, so it can be read back
+    in with load_failure_log() (or pd.read_json(failure_log, lines=True)).
+
+    Arguments:
+        failure_log:
+            - str
+            - Path to the failure log.
+        location:
+            - tuple, (latitude, longitude)
+            - Units:    °N, °E
+        model_params:
+            - define_models.ModelParams
+        report:
+            - InversionReport
+    """
+
+    record = {
+        'lat': float(location[0]),
+        'lon': float(location[1]),
+        'id': model_params.id,
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        **report._asdict(),
+    }
+
+    if os.path.dirname(failure_log):
+        os.makedirs(os.path.dirname(failure_log), exist_ok=True)
+    with open(failure_log, 'a') as fid:
+        fid.write(json.dumps(record) + '\n')
+
+def load_failure_log(failure_log:str='output/failed_locations.jsonl') -> list:
+    """ Load in the locations where the inversion has been aborted.
+
+    Arguments:
+        failure_log:
+            - str
+            - Path to the failure log written by _write_failure_log()
+
+    Returns:
+        records:
+            - list of dicts, one per failed inversion
+            - Includes 'lat', 'lon', 'id', 'stop_reason' and all of the other
+              InversionReport fields.
+            - Empty if the log does not exist yet.
+    """
+
+    if not os.path.exists(failure_log):
+        return []
+
+    with open(failure_log, 'r') as fid:
+        return [json.loads(line) for line in fid if line.strip()]
+
+def save_model_uncertainty(uncertainty:ModelUncertainty, fname:str):
+    """ Save ModelUncertainty to file, to be read with load_model_uncertainty.
+
+    Arguments:
+        uncertainty:
+            - ModelUncertainty
+        fname:
+            - str
+            - Saved to output/models/(fname)_uncertainty.npz, i.e. alongside
+              the model saved by define_models.save_model(model, fname)
+    """
+
+    np.savez('output/models/{}_uncertainty.npz'.format(fname),
+             **uncertainty._asdict())
+
+def load_model_uncertainty(fname:str) -> ModelUncertainty:
+    """ Load ModelUncertainty saved with save_model_uncertainty(). """
+
+    with np.load('output/models/{}_uncertainty.npz'.format(fname)) as data:
+        return ModelUncertainty(**{k: data[k] for k in ModelUncertainty._fields})
+
+def _physical_damped_least_squares(p:np.array, G:np.array, d:np.array,
+                                   W:np.array, H_mat:np.array,
+                                   h_vec:np.array,
+                                   model:define_models.VsvModel,
+                                   lm_lambda:float,
+                                   inversion_params:InversionParams,
+                                   ) -> (np.array, float):
+    """ Find a least squares step that gives a physically possible model.
+
+    If the step would give any negative layer thicknesses (see
+    _has_negative_thickness()), λ is increased to shorten the step, and the
+    least squares is solved again.  This doesn't need a new MINEOS run.
+
+    Arguments:
+        p, G, d, W, H_mat, h_vec:
+            - As output by _build_least_squares_inputs()
+        model:
+            - define_models.VsvModel
+            - Current model, which p was built from.
+        lm_lambda:
+            - float
+            - Current Levenberg-Marquardt damping.
+        inversion_params:
+            - InversionParams
+
+    Returns:
+        p_new:
+            - (n_model_points, 1) np.array, or None if no physical step was
+              found in inversion_params.lm_max_retries tries.
+        lm_lambda:
+            - float
+            - Levenberg-Marquardt damping used for p_new.
+    """
+
+    for i in range(inversion_params.lm_max_retries + 1):
+        with timing.span('_damped_least_squares'):
+            p_new = _damped_least_squares(p, G, d, W, H_mat, h_vec,
+                                          inversion_params, lm_lambda)
+        if not _has_negative_thickness(p_new, model):
+            return p_new, lm_lambda
+        lm_lambda = max(lm_lambda * inversion_params.lm_lambda_factor,
+                        inversion_params.lm_lambda_initial, 1e-3)
+
+    return None, lm_lambda
+
+def _calculate_gain_ratio(chi_squared:float, new_chi_squared:float,
+                          predicted_chi_squared:float) -> float:
+    """ Compare the actual and predicted reduction in chi squared for a step.
+
+    Arguments:
+        chi_squared:
+            - float
+            - Weighted chi squared of the current model.
+        new_chi_squared:
+            - float
+            - Weighted chi squared of the new model (from MINEOS).
+        predicted_chi_squared:
+            - float
+            - Weighted chi squared of the new model predicted by the
+              linearised problem, |W * (d - G * p_new)| ** 2.
+
+    Returns:
+        gain_ratio:
+            - float
+            - Actual reduction / predicted reduction.  If the damping means
+              that no reduction in chi squared was predicted (so the ratio is
+              meaningless), this is 1 for a step that actually reduced the
+              misfit and -1 otherwise.
+    """
+
+    actual = chi_squared - new_chi_squared
+    predicted = chi_squared - predicted_chi_squared
+
+    if predicted <= 0:
+        return 1. if actual > 0 else -1.
+
+    return actual / predicted
+
+def _weighted_chi_squared(p:np.array, G:np.array, d:np.array,
+                          W:np.array) -> float:
+    """ Calculate the weighted chi squared misfit of the current model.
+
+    d is the data misfit with G * p added on (see _build_data_misfit_vector),
+    so the actual misfit of observed to predicted values is d - G * p.  W is
+    a diagonal matrix of 1 / standard deviation, so the chi squared is
+        Σ ((obs - pred) / std) ** 2 = |W * (d - G * p)| ** 2
+
+    Arguments:
+        p, G, d, W:
+            - As output by _build_least_squares_inputs()
+
+    Returns:
+        chi_squared:
+            - float
+    """
+
+    return float(np.sum(np.matmul(W, d - np.matmul(G, p)) ** 2))
+
+def _check_misfit_convergence(chi_squared:list, n_data:int,
+                              inversion_params:InversionParams) -> str:
+    """ Decide whether to stop based on the misfit history.
+
+    Arguments:
+        chi_squared:
+            - list of floats
+            - Weighted chi squared of each model so far, most recent last.
+        n_data:
+            - int
+            - Number of data points used in the chi squared.
+        inversion_params:
+            - InversionParams
+
+    Returns:
+        stop_reason:
+            - str
+            - Empty string if the inversion should keep going, otherwise
+              'chi_squared_target', 'misfit_converged' or 'stagnated'.
+    """
+
+    if chi_squared[-1] / n_data <= inversion_params.chi_squared_target:
+        return 'chi_squared_target'
+
+    tol = inversion_params.misfit_reduction_tolerance
+    if len(chi_squared) > 1:
+        reduction = (chi_squared[-2] - chi_squared[-1]) / chi_squared[-2]
+        if 0 <= reduction < tol:
+            return 'misfit_converged'
+
+    n = inversion_params.stagnation_iterations
+    if len(chi_squared) > n:
+        if min(chi_squared[-n:]) > min(chi_squared[:-n]) * (1 - tol):
+            return 'stagnated'
+
+    return ''
+
+def _check_model_convergence(model_change:list, wall_time:float,
+                             inversion_params:InversionParams,
+                             n_steps:int=None, accepted:bool=True) -> str:
+    """ Decide whether to stop based on the model updates and time taken.
+
+    Arguments:
+        model_change:
+            - list of floats
+            - Relative change in the model vector at each accepted update
+              so far.
+        wall_time:
+            - float
+            - Units:    seconds
+            - Time since the inversion started.
+        inversion_params:
+            - InversionParams
+        n_steps:
+            - int
+            - Default value = None, i.e. len(model_change)
+            - Number of least squares steps tried so far, including any that
+              were rejected.
+        accepted:
+            - bool
+            - Default value = True
+            - Whether the latest step was accepted.  A rejected step did not
+              move the model, so it can't have converged.
+
+    Returns:
+        stop_reason:
+            - str
+            - Empty string if the inversion should keep going, otherwise
+              'model_converged', 'max_iterations' or 'max_wall_time'.
+    """
+
+    if n_steps is None:
+        n_steps = len(model_change)
+
+    if accepted and model_change[-1] < inversion_params.model_change_tolerance:
+        return 'model_converged'
+    if n_steps >= inversion_params.max_iterations:
+        return 'max_iterations'
+    if wall_time >= inversion_params.max_wall_time:
+        return 'max_wall_time'
+
+    return ''
+
+def run_continuation_inversion(model_params:define_models.ModelParams,
+                               locations:list,
+                               inversion_params:InversionParams=InversionParams(),
+                               max_warm_start_distance:float=1.5,
+                               ) -> list:
+    """ Invert a grid of locations, starting each from a converged neighbour.
+
+    The locations are visited in a space-filling order (_space_filling_order()),
+    so that most locations have a neighbour that has already been inverted.
+    Each location starts from the final model of the nearest location that
+    has already converged (respaced with _warm_start_model()), which is
+    normally much closer to the answer than a model built from scratch by
+    define_models.setup_starting_model().  If no converged location is close
+    enough, the location is started from scratch as usual.
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+            - Shared by all locations (apart from the id)
+        locations:
+            - list of tuples, (latitude, longitude)
+            - Units:    °N, °E
+        inversion_params:
+            - InversionParams
+        max_warm_start_distance:
+            - float
+            - Units:    grid spacings
+            - Default value = 1.5, i.e. including diagonal neighbours
+            - Only warm start from locations at most this far away.
+
+    Returns:
+        results:
+            - list of (define_models.VsvModel, InversionReport) tuples, in the
+              same order as locations
+    """
+
+    locs = np.array(locations, dtype=float)
+    spacing = _grid_spacing(locs)
+    results = [None] * len(locations)
+    converged = []
+    for i in _space_filling_order(locations):
+        location = tuple(locations[i])
+        mp = model_params._replace(
+            id='{}_{}N_{}E'.format(model_params.id, *location)
+        )
+        with artefacts.run(inversion_params.artefacts,
+                           _artefact_bundle_file(mp.id)):
+            obs_constraints = constraints.extract_observations(
+                location, mp.id, mp.boundaries, mp.vpv_vsv_ratio
+            )
+
+            distance = (
+                np.sqrt(np.sum((locs[converged] - locs[i]) ** 2, axis=1))
+                / spacing if converged else np.array([])
+            )
+            if distance.size and np.min(distance) <= max_warm_start_distance:
+                neighbour = converged[int(np.argmin(distance))]
+                logger.info('Warm starting %s from %s',
+                            location, tuple(locations[neighbour]))
+                os.makedirs('output/{}'.format(mp.id), exist_ok=True)
+                model = _warm_start_model(results[neighbour][0], mp)
+            else:
+                model = define_models.setup_starting_model(mp, location)
+
+            results[i] = _run_inversion_from_model(
+                mp, model, obs_constraints, location, inversion_params
+            )
+            if not results[i][1].diverged:
+                converged += [i]
+
+    return results
+
+def _warm_start_model(model:define_models.VsvModel,
+                      model_params:define_models.ModelParams
+                      ) -> define_models.VsvModel:
+    """ Make a starting model from a neighbouring location's final model.
+
+    Arguments:
+        model:
+            - define_models.VsvModel
+            - Final model from a neighbouring location.
+        model_params:
+            - define_models.ModelParams
+            - For the new location.
+
+    Returns:
+        model:
+            - define_models.VsvModel
+            - Copy of the input model, evenly respaced.
+    """
+
+    thickness, vsv, bi = define_models._return_evenly_spaced_model(
+        define_models.VsvModel(
+            model.vsv.copy(), model.thickness.copy(),
+            model.boundary_inds.copy(), model.d_inds,
+        ),
+        model_params.min_layer_thickness,
+    )
+
+    return define_models.VsvModel(
+        vsv, thickness, bi,
+        define_models._find_depth_indices(thickness, model_params.depth_limits)
+    )
+
+def _grid_spacing(locs:np.array) -> float:
+    """ Find the smallest non-zero spacing in latitude or longitude. """
+
+    steps = np.abs(np.diff(np.sort(locs, axis=0), axis=0))
+    steps = steps[steps > 1e-9]
+
+    return float(np.min(steps)) if steps.size else 1.
 
+def _space_filling_order(locations:list) -> list:
+    """ Order grid locations along a Hilbert curve.
+
+    Consecutive locations along a Hilbert curve are (almost always)
+    neighbours, and every location is close to ones that came shortly before
+    it, so this is a good order for warm starting from neighbours.
+
+    Arguments:
+        locations:
+            - list of tuples, (latitude, longitude)
+            - Units:    °N, °E
+            - Should be on a regular grid (gaps are fine).
+
+    Returns:
+        order:
+            - list of ints
+            - Indices into locations, in the order to visit them.
     """
 
-    model = define_models.setup_starting_model(model_params)
+    locs = np.array(locations, dtype=float)
+    spacing = _grid_spacing(locs)
+    ij = np.round((locs - np.min(locs, axis=0)) / spacing).astype(int)
+    n = 1
+    while n <= np.max(ij):
+        n *= 2
+
+    def hilbert_index(x, y):
+        # Convert (x, y) to distance along the curve (Hilbert, 1891)
+        d = 0
+        s = n // 2
+        while s > 0:
+            rx = int((x & s) > 0)
+            ry = int((y & s) > 0)
+            d += s * s * ((3 * rx) ^ ry)
+            if ry == 0:
+                if rx == 1:
+                    x = s - 1 - x
+                    y = s - 1 - y
+                x, y = y, x
+            s //= 2
+        return d
+
+    return sorted(range(len(locations)),
+                  key=lambda i: hilbert_index(ij[i, 0], ij[i, 1]))
+
+def run_damping_sweep(model_params:define_models.ModelParams,
+                      location:tuple,
+                      damping_scales:np.array=np.logspace(-2, 2, 41),
+                      ) -> DampingSweep:
+    """ Find the L-curve for a location from a single MINEOS run.
+
+    This runs the forward problem once for the starting model, and then
+    solves the least squares for every damping level in damping_scales
+    (see _damping_sweep()).  Use l_curve_corner() to pick a damping level.
+
+    The damping can be scaled for each layer separately, e.g. to sweep the
+    damping on the crust while keeping the rest fixed, by giving a scale for
+    each layer in define_models.EarthLayerIndices.layer_names at each
+    damping level.
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+        location:
+            - tuple, (latitude, longitude)
+            - Units:    °N, °E
+        damping_scales:
+            - (n_damping, ) or (n_damping, n_layers) np.array
+            - Scale factors for the damping set in weights.py, either for
+              all of the constraints, or for each of the n_layers (= 5)
+              layers in define_models.EarthLayerIndices.layer_names.
+
+    Returns:
+        DampingSweep
+    """
+
+    model = define_models.setup_starting_model(model_params, location)
     obs_constraints = constraints.extract_observations(
         location, model_params.id, model_params.boundaries, model_params.vpv_vsv_ratio
     )
+    p, G, d, W, H_mat, h_vec, _ = _build_least_squares_inputs(
+        model_params, model, obs_constraints
+    )
+    row_layers = None
+    if np.ndim(damping_scales) == 2:
+        row_layers = _constraint_layers(
+            H_mat, define_models._set_earth_layer_indices(model_params, model)
+        )
+
+    return _damping_sweep(G, d, W, H_mat, h_vec, damping_scales, row_layers)
+
+def _constraint_layers(H_mat:np.array,
+                       layers:define_models.EarthLayerIndices) -> np.array:
+    """ Find which layer each a priori constraint equation applies to.
+
+    Each row of H_mat is assigned to the layer of the model parameter with
+    the largest (absolute) coefficient in that row.
+
+    Arguments:
+        H_mat:
+            - (n_constraint_equations, n_model_points) np.array
+        layers:
+            - define_models.EarthLayerIndices
+
+    Returns:
+        row_layers:
+            - (n_constraint_equations, ) np.array of ints
+            - Index into layers.layer_names for each row of H_mat.
+    """
+
+    column_layers = np.zeros(H_mat.shape[1], dtype=int)
+    for i, layer_name in enumerate(layers.layer_names):
+        column_layers[np.asarray(getattr(layers, layer_name), dtype=int)] = i
+
+    return column_layers[np.argmax(np.abs(H_mat), axis=1)]
+
+def _damping_sweep(G:np.array, d:np.array, W:np.array, H_mat:np.array,
+                   h_vec:np.array, damping_scales:np.array,
+                   row_layers:np.array=None) -> DampingSweep:
+    """ Solve the damped least squares for many damping levels at once.
+
+    For damping scale α, the normal equations (see _damped_least_squares())
+    are
+        (A + α^2 * B) * m = a + α^2 * b
+    where A = G' * We * G, B = H' * H, a = G' * We * d, and b = H' * h.
+
+    Solving the generalised symmetric eigenproblem
+        B * v = θ * (A + B) * v,        V' * (A + B) * V = I
+    gives V' * B * V = Θ and V' * A * V = I - Θ, so both blocks are
+    diagonalised by the same V.  Then
+        (A + α^2 * B)^-1 = V * diag(1 / (1 - θ + α^2 * θ)) * V'
+    so after the one-off O(n^3) eigendecomposition, each extra damping level
+    only costs O(n^2).  This is equivalent to the generalised SVD of
+    (sqrt(We) * G, H), but only needs scipy.linalg.eigh.
+
+    Note that A + B must be positive definite, i.e. the model parameters
+    must be constrained by α = 1 (as is needed for _damped_least_squares()
+    to give a unique solution anyway).
+
+    If there is a different α for each layer, but the damping levels only
+    differ by an overall factor (i.e. every row of damping_scales is a
+    multiple of the first), H and h are scaled by the first row and the
+    factors are swept as above.  Otherwise, the blocks can't all be
+    diagonalised at once, so the normal equations are solved for each
+    damping level in turn, at O(n^3) each.
+
+    Arguments:
+        G:
+            - (n_data_points, n_model_points) np.array
+        d:
+            - (n_data_points, 1) np.array
+        W:
+            - (n_data_points, n_data_points) np.array
+        H_mat:
+            - (n_constraint_equations, n_model_points) np.array
+        h_vec:
+            - (n_constraint_equations, 1) np.array
+        damping_scales:
+            - (n_damping, ) or (n_damping, n_layers) np.array
+            - If 2D, the scale factor for each layer at each damping level.
+        row_layers:
+            - (n_constraint_equations, ) np.array of ints
+            - Default value = None
+            - Index of the column of damping_scales for each row of H_mat,
+              as from _constraint_layers().  Only needed if damping_scales
+              is 2D.
+
+    Returns:
+        DampingSweep
+    """
+
+    damping_scales = np.asarray(damping_scales, dtype=float)
+    A = np.matmul(G.T, np.matmul(W, G))
+    a = np.matmul(G.T, np.matmul(W, d))
+
+    if damping_scales.ndim == 1:
+        models = _eigen_damping_sweep(A, a, H_mat, h_vec, damping_scales)
+    elif (np.all(damping_scales[0] > 0) and np.allclose(
+            damping_scales / damping_scales[0],
+            damping_scales[:, :1] / damping_scales[0, 0])):
+        layer_scales = damping_scales[0][row_layers][:, np.newaxis]
+        models = _eigen_damping_sweep(
+            A, a, H_mat * layer_scales, h_vec * layer_scales,
+            damping_scales[:, 0] / damping_scales[0, 0],
+        )
+    else:
+        models = np.zeros((damping_scales.shape[0], G.shape[1]))
+        for i, scales in enumerate(damping_scales):
+            H_scaled = H_mat * scales[row_layers][:, np.newaxis]
+            h_scaled = h_vec * scales[row_layers][:, np.newaxis]
+            models[i] = np.linalg.solve(
+                A + np.matmul(H_scaled.T, H_scaled),
+                a + np.matmul(H_scaled.T, h_scaled),
+            ).flatten()
+
+    chi_squared = np.sum(
+        np.matmul(W, d - np.matmul(G, models.T)) ** 2, axis=0
+    )
+    roughness = np.sum((np.matmul(H_mat, models.T) - h_vec) ** 2, axis=0)
+
+    return DampingSweep(
+        damping_scales=damping_scales,
+        models=models,
+        chi_squared=chi_squared,
+        roughness=roughness,
+    )
+
+def _eigen_damping_sweep(A:np.array, a:np.array, H_mat:np.array,
+                         h_vec:np.array, damping_scales:np.array) -> np.array:
+    """ Solve (A + α^2 * H' * H) * m = a + α^2 * H' * h for every α.
+
+    See _damping_sweep() for the maths.
+
+    Returns:
+        models:
+            - (n_damping, n_model_points) np.array
+    """
+
+    B = np.matmul(H_mat.T, H_mat)
+    theta, V = scipy.linalg.eigh(B, A + B)
+    Va = np.matmul(V.T, a).flatten()
+    Vb = np.matmul(V.T, np.matmul(H_mat.T, h_vec)).flatten()
+
+    # (n_damping, n_model_points) coefficients in the eigenbasis
+    alpha_sq = damping_scales[:, np.newaxis] ** 2
+    coeffs = (Va + alpha_sq * Vb) / (1 - theta + alpha_sq * theta)
+
+    return np.matmul(coeffs, V.T)
+
+def l_curve_corner(sweep:DampingSweep) -> int:
+    """ Find the corner of the L-curve.
+
+    This is the point of maximum curvature of log(roughness) against
+    log(chi squared), parameterised by log(damping scale).
+
+    Arguments:
+        sweep:
+            - DampingSweep
+            - With at least three damping levels.
+
+    Returns:
+        index:
+            - int
+            - Index of the best damping level in sweep.damping_scales
+    """
+
+    if sweep.damping_scales.ndim == 2:
+        # The curvature doesn't depend on how the curve is parameterised
+        t = np.arange(len(sweep.damping_scales), dtype=float)
+    else:
+        t = np.log(sweep.damping_scales)
+    x = np.log(sweep.chi_squared)
+    y = np.log(sweep.roughness)
+    dx, dy = np.gradient(x, t), np.gradient(y, t)
+    ddx, ddy = np.gradient(dx, t), np.gradient(dy, t)
+    curvature = (dx * ddy - dy * ddx) / (dx ** 2 + dy ** 2) ** 1.5
+
+    return int(np.nanargmax(curvature[1:-1])) + 1
+
+def run_batched_inversion(model_params:define_models.ModelParams,
+                          locations:list,
+                          n_iterations:int=5,
+                          inversion_params:InversionParams=InversionParams(),
+                          ) -> list:
+    """ Run the inversion for many locations, stepping them all together.
+
+    Every location gets its own copy of model_params with a unique id (so
+    that the MINEOS files for each location are kept separate).  At each
+    iteration, the forward problem is run for each location in turn, and then
+    all of the damped least squares problems are solved together in
+    _batched_damped_least_squares().
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+            - Shared by all locations (apart from the id)
+        locations:
+            - list of tuples, (latitude, longitude)
+            - Units:    °N, °E
+        n_iterations:
+            - int
+            - Number of Gauss-Newton steps taken for every location
+        inversion_params:
+            - InversionParams
+
+    Returns:
+        models:
+            - list of define_models.VsvModel, in the same order as locations
+    """
+
+    all_model_params = [
+        model_params._replace(
+            id='{}_{}N_{}E'.format(model_params.id, lat, lon)
+        )
+        for lat, lon in locations
+    ]
+    with _artefacts_per_location(all_model_params, inversion_params):
+        models = []
+        all_obs_constraints = []
+        for mp, location in zip(all_model_params, locations):
+            models += [define_models.setup_starting_model(mp, location)]
+            all_obs_constraints += [constraints.extract_observations(
+                location, mp.id, mp.boundaries, mp.vpv_vsv_ratio
+            )]
+
+        for i in range(n_iterations):
+            models = _batched_inversion_iteration(
+                all_model_params, models, all_obs_constraints,
+                inversion_params
+            )
+
+    return models
+
+def run_joint_inversion(model_params:define_models.ModelParams,
+                        locations:list,
+                        n_iterations:int=5,
+                        inversion_params:InversionParams=InversionParams(),
+                        ) -> list:
+    """ Run a pseudo-3D inversion, smoothing laterally between locations.
+
+    As run_batched_inversion(), but instead of solving for each location
+    independently, the least squares for all locations are put into a single
+    sparse system with extra constraints to keep neighbouring locations
+    similar (see _joint_damped_least_squares()).  This gives spatially
+    consistent Moho and LAB depths without having to smooth afterwards.
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+            - Shared by all locations (apart from the id)
+        locations:
+            - list of tuples, (latitude, longitude)
+            - Units:    °N, °E
+            - Should be on a regular grid so that neighbours can be found
+              (see _find_neighbours()).
+        n_iterations:
+            - int
+            - Number of Gauss-Newton steps taken for every location
+        inversion_params:
+            - InversionParams
+            - Includes the strength of the lateral smoothing
+
+    Returns:
+        models:
+            - list of define_models.VsvModel, in the same order as locations
+    """
+
+    all_model_params = [
+        model_params._replace(
+            id='{}_{}N_{}E'.format(model_params.id, lat, lon)
+        )
+        for lat, lon in locations
+    ]
+    neighbours = _find_neighbours(locations)
+    with _artefacts_per_location(all_model_params, inversion_params):
+        models = []
+        all_obs_constraints = []
+        for mp, location in zip(all_model_params, locations):
+            models += [define_models.setup_starting_model(mp, location)]
+            all_obs_constraints += [constraints.extract_observations(
+                location, mp.id, mp.boundaries, mp.vpv_vsv_ratio
+            )]
+
+        for i in range(n_iterations):
+            all_inputs = [
+                _build_least_squares_inputs(mp, m, oc) for mp, m, oc
+                in zip(all_model_params, models, all_obs_constraints)
+            ]
+            _, Gs, ds, Ws, H_mats, h_vecs, _ = zip(*all_inputs)
+            p_news = _joint_damped_least_squares(
+                Gs, ds, Ws, H_mats, h_vecs, models, neighbours,
+                inversion_params
+            )
+            models = [
+                _update_model(p_new, m, mp) for p_new, m, mp
+                in zip(p_news, models, all_model_params)
+            ]
+
+    return models
+
+def _find_neighbours(locations:list) -> list:
+    """ Find pairs of neighbouring locations on a regular grid.
+
+    Neighbours are the nearest locations in latitude or longitude, i.e. the
+    four locations either side of each grid point (if they are in the list).
+
+    Arguments:
+        locations:
+            - list of tuples, (latitude, longitude)
+            - Units:    °N, °E
+
+    Returns:
+        neighbours:
+            - list of tuples, (i, j), where i < j are indices into locations
+    """
+
+    locs = np.array(locations, dtype=float)
+    if len(locs) < 2:
+        return []
+    dlat = np.abs(locs[:, 0][:, np.newaxis] - locs[:, 0])
+    dlon = np.abs(locs[:, 1][:, np.newaxis] - locs[:, 1])
+    spacing = np.min((dlat + dlon)[np.triu_indices(len(locs), 1)])
+    tol = 1e-6 * max(spacing, 1e-6)
+    adjacent = (
+        ((dlat < tol) & (np.abs(dlon - spacing) < tol))
+        | ((dlon < tol) & (np.abs(dlat - spacing) < tol))
+    )
+
+    return [(i, j) for i, j in zip(*np.where(np.triu(adjacent, 1)))]
+
+def _build_lateral_constraints(model_i:define_models.VsvModel,
+                               model_j:define_models.VsvModel,
+                               inversion_params:InversionParams,
+                               ) -> (np.array, np.array, np.array,
+                                     np.array, np.array):
+    """ Build the equations smoothing the model between two locations.
+
+    The two models will not have velocity nodes at exactly the same depths,
+    so each Vsv node in model_i is compared to Vsv at the same depth in
+    model_j, linearly interpolated between the two neighbouring nodes.  Nodes
+    that fall within a boundary layer in model_j are skipped, as Vsv is not
+    expected to be smooth across these.
+        ε_s * (s_i[k] - w_a * s_j[a] - w_b * s_j[a + 1]) = 0
+
+    The depth of each boundary layer is the (fixed) thickness of the layers
+    above it plus the thickness parameter, t, so setting boundary depths equal
+    gives
+        ε_t * (t_i - t_j) = ε_t * (z0_j - z0_i)
+    where z0 is the depth to the top of the layer above the boundary layer.
+
+    Arguments:
+        model_i, model_j:
+            - define_models.VsvModel
+        inversion_params:
+            - InversionParams
+            - Sets ε_s and ε_t.
+
+    Returns:
+        rows:
+            - (n_entries, ) np.array of ints
+            - Equation number for each non-zero entry.
+        cols_i, cols_j:
+            - (n_entries, ) np.array of ints
+            - Index into the model vector of location i or location j for
+              each non-zero entry (-1 if the entry is for the other location).
+        vals:
+            - (n_entries, ) np.array
+        rhs:
+            - (n_equations, ) np.array
+    """
+
+    rows, cols_i, cols_j, vals, rhs = [], [], [], [], []
+    eq = 0
+
+    depth_i = np.cumsum(model_i.thickness)
+    depth_j = np.cumsum(model_j.thickness)
+    z_i = depth_i[model_i.d_inds]
+    z_j = depth_j[model_j.d_inds]
+    eps_s = inversion_params.lateral_damping_s
+    for k, z in enumerate(z_i):
+        a = np.searchsorted(z_j, z, side='right') - 1
+        if a < 0 or a >= len(z_j) - 1 or model_j.d_inds[a] in model_j.boundary_inds:
+            continue
+        w_b = (z - z_j[a]) / (z_j[a + 1] - z_j[a])
+        rows += [eq, eq, eq]
+        cols_i += [k, -1, -1]
+        cols_j += [-1, a, a + 1]
+        vals += [eps_s, -eps_s * (1 - w_b), -eps_s * w_b]
+        rhs += [0.]
+        eq += 1
+
+    eps_t = inversion_params.lateral_damping_t
+    n_s_i, n_s_j = len(model_i.d_inds), len(model_j.d_inds)
+    for b, (bi_i, bi_j) in enumerate(zip(model_i.boundary_inds,
+                                         model_j.boundary_inds)):
+        z0_i = depth_i[bi_i] - model_i.thickness[bi_i, 0]
+        z0_j = depth_j[bi_j] - model_j.thickness[bi_j, 0]
+        rows += [eq, eq]
+        cols_i += [n_s_i + b, -1]
+        cols_j += [-1, n_s_j + b]
+        vals += [eps_t, -eps_t]
+        rhs += [eps_t * (z0_j - z0_i)]
+        eq += 1
+
+    return (np.array(rows, dtype=int), np.array(cols_i, dtype=int),
+            np.array(cols_j, dtype=int), np.array(vals, dtype=float),
+            np.array(rhs, dtype=float))
+
+def _joint_damped_least_squares(Gs:list, ds:list, Ws:list,
+                                H_mats:list, h_vecs:list, models:list,
+                                neighbours:list,
+                                inversion_params:InversionParams) -> list:
+    """ Solve the damped least squares for many locations as one system.
+
+    Each location has its own F * m_est = f (see _damped_least_squares()).
+    These are put together into a block diagonal sparse matrix, and the
+    lateral smoothing equations between each pair of neighbouring locations
+    (_build_lateral_constraints()) are added on at the bottom.
+        [[ F_1              ]             [[ f_1 ]
+         [      F_2         ]   * m  =     [ f_2 ]
+         [           ...    ]              [ ... ]
+         [   lateral (L)    ]]             [  l  ]]
+    This is then solved in the least squares sense with scipy.sparse.linalg
+    (lsmr or lsqr), which only needs products with the sparse matrix.
+
+    Arguments:
+        Gs, ds, Ws, H_mats, h_vecs:
+            - lists (one entry per location) of the G, d, W, H_mat, h_vec
+              arguments to _damped_least_squares()
+        models:
+            - list of define_models.VsvModel, one per location
+            - Current models, needed to match up the depths of the model
+              parameters between neighbouring locations.
+        neighbours:
+            - list of tuples (i, j), as from _find_neighbours()
+        inversion_params:
+            - InversionParams
+
+    Returns:
+        new_models:
+            - list of (n_model_points, 1) np.array, one per location
+    """
+
+    n_model_points = [G.shape[1] for G in Gs]
+    offsets = np.concatenate(([0], np.cumsum(n_model_points)))
+
+    F_blocks = []
+    f_blocks = []
+    for G, d, W, H_mat, h_vec in zip(Gs, ds, Ws, H_mats, h_vecs):
+        sqrt_W = np.sqrt(W)
+        F_blocks += [scipy.sparse.csr_matrix(
+            np.vstack((np.matmul(sqrt_W, G), H_mat))
+        )]
+        f_blocks += [np.vstack((np.matmul(sqrt_W, d), h_vec)).flatten()]
+
+    lat_rows, lat_cols, lat_vals, lat_rhs = [], [], [], []
+    n_lat = 0
+    for i, j in neighbours:
+        rows, cols_i, cols_j, vals, rhs = _build_lateral_constraints(
+            models[i], models[j], inversion_params
+        )
+        cols = np.where(cols_i >= 0, offsets[i] + cols_i, offsets[j] + cols_j)
+        lat_rows += [rows + n_lat]
+        lat_cols += [cols]
+        lat_vals += [vals]
+        lat_rhs += [rhs]
+        n_lat += rhs.size
+
+    L = scipy.sparse.csr_matrix(
+        (np.concatenate(lat_vals + [[]]),
+         (np.concatenate(lat_rows + [[]]).astype(int),
+          np.concatenate(lat_cols + [[]]).astype(int))),
+        shape=(n_lat, offsets[-1]),
+    )
+    F = scipy.sparse.vstack((scipy.sparse.block_diag(F_blocks), L)).tocsr()
+    f = np.concatenate(f_blocks + lat_rhs)
+
+    if inversion_params.sparse_solver == 'lsqr':
+        solver = scipy.sparse.linalg.lsqr
+    else:
+        solver = scipy.sparse.linalg.lsmr
+    new_model = solver(
+        F, f, atol=inversion_params.sparse_tolerance,
+        btol=inversion_params.sparse_tolerance,
+        maxiter=10 * offsets[-1],
+    )[0]
+
+    return [new_model[offsets[i]:offsets[i + 1]][:, np.newaxis]
+            for i in range(len(Gs))]
+
+def _batched_inversion_iteration(all_model_params:list, models:list,
+                                 all_obs_constraints:list,
+                                 inversion_params:InversionParams
+                                 ) -> list:
+    """ Take a single Gauss-Newton step for a batch of locations.
+
+    As _inversion_iteration(), but the forward problem is run for every
+    location before the least squares for all locations are solved in a
+    single call to _batched_damped_least_squares().  inversion_params.solver
+    is passed on, so 'banded' still uses the banded solve for each location.
+
+    Arguments:
+        all_model_params:
+            - list of define_models.ModelParams (one per location)
+        models:
+            - list of define_models.VsvModel (one per location)
+        all_obs_constraints:
+            - list of (obs, std_obs, periods) tuples (one per location)
+        inversion_params:
+            - InversionParams
+
+    Returns:
+        models:
+            - list of define_models.VsvModel, updated by one iteration
+    """
 
-    for i in range(n_iterations):
-        # Still need to pass model_params as it has info on e.g. vp/vs ratio
-        # needed to convert from VsvModel to MINEOS card
-        model = _inversion_iteration(model_params, model, obs_constraints)
+    all_inputs = [
+        _build_least_squares_inputs(mp, m, oc) for mp, m, oc
+        in zip(all_model_params, models, all_obs_constraints)
+    ]
+    _, Gs, ds, Ws, H_mats, h_vecs, _ = zip(*all_inputs)
+    p_news = _batched_damped_least_squares(Gs, ds, Ws, H_mats, h_vecs,
+                                           inversion_params)
 
-    return model
+    return [
+        _update_model(p_new, m, mp) for p_new, m, mp
+        in zip(p_news, models, all_model_params)
+    ]
 
 def _inversion_iteration(model_params:define_models.ModelParams,
                          model:define_models.VsvModel,
                          obs_constraints:tuple,
+                         inversion_params:InversionParams=InversionParams(),
                          ) -> define_models.VsvModel:
     """ Run a single iteration of the least squares
     """
 
+    obs, std_obs, periods = obs_constraints
+
+    p, G, d, W, H_mat, h_vec, _ = _build_least_squares_inputs(
+        model_params, model, obs_constraints
+    )
+    # Perform inversion
+    # print('G: {}, p: {}, W: {}, d: {}, H_mat: {}, h_vec: {}'.format(
+    #     G.shape, p.shape, W.shape, d.shape, H_mat.shape, h_vec.shape
+    # ))
+    with timing.span('_damped_least_squares'):
+        p_new = _damped_least_squares(p, G, d, W, H_mat, h_vec,
+                                      inversion_params)
+
+    return _update_model(p_new, model, model_params), G, obs #p, G, d, W, H_mat, h_vec
+
+def _build_least_squares_inputs(model_params:define_models.ModelParams,
+                                model:define_models.VsvModel,
+                                obs_constraints:tuple,
+                                max_mineos_runs:int=None) -> tuple:
+    """ Run the forward problem and assemble the inputs to the least squares.
+
+    This is everything in an iteration before the actual inversion step, i.e.
+    running MINEOS for the predicted phase velocities and kernels, building
+    the partial derivatives matrix and data misfit, and building the
+    weighting and damping matrices.
+
+    Arguments:
+        model_params:
+            - define_models.ModelParams
+        model:
+            - define_models.VsvModel
+            - Current iteration of the velocity model
+        obs_constraints:
+            - tuple of (obs, std_obs, periods), as from
+              constraints.extract_observations()
+        max_mineos_runs:
+            - int
+            - Default value = None, i.e. mineos.RunParameters.max_run_N
+            - Give up if MINEOS needs to be restarted more than this many
+              times to reach the shortest period.
+
+    Returns:
+        p, G, d, W, H_mat, h_vec
+            - Inputs to _damped_least_squares(), with the constraint on the
+              Moho strength already removed from G and d.
+            - All None if MINEOS gave up (see max_mineos_runs).
+        n_mineos_runs:
+            - int
+            - Number of times MINEOS had to be run (i.e. restarts + 1) to
+              reach the shortest period (see mineos._run_mineos()).
+    """
 
     obs, std_obs, periods = obs_constraints
 
     # Build all of the inputs to the damped least squares
     # Run MINEOS to get phase velocities and kernels
-    mineos_model = define_models.convert_vsv_model_to_mineos_model(
-        model, model_params
-    )
+    with timing.span('convert_vsv_model_to_mineos_model'):
+        mineos_model = define_models.convert_vsv_model_to_mineos_model(
+            model, model_params
+        )
     # Can vary other parameters in MINEOS by putting them as inputs to this call
     # e.g. defaults include l_min, l_max; qmod_path; phase_or_group_velocity
     params = mineos.RunParameters(freq_max = 1000 / min(periods) + 1)
-    ph_vel_pred, kernels = mineos.run_mineos_and_kernels(
-        params, periods, model_params.id
-    )
+    if max_mineos_runs is not None:
+        params = params._replace(max_run_N=max_mineos_runs)
+    with timing.span('run_mineos'):
+        ph_vel_pred, l_run, n_mineos_runs = mineos._run_mineos(
+            params, periods, model_params.id
+        )
+    if n_mineos_runs > params.max_run_N:
+        return (None,) * 6 + (n_mineos_runs,)
+    with timing.span('run_kernels'):
+        kernels = mineos.run_kernels(
+            params, periods, ph_vel_pred, model_params.id, l_run
+        )
     kernels = kernels[kernels['z'] <= model_params.depth_limits[1]]
 
     # Assemble G, p, and d
-    G = partial_derivatives._build_partial_derivatives_matrix(
-        kernels, model, model_params
-    )
-    print('*****************')
+    with timing.span('_build_partial_derivatives_matrix'):
+        G = partial_derivatives._build_partial_derivatives_matrix(
+            kernels, model, model_params
+        )
 
     p = _build_model_vector(model, model_params.depth_limits)
     predictions = np.concatenate((ph_vel_pred, _predict_RF_vals(model)))
-    print('G: {}, p: {}, preds: {}'.format(
-        G.shape, p.shape, predictions.shape
-    ))
+    logger.debug('G: %s, p: %s, preds: %s',
+                 G.shape, p.shape, predictions.shape)
     d = _build_data_misfit_vector(obs, predictions, p, G)
 
     # Remove constraint on Moho strength
@@ -103,14 +1941,18 @@ def _inversion_iteration(model_params:define_models.ModelParams,
     std_obs = std_obs[:-2]#np.vstack((std_obs[:-2], std_obs[-1]))
 
     # Build all of the weighting functions for damped least squares
-    W, H_mat, h_vec = (
-        weights.build_weighting_damping(std_obs, p, model, model_params)
-    )
-    # Perform inversion
-    # print('G: {}, p: {}, W: {}, d: {}, H_mat: {}, h_vec: {}'.format(
-    #     G.shape, p.shape, W.shape, d.shape, H_mat.shape, h_vec.shape
-    # ))
-    p_new = _damped_least_squares(p, G, d, W, H_mat, h_vec)
+    with timing.span('build_weighting_damping'):
+        W, H_mat, h_vec = (
+            weights.build_weighting_damping(std_obs, p, model, model_params)
+        )
+
+    return p, G, d, W, H_mat, h_vec, n_mineos_runs
+
+def _update_model(p_new:np.array, model:define_models.VsvModel,
+                  model_params:define_models.ModelParams
+                  ) -> define_models.VsvModel:
+    """ Convert the least squares output to an evenly spaced VsvModel.
+    """
 
     model = _build_inversion_model_from_model_vector(p_new, model)
 
@@ -121,7 +1963,7 @@ def _inversion_iteration(model_params:define_models.ModelParams,
     return define_models.VsvModel(
             vsv, thickness, bi,
             define_models._find_depth_indices(thickness, model_params.depth_limits)
-           ), G, obs #p, G, d, W, H_mat, h_vec
+           )
 
 
 def _predict_RF_vals(model:define_models.VsvModel):
@@ -216,6 +2058,32 @@ def _build_inversion_model_from_model_vector(p:np.array,
     )
 
 
+def _has_negative_thickness(p:np.array,
+                            model:define_models.VsvModel) -> bool:
+    """ Check if a model vector would give any negative layer thicknesses.
+
+    Moving a boundary layer in _build_inversion_model_from_model_vector()
+    takes thickness from the layer below it, so a big enough step in t can
+    make either the thickness above the boundary layer or the one below it
+    negative, which MINEOS cannot do anything with.
+
+    Arguments:
+        p:
+            - (n_depth points + n_boundary_layers, 1) np.array
+            - Proposed model vector, [s; t]
+        model:
+            - define_models.VsvModel
+            - Current model (that p is an update to)
+
+    Returns:
+        bool
+    """
+
+    new_model = _build_inversion_model_from_model_vector(p, model)
+
+    return bool(np.any(new_model.thickness < 0))
+
+
 def _build_data_misfit_vector(data:np.array, prediction:np.array,
         m0:np.array, G:np.array):
     """ Calculate data misfit.
@@ -281,7 +2149,9 @@ def _build_data_misfit_vector(data:np.array, prediction:np.array,
     return data_misfit
 
 
-def _damped_least_squares(m0, G, d, W, H_mat, h_vec):
+def _damped_least_squares(m0, G, d, W, H_mat, h_vec,
+                          inversion_params:InversionParams=InversionParams(),
+                          lm_lambda:float=0., return_uncertainty:bool=False):
     """ Calculate the damped least squares, after Menke (2012).
 
     Least squares (Gauss-Newton solution):
@@ -356,16 +2226,60 @@ p, G, d, W, H_mat, h_vec
         i.e. m_est = (F' * F)^-1 * F' * f
                    = [(G' * We * G) + (ε^2 * D' * D) + (H' * H)]^-1
                      * [(G' * We * d) + (H' * h)]
+
+    To control the step length, we can also add Levenberg-Marquardt damping
+    (Marquardt, 1963; DOI: 10.1137/0111030) towards the current model, m0,
+    scaled by the diagonal of the normal equations so that the velocity and
+    thickness parameters are treated equally despite their different units:
+        m_est = [(F' * F) + λ * diag(F' * F)]^-1
+                * [(F' * f) + λ * diag(F' * F) * m0]
+    λ = 0 is the full Gauss-Newton step, and as λ increases, the step gets
+    shorter and turns towards the steepest descent direction.
+
+    If return_uncertainty is True, also return the model resolution and
+    posterior covariance (Menke, 2012; section 4.5).  Writing the generalised
+    inverse as F^-g = (F' * F)^-1 * F', which is split into the columns that
+    act on the data and the columns that act on the a priori constraints,
+        F^-g = [ F^-g_d,  F^-g_h ]
+    the model resolution matrix is
+        R = F^-g * [[ sqrt(We) * G ],  =  F^-g_d * sqrt(We) * G
+                    [      0       ]]
+    and the posterior covariance is propagated from the covariance of f,
+        C = F^-g * cov(f) * F^-g'
+          = F^-g_d * diag(σ) * F^-g_d' + F^-g_h * F^-g_h'
+    as the rows sqrt(We) * d have variance σ^2 / σ = σ, and the a priori
+    constraint equations are already scaled to have unit variance.  F^-g comes
+    from the same solve as m_est, so this costs very little extra.  Only the
+    bands near the diagonal are kept (see ModelUncertainty).
+
+    If inversion_params.solver is 'banded', this is instead solved by
+    _banded_damped_least_squares(), which gives the same m_est without ever
+    forming the dense normal equations.
     """
 
+    if inversion_params.solver == 'banded':
+        return _banded_damped_least_squares(G, d, W, H_mat, h_vec,
+                                            inversion_params, m0, lm_lambda,
+                                            return_uncertainty)
+
     F = np.vstack((np.matmul(np.sqrt(W), G), H_mat))
     f = np.vstack((np.matmul(np.sqrt(W), d), h_vec))
 
     Finv_denominator = np.matmul(F.T, F)
+    Ftf = np.matmul(F.T, f)
+    if lm_lambda:
+        lm_damping = lm_lambda * np.diag(Finv_denominator)
+        Finv_denominator = Finv_denominator + np.diag(lm_damping)
+        Ftf = Ftf + lm_damping[:, np.newaxis] * m0
     # x = np.linalg.lstsq(a, b) solves for x: ax = b, i.e. x = a \ b in MATLAB
-    Finv = np.linalg.lstsq(Finv_denominator, F.T, rcond=None)[0]
-
-    new_model = np.matmul(Finv, f)
+    if not return_uncertainty:
+        new_model = np.linalg.lstsq(Finv_denominator, Ftf, rcond=None)[0]
+    else:
+        # Solve for the generalised inverse and the model together
+        solution = np.linalg.lstsq(
+            Finv_denominator, np.hstack((F.T, Ftf)), rcond=None
+        )[0]
+        Finv, new_model = solution[:, :-1], solution[:, -1:]
     #
     # H = [D2; H1; H2; H3; H4; H6; H7; H8; H9]; % where H = D
     # h = [d2; h1; h2; h3; h4; h6; h7; h8; h9]; % h = D*mhat
@@ -378,4 +2292,278 @@ p, G, d, W, H_mat, h_vec
     # Finv = (F'*F+epsilon_0norm*eye(NF,NF))\F'; % least squares
     # mest_all = Finv*f;
 
+    if return_uncertainty:
+        n_data = G.shape[0]
+        return new_model, _build_model_uncertainty(
+            Finv[:, :n_data], Finv[:, n_data:], G, W,
+            inversion_params.n_offdiagonals,
+        )
+
+    return new_model
+
+def _build_model_uncertainty(Finv_d:np.array, Finv_h:np.array,
+                             G:np.array, W:np.array,
+                             n_offdiagonals:int) -> ModelUncertainty:
+    """ Calculate the bands of the resolution and covariance matrices.
+
+    See _damped_least_squares() for the maths.  Only the bands that are kept
+    are ever calculated, so this never forms an (n_model_points x
+    n_model_points) matrix.
+
+    Arguments:
+        Finv_d:
+            - (n_model_points, n_data_points) np.array
+            - Columns of the generalised inverse acting on the data.
+        Finv_h:
+            - (n_model_points, n_constraint_equations) np.array
+            - Columns of the generalised inverse acting on the constraints.
+        G:
+            - (n_data_points, n_model_points) np.array
+        W:
+            - (n_data_points, n_data_points) np.array
+            - Diagonal data error weighting matrix, 1 / σ.
+        n_offdiagonals:
+            - int
+
+    Returns:
+        ModelUncertainty
+    """
+
+    sqrt_W = np.sqrt(W)
+    sigma = 1 / np.diag(W)
+
+    resolution = np.vstack([
+        _product_diagonal(Finv_d, np.matmul(sqrt_W, G).T, k)
+        for k in range(-n_offdiagonals, n_offdiagonals + 1)
+    ])
+    Finv_d_scaled = Finv_d * np.sqrt(sigma)
+    covariance = np.vstack([
+        _product_diagonal(Finv_d_scaled, Finv_d_scaled, k)
+        + _product_diagonal(Finv_h, Finv_h, k)
+        for k in range(n_offdiagonals + 1)
+    ])
+
+    return ModelUncertainty(resolution=resolution, covariance=covariance)
+
+def _product_diagonal(A:np.array, B:np.array, k:int) -> np.array:
+    """ Find the kth diagonal of A * B' without calculating A * B'.
+
+    Arguments:
+        A, B:
+            - (n, m) np.array
+        k:
+            - int
+            - Diagonal (positive above the main diagonal).
+
+    Returns:
+        diagonal:
+            - (n, ) np.array
+            - diagonal[i] = (A * B')[i, i + k], padded with NaN where i + k
+              is out of range.
+    """
+
+    n = A.shape[0]
+    diagonal = np.full(n, np.nan)
+    if k >= 0:
+        diagonal[:n - k] = np.sum(A[:n - k] * B[k:], axis=1)
+    else:
+        diagonal[-k:] = np.sum(A[-k:] * B[:n + k], axis=1)
+
+    return diagonal
+
+def _banded_damped_least_squares(G, d, W, H_mat, h_vec,
+                                 inversion_params:InversionParams,
+                                 m0=None, lm_lambda:float=0.,
+                                 return_uncertainty:bool=False):
+    """ Solve the damped least squares, exploiting the banded a priori terms.
+
+    The normal equations solved in _damped_least_squares() are
+        [(G' * We * G) + (H' * H)] * m_est = (G' * We * d) + (H' * h)
+
+    All of our a priori constraints (e.g. weights._build_smoothing_constraints,
+    weights._build_constraint_damp_zero_gradient) only link adjacent depth
+    nodes, so H' * H is banded with a very narrow bandwidth.  In contrast,
+    G' * We * G is dense, but G only has (n_periods + n_RF) rows, so this term
+    is low rank.  Writing U = (sqrt(We) * G)', we have
+        N = A + U * U'          where A = H' * H (banded)
+    and by the Woodbury identity
+        N^-1 = A^-1 - A^-1 * U * (I + U' * A^-1 * U)^-1 * U' * A^-1
+    Here, A is factorised once (banded Cholesky, scipy.linalg.cholesky_banded)
+    and everything else is either a banded solve or a tiny
+    (n_data_points x n_data_points) dense solve.
+
+    A = H' * H is not positive definite (e.g. the boundary layer thickness
+    parameters are unconstrained by H, and there is no constraint across the
+    boundary layers themselves), so we add a small shift to the diagonal,
+        A = H' * H + δI,    δ = inversion_params.banded_shift * max(diag(N))
+    and then remove the resulting bias with a few steps of iterative
+    refinement against the unshifted N.
+
+    Levenberg-Marquardt damping, λ * diag(N), is diagonal so just goes
+    straight into A.
+
+    The generalised inverse for the resolution and covariance (see
+    _damped_least_squares()) is found with the same factorisation,
+        F^-g_d = N^-1 * U           F^-g_h = N^-1 * H'
+    which is a banded solve per column.
+
+    Arguments:
+        G:
+            - (n_data_points, n_model_points) np.array
+            - Partial derivatives matrix.
+        d:
+            - (n_data_points, 1) np.array
+            - Data misfit vector, as from _build_data_misfit_vector().
+        W:
+            - (n_data_points, n_data_points) np.array
+            - Diagonal data error weighting matrix, We.
+        H_mat:
+            - (n_constraint_equations, n_model_points) np.array
+            - A priori constraints matrix, H in H * m = h.
+        h_vec:
+            - (n_constraint_equations, 1) np.array
+            - A priori constraints vector, h in H * m = h.
+        inversion_params:
+            - InversionParams
+            - Sets the diagonal shift and number of refinement steps.
+        m0:
+            - (n_model_points, 1) np.array
+            - Current model, only needed if lm_lambda is non-zero.
+        lm_lambda:
+            - float
+            - Levenberg-Marquardt damping.
+        return_uncertainty:
+            - bool
+            - If True, also return the ModelUncertainty.
+
+    Returns:
+        new_model:
+            - (n_model_points, 1) np.array
+            - Same as the output from the dense _damped_least_squares().
+        uncertainty:
+            - ModelUncertainty (only if return_uncertainty)
+    """
+
+    sqrt_W = np.sqrt(W)
+    U = np.matmul(sqrt_W, G).T
+    H = scipy.sparse.csr_matrix(H_mat)
+    rhs = np.matmul(U, np.matmul(sqrt_W, d)) + H.T.dot(h_vec)
+
+    # Pack H' * H into upper banded storage, ab[u + i - j, j] = A[i, j]
+    HtH = (H.T.dot(H)).tocoo()
+    HtH.sum_duplicates()
+    upper = HtH.row <= HtH.col
+    rows, cols, vals = HtH.row[upper], HtH.col[upper], HtH.data[upper]
+    n_bands = int(np.max(cols - rows)) if vals.size else 0
+    n = HtH.shape[0]
+    ab = np.zeros((n_bands + 1, n))
+    ab[n_bands + rows - cols, cols] = vals
+
+    diag_N = ab[n_bands, :] + np.sum(U ** 2, axis=1)
+    lm_damping = lm_lambda * diag_N
+    if lm_lambda:
+        rhs = rhs + lm_damping[:, np.newaxis] * m0
+    shift = inversion_params.banded_shift * max(np.max(diag_N), 1e-30)
+    ab[n_bands, :] += shift + lm_damping
+    cho_A = scipy.linalg.cholesky_banded(ab)
+
+    # Small dense (n_data_points x n_data_points) capacitance matrix
+    Ainv_U = scipy.linalg.cho_solve_banded((cho_A, False), U)
+    capacitance = np.eye(U.shape[1]) + np.matmul(U.T, Ainv_U)
+
+    def solve_shifted(b):
+        Ainv_b = scipy.linalg.cho_solve_banded((cho_A, False), b)
+        return Ainv_b - np.matmul(
+            Ainv_U, np.linalg.solve(capacitance, np.matmul(U.T, Ainv_b))
+        )
+
+    def multiply_N(x):
+        return (H.T.dot(H.dot(x)) + np.matmul(U, np.matmul(U.T, x))
+                + lm_damping[:, np.newaxis] * x)
+
+    def solve(b):
+        x = solve_shifted(b)
+        for i in range(inversion_params.banded_refinement_steps):
+            x += solve_shifted(b - multiply_N(x))
+        return x
+
+    new_model = solve(rhs)
+
+    if return_uncertainty:
+        return new_model, _build_model_uncertainty(
+            solve(U), solve(H.T.toarray()), G, W,
+            inversion_params.n_offdiagonals,
+        )
+
     return new_model
+
+def _batched_damped_least_squares(Gs:list, ds:list, Ws:list,
+                                  H_mats:list, h_vecs:list,
+                                  inversion_params:InversionParams=InversionParams(),
+                                  ) -> list:
+    """ Solve the damped least squares for many locations at once.
+
+    Each location has its own F * m_est = f (see _damped_least_squares()).
+    For a grid of locations, these are all small, so the time is dominated by
+    the overhead of each call rather than by the arithmetic.  Here, all of the
+    F and f are stacked into (n_locations, n_rows, n_model_points) arrays,
+    and F' * F * m_est = F' * f is solved with a single (stacked)
+    np.linalg.solve.
+
+    Locations do not need to have exactly the same number of data or model
+    parameters.  Shorter F and f are padded with rows of zeros (which do not
+    change F' * F or F' * f), and any padded model parameters are pinned to
+    zero by setting their diagonal in F' * F to 1.
+
+    Note that, unlike the dense _damped_least_squares(), which uses lstsq,
+    this requires F' * F to be non-singular for every location.
+
+    If inversion_params.solver is 'banded', each location is instead solved
+    in turn by _banded_damped_least_squares().  That never forms F' * F, so
+    there is nothing to stack.
+
+    Arguments:
+        Gs, ds, Ws, H_mats, h_vecs:
+            - lists (one entry per location) of the G, d, W, H_mat, h_vec
+              arguments to _damped_least_squares()
+        inversion_params:
+            - InversionParams
+            - Default value = InversionParams(), i.e. the dense solver
+
+    Returns:
+        new_models:
+            - list of (n_model_points, 1) np.array, one per location
+    """
+
+    if inversion_params.solver == 'banded':
+        return [
+            _banded_damped_least_squares(G, d, W, H_mat, h_vec,
+                                         inversion_params)
+            for G, d, W, H_mat, h_vec in zip(Gs, ds, Ws, H_mats, h_vecs)
+        ]
+
+    n_locs = len(Gs)
+    n_model_points = [G.shape[1] for G in Gs]
+    n_rows = [G.shape[0] + H.shape[0] for G, H in zip(Gs, H_mats)]
+
+    F = np.zeros((n_locs, max(n_rows), max(n_model_points)))
+    f = np.zeros((n_locs, max(n_rows), 1))
+    for i in range(n_locs):
+        sqrt_W = np.sqrt(Ws[i])
+        F[i, :n_rows[i], :n_model_points[i]] = np.vstack((
+            np.matmul(sqrt_W, Gs[i]), H_mats[i]
+        ))
+        f[i, :n_rows[i]] = np.vstack((np.matmul(sqrt_W, ds[i]), h_vecs[i]))
+
+    Ft = np.swapaxes(F, 1, 2)
+    FtF = np.matmul(Ft, F)
+    Ftf = np.matmul(Ft, f)
+
+    # Pin any padded model parameters to zero
+    for i in range(n_locs):
+        padded = np.arange(n_model_points[i], max(n_model_points))
+        FtF[i, padded, padded] = 1.
+
+    new_models = np.linalg.solve(FtF, Ftf)
+
+    return [new_models[i, :n_model_points[i]] for i in range(n_locs)]
@@ -0,0 +1,183 @@
+""" Logging for the inversion.
+
+All of the modules in util report what they are doing through the standard
+logging module, each with its own logger (logging.getLogger(__name__)), so
+everything comes under the 'util' logger.  Nothing is shown below WARNING
+until setup_logging() is called, so the inversion is quiet by default - call
+setup_logging() at the start of a script to see progress.
+
+When running many locations in parallel, it helps to know which location a
+log message came from.  Anything set with the context() context manager
+(e.g. model id and location) is added to every log message from inside the
+block.  With json_lines=True, each message is written as one line of JSON
+so the logs from a whole batch can be gathered up and searched afterwards.
+
+Classes:
+    1. JsonLinesFormatter
+        - Format log records as single lines of JSON
+Functions:
+    1. setup_logging(level='INFO', log_file:str='', json_lines:bool=False):
+        - Set the level and output for all of the util loggers
+    2. context(**kwargs):
+        - Context manager to label all log messages inside the block
+    3. log_progress(logger:logging.Logger, key:str, message:str, *args,
+                    min_interval:float=10., force:bool=False):
+        - Log a progress message, but no more often than every min_interval
+"""
+
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import time
+
+
+_log_context = contextvars.ContextVar('log_context', default={})
+_last_progress = {}
+
+
+# =============================================================================
+# Set up classes for commonly used variables
+# =============================================================================
+
+class _ContextFilter(logging.Filter):
+    """ Add the current context (see context()) to every log record.
+    """
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        record.context = _log_context.get()
+        return True
+
+class JsonLinesFormatter(logging.Formatter):
+    """ Format log records as single lines of JSON.
+
+    Each line has the time, level, logger name and message, plus everything
+    in the current context (see context()).
+    """
+
+    def format(self, record:logging.LogRecord) -> str:
+        line = {
+            'time': datetime.datetime.fromtimestamp(record.created)
+                        .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+        }
+        line.update(getattr(record, 'context', {}))
+        line['message'] = record.getMessage()
+        if record.exc_info:
+            line['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(line, default=str)
+
+
+# =============================================================================
+#       Set up the loggers
+# =============================================================================
+
+def setup_logging(level='INFO', log_file:str='', json_lines:bool=False):
+    """ Set the level and output for all of the util loggers.
+
+    Calling this again replaces the previous set up.
+
+    Arguments:
+        level:
+            - str or int
+            - Default value = 'INFO'
+            - Minimum level of messages to show, as in the logging module.
+              'DEBUG' includes e.g. every MINEOS restart; 'WARNING' is
+              effectively a quiet mode.
+        log_file:
+            - str
+            - Default value = ''
+            - Path to append log messages to.  If this is an empty string,
+              messages go to stderr.
+        json_lines:
+            - bool
+            - Default value = False
+            - If True, write each message as a line of JSON (see
+              JsonLinesFormatter).  Otherwise, write them as plain text,
+              labelled with the current context.
+    """
+
+    logger = logging.getLogger('util')
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+
+    if log_file:
+        if os.path.dirname(log_file):
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        handler = logging.FileHandler(log_file)
+    else:
+        handler = logging.StreamHandler()
+
+    if json_lines:
+        handler.setFormatter(JsonLinesFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(name)s %(context)s: %(message)s'
+        ))
+    handler.addFilter(_ContextFilter())
+
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+@contextlib.contextmanager
+def context(**kwargs):
+    """ Label all log messages from inside the block with kwargs.
+
+    Contexts can be nested, with the inner values added to the outer ones.
+
+    Usage:
+        with logs.context(id=model_params.id, location=location):
+            ...
+
+    Arguments:
+        **kwargs:
+            - Labels for the log messages, e.g. model id, location.  These
+              should be JSON serialisable.
+    """
+
+    new_context = dict(_log_context.get())
+    new_context.update(kwargs)
+    token = _log_context.set(new_context)
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+def log_progress(logger:logging.Logger, key:str, message:str, *args,
+                 min_interval:float=10., force:bool=False):
+    """ Log a progress message at INFO, but not too often.
+
+    With hundreds of locations or trials, logging every update is a lot of
+    output for not much information.  This only logs a message if it has
+    been at least min_interval since the last progress message with the
+    same key (in this process).
+
+    Arguments:
+        logger:
+            - logging.Logger
+        key:
+            - str
+            - Label for this set of progress messages.
+        message, *args:
+            - As logger.info()
+        min_interval:
+            - float
+            - Units:    seconds
+            - Default value = 10.
+        force:
+            - bool
+            - Default value = False
+            - If True, log the message anyway (e.g. for the final update).
+    """
+
+    now = time.monotonic()
+    if force or now - _last_progress.get(key, -float('inf')) >= min_interval:
+        _last_progress[key] = now
+        logger.info(message, *args)
@@ -24,6 +24,7 @@ Functions:
 
 #import collections
 import typing
+import logging
 import numpy as np
 import subprocess
 import os
@@ -31,6 +32,9 @@ import glob
 import pandas as pd
 
 from util import define_models
+from util import timing
+
+logger = logging.getLogger(__name__)
 
 
 # =============================================================================
@@ -173,11 +177,13 @@ def run_kernels(parameters:RunParameters, periods:np.array, ph_vel:np.array,
         except:
             pass
 
-    execfile = _write_kernel_files(parameters, periods, save_name, n_runs)
-    _run_execfile(execfile)
+    with timing.span('kernel_run'):
+        execfile = _write_kernel_files(parameters, periods, save_name, n_runs)
+        _run_execfile(execfile)
 
-    kernels = _read_kernels(save_name, periods)
-    kernels = _correct_kernels(kernels, save_name, ph_vel, periods)
+    with timing.span('read_kernels'):
+        kernels = _read_kernels(save_name, periods)
+        kernels = _correct_kernels(kernels, save_name, ph_vel, periods)
     kernels['type'] = parameters.Rayleigh_or_Love
 
     return kernels
@@ -187,6 +193,31 @@ def run_mineos(parameters:RunParameters, periods:np.array,
                card_name:str) -> np.array:
     """
     Given a card_model_name (MINEOS card saved as a text file), run MINEOS.
+
+    Returns the phase velocities and the number of (partially) successful
+    MINEOS runs, which is needed by run_kernels().
+    """
+
+    phase_vel, l_run, _ = _run_mineos(parameters, periods, card_name)
+
+    return phase_vel, l_run
+
+def _run_mineos(parameters:RunParameters, periods:np.array,
+                card_name:str) -> (np.array, int, int):
+    """ Run MINEOS as run_mineos(), also counting how many times it was run.
+
+    Returns:
+        phase_vel:
+            - (n_periods, ) np.array
+            - Units:    km/s
+        l_run:
+            - int
+            - Number of (partially) successful MINEOS runs.
+        n_runs:
+            - int
+            - Total number of MINEOS runs, i.e. restarts + 1.  If this is
+              more than parameters.max_run_N, MINEOS gave up before getting
+              down to the shortest period.
     """
 
     save_name = 'output/{0}/{0}'.format(card_name)
@@ -212,36 +243,43 @@ def run_mineos(parameters:RunParameters, periods:np.array,
     l_run = 0
     l_min = parameters.l_min
     while min_calculated_period > min_desired_period:
-        print('Run {:3.0f}, min. l {:3.0f}'.format(n_runs, l_min))
-        execfile = _write_run_mineos(parameters, save_name, l_run, l_min)
-        _run_execfile(execfile)
+        logger.debug('MINEOS run %3.0f, min. l %3.0f', n_runs, l_min)
+        with timing.span('eig_run'):
+            execfile = _write_run_mineos(parameters, save_name, l_run, l_min)
+            _run_execfile(execfile)
 
         # Find parameters for re-running
         # Note l_run will only increase if the above run was at least
         # partially successful - c.f. n_runs which increments every time (below)
-        min_calculated_period, l_min, l_run = _check_mineos_run(
-            save_name, l_run, l_min, parameters, min_calculated_period
-        )
+        with timing.span('check_run'):
+            min_calculated_period, l_min, l_run = _check_mineos_run(
+                save_name, l_run, l_min, parameters, min_calculated_period
+            )
 
         n_runs += 1
         if n_runs > parameters.max_run_N:
-            print('Too many tries! Breaking MINEOS eig loop')
+            logger.warning('Too many tries! Breaking MINEOS eig loop after'
+                           ' %d runs (min. period %.1f s)',
+                           n_runs, min_calculated_period)
             break
 
     # Recover eig files from mutliple runs
     for run in range(l_run):
         # l_run is the number of files that need fixing (number of (partially)
         # successful MINEOS runs).  These are named xxx_0, ..., xxx_[l_run - 1].
-        execfile = _write_eig_recover(parameters, save_name, run)
-        _run_execfile(execfile)
+        with timing.span('eig_recover'):
+            execfile = _write_eig_recover(parameters, save_name, run)
+            _run_execfile(execfile)
 
     # Apply Q correction to velocities
-    execfile, qfile = _write_q_correction(parameters, save_name, l_run)
-    _run_execfile(execfile)
+    with timing.span('q_correction'):
+        execfile, qfile = _write_q_correction(parameters, save_name, l_run)
+        _run_execfile(execfile)
 
-    phase_vel = _read_qfile(qfile, periods)
+    with timing.span('read_qfile'):
+        phase_vel = _read_qfile(qfile, periods)
 
-    return phase_vel, l_run
+    return phase_vel, l_run, n_runs
 
 
 
@@ -393,7 +431,7 @@ def _read_ascfiles(ascfiles:list):
             output = output.append(pd.read_csv(ascfile, sep='\s+',
                                    skiprows=n_lines, header=None))
         except:
-            print(ascfile, ' is empty.')
+            logger.debug('%s is empty.', ascfile)
 
     if output.empty:
         return output
@@ -455,7 +493,6 @@ def _write_q_correction(params, save_name, l_run):
     fid.write('{}/mineos_qcorrectphv << ! >> {}\n'.format(params.bin_path, logfile))
     fid.write('{0}\n{1}\n'.format(params.qmod_path, qfile))
     for run in range(l_run):
-        print(run)
         fid.write('{}_{}.eig_fix\n'.format(save_name, run))
         if run == 0:
             fid.write('y\n')
@@ -81,6 +81,7 @@ G matrix by a simple matrix multiplication.
 """
 
 import typing
+import logging
 import numpy as np
 import numpy.matlib as npmatlib
 import pandas as pd
@@ -88,6 +89,8 @@ import pandas as pd
 from util import define_models
 from util import constraints
 
+logger = logging.getLogger(__name__)
+
 def _build_partial_derivatives_matrix(kernels:pd.DataFrame,
                                       model:define_models.VsvModel,
                                       model_params:define_models.ModelParams):
@@ -96,7 +99,7 @@ def _build_partial_derivatives_matrix(kernels:pd.DataFrame,
 
     g_sw = _build_partial_derivatives_matrix_sw(kernels, model, model_params)
     g_rf = _build_partial_derivatives_matrix_rf(model, model_params)
-    print(g_sw.shape, g_rf.shape)
+    logger.debug('G_sw: %s, G_rf: %s', g_sw.shape, g_rf.shape)
 
     return np.vstack((
         g_sw,
@@ -193,13 +196,16 @@ def _integrate_dc_dvsv_dvsv_dp_indepth(G_MINEOS, depth, dm_dp_mat):
         ==  1/2 (x_i+1 - x_i) (f(x_i+1) + f(x_i))
     Then the sum comes from just adding off of these pointwise integrals).
 
-    Note: this can be explicitly calculated in a (slow) loop.  Given that in the
-    depth range of interest (i.e. everywhere that dm/dp is non-zero), the
-    MINEOS card is sampled at a constant depth interval (if using the default
-    values, this is 2 km:  step = model_params.min_layer_thickness / 3), this
-    integral is really close to (fast!) matrix multiplication, where every
-    value in the matrix just needs to be multipled by the change in depth
-    and have 1/2 * (f(x_0) + f(x_n)) subtracted from it.
+    Note: this can be explicitly calculated in a (slow) loop.  Collecting
+    the terms for each depth point instead, every f(x_i) is multiplied by
+    half of the distance between its neighbours,
+            w_i = 1/2 (x_i+1 - x_i-1)   (or 1/2 (x_1 - x_0), 1/2 (x_n - x_n-1)
+                                         at the ends)
+    so the integral is just a (fast!) matrix multiplication with the kernels
+    scaled by these trapezoidal weights.  This works whether the MINEOS card
+    is sampled at a constant depth interval (by default, 2 km: step =
+    model_params.min_layer_thickness / 3) or not (e.g. with the adaptive
+    card spacing in define_models.convert_vsv_model_to_mineos_model()).
 
     Arguments:
         G_MINEOS:
@@ -248,30 +254,36 @@ def _integrate_dc_dvsv_dvsv_dp_indepth(G_MINEOS, depth, dm_dp_mat):
     #                 )
     #             )
 
-    # Speeding things up, given dz is constant
-    G_inversion_model = np.matmul(G_MINEOS, dm_dp_mat)
-    G_inversion_model *= np.diff(depth[:2]) # multiply by depth step, dx
-    i_corr = []
-    for i_param in range(G_MINEOS.shape[1] // len(depth)):
-        param_inds = list(range(i_param * len(depth),
-                                (i_param + 1) * len(depth))
-                          )
-        i_corr += [param_inds[0], param_inds[-1]]
-
-    for period in range(G_inversion_model.shape[0]):
-        for mod_param in range(G_inversion_model.shape[1]):
-            G_inversion_model[period, mod_param] -= (
-                1/2 * np.diff(depth[:2])
-                * (
-                    sum(G_MINEOS[period, i_corr[::2]]
-                    * dm_dp_mat[i_corr[::2], mod_param])
-                    + sum(G_MINEOS[period, i_corr[1::2]]
-                    * dm_dp_mat[i_corr[1::2], mod_param])
-                )
-            )
+    # Speeding things up, using trapezoidal weights at each depth
+    G_inversion_model = np.matmul(
+        G_MINEOS * np.tile(_trapezoid_weights(depth),
+                           G_MINEOS.shape[1] // len(depth)),
+        dm_dp_mat
+    )
 
     return G_inversion_model
 
+def _trapezoid_weights(x:np.array) -> np.array:
+    """ Weights such that Σ w_i f(x_i) is the trapezoidal integral of f(x).
+
+    Arguments:
+        x:
+            - (n_points, ) np.array
+            - Sample points, in order (need not be evenly spaced).
+
+    Returns:
+        w:
+            - (n_points, ) np.array
+            - Same sign as x[-1] - x[0].
+    """
+
+    dx = np.diff(x)
+    w = np.zeros(len(x))
+    w[:-1] += dx / 2
+    w[1:] += dx / 2
+
+    return w
+
 def _build_MINEOS_G_matrix(kernels:pd.DataFrame):
     """ Assemble the G matrix from MINEOS.
 
@@ -9,6 +9,8 @@ import pandas as pd
 import xarray as xr
 import matplotlib.pyplot as plt
 
+from util import constraints
+
 
 
 
@@ -239,7 +241,7 @@ def _get_topo(lats, lons):
     return np.array(topo) / 1000 # in km
 
 
-def interpolate_lit_model(ref, z, lats, lons):
+def interpolate_lit_model(ref, z, lats, lons, method='nearest'):
     """ Load a literature Vs model on a given grid of z, latitude and longitude
 
     Arguments:
@@ -256,6 +258,9 @@ def interpolate_lit_model(ref, z, lats, lons):
         lons:
             - (n_longitude_points) np.array
             - longitude vector
+        method:
+            - string
+            - 'nearest' or 'trilinear' (see constraints.regrid_lit_model)
 
     Returns:
         vs_a:
@@ -263,54 +268,22 @@ def interpolate_lit_model(ref, z, lats, lons):
             - cube of Vs data from the model denoted by 'ref'
 
     """
-    ds = load_literature_vel_model(ref)
-    z_a = ds.depth.values
-    lats_a = ds.latitude.values
-    lons_a = ds.longitude.values
-    if lons_a[0] > 0:
-        lons_a -= 360
-
-    vs_a = np.zeros((len(lats), len(lons), len(z)))
-    ila = 0
-    ilo = 0
-    for lat in lats:
-        for lon in lons:
-
-            i_lat = np.argmin(np.abs(lats_a - lat))
-            i_lon = np.argmin(np.abs(lons_a - lon))
-            if abs(lats_a[i_lat] - lat) > 1:
-                print('Nearest latitude is {}'.format(lats_a[i_lat]))
-            if abs(lons_a[i_lon] - lon) > 1:
-                print('Nearest longitude is {}'.format(lons_a[i_lon]))
-
-            vs_a[ila, ilo, :] = np.interp(z, z_a, ds.vs.values[:, i_lat, i_lon])
-
-            ilo += 1
-        ila += 1
-        ilo = 0
-
-    return vs_a
+    return constraints.regrid_lit_model(
+        load_literature_vel_model(ref), z, lats, lons, method
+    )
 
 def load_literature_vel_model(ref:str):
     """ Load a published Vs model as a dataset.
 
-    IRIS EMC has many models of the WUS avaiable to download.  These are models
-    including surface wave data with absolute Vs values (note that some were still
-    reported as dVs with a given reference model).
-
-    Models listed:
-        SR16:       Shen & Ritzwoller, 2016     - fits Moho Ps RFs
-        S15:        Schmandt et al., 2015       - fits Moho Ps RFs
-        P14:        Porrit et al., 2014         - reported as dVs relative to WUS
-        P15:        Porter et al., 2015
-        F18:        Fichtner et al., 2018
-        Y14:        Yuan et al., 2014           - no Vs modelled < 50 km depth
-        C15:        Chai et al., 2015           - includes fitting RFs throughout
+    As constraints.load_literature_vel_model(), which lists the Vs models,
+    with one extra model:
+        DE08:       Dalton & Ekstrom, 2008      - Q model, not Vs
 
     Arguments:
         ref:
             - string
-            - one of the shorthands listed above denoting which model to load
+            - DE08, or any of the shorthands in
+              constraints.load_literature_vel_model()
     Returns:
         ds
             - xarray dataset with at least the following fields
@@ -321,93 +294,10 @@ def load_literature_vel_model(ref:str):
 
     """
 
-    if ref == 'SR16':
-        nm = 'data/earth_models/US.2016.nc'
-        url = 'https://doi.org/10.17611/DP/EMCUS2016'
-        ref = 'Shen & Ritzwoller, 2016 (10.1002/2016JB012887)'
-        v_field = 'vsv'
-        ref_v = np.array([])
-    elif ref == 'S15':
-        nm = 'data/earth_models/US-CrustVs-2015_kmps.nc'
-        url = 'https://doi.org/10.17611/DP/EMCUSCRUSTVS2015'
-        ref = 'Schmandt et al., 2015 (10.1002/2015GL066593)'
-        v_field = 'vs'
-        ref_v = np.array([])
-    elif ref == 'P14':
-        nm = 'data/earth_models/DNA13_percent.nc'
-        url = 'https://doi.org/10.17611/DP/9991615'
-        ref = 'Porrit et al., 2014 (10.1016/j.epsl.2013.10.034)'
-        v_field = 'vsvj'
-        ref_v = np.array([ # WUS model, Pollitz (2008) Fig. 17: 10.1029/2007JB005556
-            [2.40, 0], [2.45, 0.5], [3.18, 4.5], [3.20, 18], [3.90, 20],
-            [3.90, 33], [4.30, 35], [4.30, 60], [4.26, 65], [4.26, 215],
-            [4.65, 220], [4.65, 240], [4.74, 242], [4.74, 300]
-            ])
-    elif ref == 'P15':
-        nm = 'data/earth_models/US-Crust-Upper-mantle-Vs.Porter.Liu.Holt.2015_kmps.nc'
-        url = 'https://doi.org/10.17611/DP/EMCUCUMVPLH15MLROWCU'
-        ref = 'Porter et al., 2015 (10.1002/2015GL066950)'
-        v_field = 'vs'
-        ref_v = np.array([])
-    elif ref == 'F18':
-        nm = 'data/earth_models/csem-north-america-2019.12.01.nc'
-        url = 'https://doi.org/10.17611/dp/emccsemnamatl20191201'
-        ref = 'Fichtner et al., 2018 (10.1029/2018GL077338)'
-        v_field = 'vsv'
-        ref_v = np.array([])
-    elif ref == 'Y14':
-        nm = 'data/earth_models/SEMum-NA14_kmps.nc'
-        url = 'https://doi.org/10.17611/dp/EMCSEMUMNA14'
-        ref = 'Yuan et al., 2014 (10.1016/j.epsl.2013.11.057)'
-        v_field = 'Vs'
-        ref_v = np.array([])
-    elif ref == 'C15':
-        nm = 'data/earth_models/WUS-CAMH-2015.nc'
-        url = 'https://doi.org/10.17611/dp/EMCWUSCAMH2015'
-        ref = 'Chai et al., 2015 (10.1002/2015GL063733)'
-        v_field = 'vs'
-        ref_v = np.array([])
-    elif ref == 'DE08':
+    if ref == 'DE08':
         return load_Dalton_Ekstrom()
 
-
-    else:
-        print('Unknown reference - try again')
-        return
-
-
-    try:
-        ds = xr.open_dataset(nm)
-    except:
-
-        print(
-            'You need to download the {} model from'.format(ref)
-            + ' IRIS EMC\n\t{} \nand save to \n\t{}'.format(url, nm)
-        )
-        return
-
-    if ref_v.any(): # Convert perturbations to absolute values
-        imax = np.argmax(ds.depth.values > ref_v[-1, 1])
-        ref_vz = np.interp(ds.depth.values[:imax], ref_v[:, 1], ref_v[:, 0])
-        dvs = ds[v_field].values[:imax, :, :]
-        vs = np.zeros_like(dvs)
-        for ila in range(dvs.shape[1]):
-            for ilo in range(dvs.shape[2]):
-                vs[:, ila, ilo] = (1 + (dvs[:, ila, ilo] / 100)) * ref_vz
-
-        ds = xr.Dataset(
-            {'vs': (['depth', 'latitude', 'longitude'],  vs)},
-            coords={'longitude': (['longitude'], ds.longitude.values),
-                    'latitude': (['latitude'], ds.latitude.values),
-                    'depth': ds.depth.values[:imax],
-                    }
-        )
-        v_field = 'vs'
-
-    if v_field != 'vs':
-        ds['vs'] = ds[v_field]
-
-    return ds
+    return constraints.load_literature_vel_model(ref)
 
 def load_Dalton_Ekstrom():
     depths = np.arange(50, 401, 50)
@@ -462,15 +462,8 @@ def plot_phase_vels_margins():
         for lon in [-114, -113, -108, -107]:
             locs += [(lat, lon)]
 
-    phv_all = constraints._load_observed_sw_constraints()
-
-    i = 0
-    for loc in locs:
-        a = constraints._extract_phase_vels(loc, (1, phv_all))
-        if i == 0:
-            phv = np.zeros((len(a), len(locs)))
-        phv[:, i] = a.ph_vel.values
-        i += 1
+    store = constraints.load_surface_wave_store()
+    phv = constraints.query_surface_wave_store(store, locs)[0].T
     cp_outline = pd.read_csv('data/earth_models/CP_outline.csv').values
     cp_outline = np.vstack((cp_outline, cp_outline[0, :]))
 
@@ -494,7 +487,7 @@ def plot_phase_vels_margins():
         st_y = float((loc[0] - yl[0])/(np.diff(yl))) + 0.01
 
         aa = f.add_axes([st_x, st_y, 0.18, 0.15])
-        _plot_c_one_colour(phv, a.period, i, p, aa)
+        _plot_c_one_colour(phv, store.periods, i, p, aa)
         aa.set_axis_off()
 
         i += 1
@@ -0,0 +1,195 @@
+""" Lightweight timing of the stages of each inversion iteration.
+
+Most of the wall time in an inversion iteration goes on writing the MINEOS
+card, running MINEOS (including any restarts), reading its output, building
+the partial derivatives matrix, and solving the least squares.  To see how the
+time is split up, these stages are wrapped in span() calls, which time them
+with time.perf_counter().  Spans can be nested, and are named by joining the
+names of all enclosing spans with '/', e.g. 'forward/run_mineos/eig_run'.
+
+The time spent in each span (and how many times it was entered) is added up
+until write_timing_record() is called, which appends everything so far as a
+single line of JSON to a log file, and then starts the totals again.  In the
+inversion, this is done once per iteration (see
+inversion.InversionParams.timing_log).  For more detail, profile() will run
+cProfile over a block of code.
+
+The span totals are kept at module level, so each process (e.g. each worker
+in ensemble.run_monte_carlo_ensemble()) keeps its own.
+
+Functions:
+    1. span(name:str):
+        - Context manager to time a (named) block of code
+    2. collect_spans() -> dict:
+        - Return the span totals so far, and reset them
+    3. write_timing_record(timing_log:str, **kwargs):
+        - Append the span totals so far (and any other info) to a JSON lines file
+    4. load_timing_records(timing_log:str) -> list:
+        - Read in all records from a timing log
+    5. summarise_timing_records(records:list) -> list:
+        - Add up the time in each span across many records
+    6. profile(profile_file:str):
+        - Context manager to run cProfile over a block of code
+"""
+
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import time
+
+
+_span_stack = []
+_span_totals = {}
+
+# =============================================================================
+#       Time blocks of code
+# =============================================================================
+
+@contextlib.contextmanager
+def span(name:str):
+    """ Time a block of code, adding it to the span totals.
+
+    Usage:
+        with timing.span('run_mineos'):
+            ...
+
+    Arguments:
+        name:
+            - str
+            - Label for this block of code.  The full name of the span is
+              the names of all enclosing spans and this one, joined by '/'.
+    """
+
+    _span_stack.append(name)
+    full_name = '/'.join(_span_stack)
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds, count = _span_totals.get(full_name, (0., 0))
+        _span_totals[full_name] = (
+            seconds + time.perf_counter() - start_time, count + 1
+        )
+        _span_stack.pop()
+
+def collect_spans() -> dict:
+    """ Return the span totals so far, and reset them.
+
+    Returns:
+        spans:
+            - dict, {full span name: {'seconds': float, 'count': int}}
+    """
+
+    spans = {
+        name: {'seconds': seconds, 'count': count}
+        for name, (seconds, count) in _span_totals.items()
+    }
+    _span_totals.clear()
+
+    return spans
+
+
+# =============================================================================
+#       Record the timings
+# =============================================================================
+
+def write_timing_record(timing_log:str, **kwargs):
+    """ Append the span totals so far to a JSON lines file.
+
+    The span totals are reset whether or not anything is written.
+
+    Arguments:
+        timing_log:
+            - str
+            - Path to the log file.  If this is an empty string, nothing
+              is written.
+        **kwargs:
+            - Anything else to label the record with, e.g. model id,
+              location, iteration number.  Must be JSON serialisable.
+    """
+
+    spans = collect_spans()
+    if not timing_log or not spans:
+        return
+
+    record = {'time': datetime.datetime.now().isoformat(timespec='seconds')}
+    record.update(kwargs)
+    record['spans'] = spans
+
+    if os.path.dirname(timing_log):
+        os.makedirs(os.path.dirname(timing_log), exist_ok=True)
+    with open(timing_log, 'a') as fid:
+        fid.write(json.dumps(record) + '\n')
+
+def load_timing_records(timing_log:str) -> list:
+    """ Read in all of the records from a timing log.
+
+    Returns:
+        records:
+            - list of dicts, as written by write_timing_record()
+    """
+
+    if not os.path.exists(timing_log):
+        return []
+
+    with open(timing_log, 'r') as fid:
+        return [json.loads(line) for line in fid if line.strip()]
+
+def summarise_timing_records(records:list) -> list:
+    """ Add up the time spent in each span across many records.
+
+    Arguments:
+        records:
+            - list of dicts, as from load_timing_records()
+
+    Returns:
+        summary:
+            - list of tuples, (full span name, total seconds, total count)
+            - Sorted so the span with the most time in it comes first.
+    """
+
+    totals = {}
+    for record in records:
+        for name, s in record['spans'].items():
+            seconds, count = totals.get(name, (0., 0))
+            totals[name] = (seconds + s['seconds'], count + s['count'])
+
+    return sorted(
+        ((name, seconds, count) for name, (seconds, count) in totals.items()),
+        key=lambda x: x[1], reverse=True,
+    )
+
+
+# =============================================================================
+#       Profile blocks of code
+# =============================================================================
+
+@contextlib.contextmanager
+def profile(profile_file:str):
+    """ Run cProfile over a block of code, saving the stats to profile_file.
+
+    The saved stats can be read with the pstats module, e.g.
+        pstats.Stats(profile_file).sort_stats('cumulative').print_stats(20)
+
+    Arguments:
+        profile_file:
+            - str
+            - Path to save the stats to.  If this is an empty string, the
+              code is run without profiling.
+    """
+
+    if not profile_file:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if os.path.dirname(profile_file):
+            os.makedirs(os.path.dirname(profile_file), exist_ok=True)
+        profiler.dump_stats(profile_file)
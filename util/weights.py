@@ -11,6 +11,7 @@ import pandas as pd
 
 from util import constraints
 from util import define_models
+from util import artefacts
 
 # =============================================================================
 # Set up classes for commonly used variables
@@ -108,8 +109,8 @@ def build_weighting_damping(std_obs:np.array, p:np.array,
 
     # Record damping parameters
     save_name = 'output/{0}/{0}'.format(model_params.id)
-    damp_s.to_csv(save_name + 'damp_s.csv', index=False)
-    damp_t.to_csv(save_name + 'damp_t.csv', index=False)
+    artefacts.save_csv(damp_s, save_name + 'damp_s.csv', index=False)
+    artefacts.save_csv(damp_t, save_name + 'damp_t.csv', index=False)
 
     # Put all a priori constraints together
     a_priori_mat = np.vstack((
@@ -2,6 +2,7 @@ import unittest
 from parameterized import parameterized
 import shutil
 import os
+import logging
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -14,6 +15,10 @@ from util import partial_derivatives
 from util import weights
 from util import constraints
 from util import plots
+from util import logs
+from util import artefacts
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -172,11 +177,17 @@ def test_damping(): #n_iter
                     model_params.vpv_vsv_ratio,
                 )
 
-                model = define_models.setup_starting_model(model_params, location)
-
-                run_plot_inversion(
-                    model_params, model, obs, std_obs, periods, location
-                    )
+                # One MINEOS run covers the whole range of damping
+                sweep = inversion.run_damping_sweep(model_params, location)
+                i_best = inversion.l_curve_corner(sweep)
+                logger.info('Best damping scale: %.3g',
+                            sweep.damping_scales[i_best])
+                plt.figure()
+                plt.loglog(sweep.chi_squared, sweep.roughness, 'k.-')
+                plt.loglog(sweep.chi_squared[i_best], sweep.roughness[i_best],
+                           'ro')
+                plt.xlabel('Weighted chi squared')
+                plt.ylabel('Roughness')
 
 def test_MonteCarlo(n_MonteCarlo): #n_iter
 
@@ -469,7 +480,7 @@ def run_plot_inversion(model_params, model,
         plots.plot_rf_data(p_rf, 'm' + str(n), ax_rf)
 
         # Run inversion
-        print('****** ITERATION ' +  str(n) + ' ******')
+        logger.info('Iteration %d', n)
         model, G, o = inversion._inversion_iteration(model_params, model, location,
                                                   (obs, std_obs, periods))
 
@@ -536,7 +547,8 @@ def run_plot_inversion(model_params, model,
     return model, G, o
 
 
-def try_run(location:tuple, t_BLs:tuple, id:str):
+def try_run(location:tuple, t_BLs:tuple, id:str,
+            inversion_params=inversion.InversionParams(max_iterations=10)):
 
     t_Moho, t_LAB = t_BLs
     mp = define_models.ModelParams(id,
@@ -593,36 +605,47 @@ def try_run(location:tuple, t_BLs:tuple, id:str):
             boundary_inds = np.array(boundary_inds),
             d_inds = define_models._find_depth_indices(thickness, mp.depth_limits),
         )
-    max_runs = 10
     # return run_plot_inversion(mp, m0, np.hstack((ph_vel_pred, rf_p))[:, np.newaxis],
     #                    std_obs, periods, location, m, max_runs
     #                    )
-    return run_plot_inversion(mp, m0, obs,
-                       std_obs, periods, location, m, max_runs
-                       )
+    # Go through the full inversion so that it is aborted (and the location
+    # added to the failure log) if it diverges - see run_plot_inversion()
+    # for plotting each iteration
+    return inversion._run_inversion_from_model(
+        mp, m0, (obs, std_obs, periods), location, inversion_params
+    )
     #return run_plot_MC_inversion(mp, m, obs, std_obs, periods, location)
 
-def loop_through_locs():
+def loop_through_locs(log_level='INFO', log_file='', artefact_mode='write'):
 
-    broken = ((37, -107), (39, -106), (40, -108), (41, -108), (41, -107))#((33, -115), (41, -108))
+    logs.setup_logging(log_level, log_file, json_lines=bool(log_file))
+    artefacts.set_mode(artefact_mode)
+    # Locations that diverge are aborted by the inversion and logged, so skip
+    # anything that has already failed as well as those known to be broken
+    broken = {(37, -107), (39, -106), (40, -108), (41, -108), (41, -107)}#((33, -115), (41, -108))
+    broken |= {(r['lat'], r['lon']) for r in inversion.load_failure_log()}
     id = '_noMohoLAB'
     for t_LAB in [5]:
         for lat in range(33, 43, 1):
             for lon in range(-117, -102):#range(-117, -102, 1):
 
                 if (lat, lon) in broken:
-                    print('{}, {} is broken'.format(lat, lon))
+                    logger.info('%s, %s is broken', lat, lon)
                     continue
 
                 t_Moho = 3.
                 fname = '{}N_{}W_{}kmLAB{}'.format(lat, lon, t_LAB, id)
 
                 if not os.path.isfile('output/models/{}.csv'.format(fname)):
-                    print('Doing {}, {}!'.format(lat, lon))
-                    m, G, o = try_run((lat, lon), (t_Moho, t_LAB), id)
+                    logger.info('Doing %s, %s!', lat, lon)
+                    m, report = try_run((lat, lon), (t_Moho, t_LAB), id)
+                    if report.diverged:
+                        logger.warning('%s, %s diverged (%s)',
+                                       lat, lon, report.stop_reason)
+                        continue
                     define_models.save_model(m, fname)
                 else:
-                    print('Done {}, {} already!'.format(lat, lon))
+                    logger.info('Done %s, %s already!', lat, lon)
 
 def load_models(zmax=350):
     z = np.arange(0, min((zmax, 350)), 0.5)